@@ -0,0 +1,41 @@
+#!/bin/bash
+# Build the dashboard's static assets: purged, minified Tailwind CSS and the
+# vendored Chart.js, renamed by content hash and precompressed, plus a
+# manifest.json mapping logical names to the hashed files.
+#   build.sh OUT_DIR   (run next to dashboard.py, tailwind.config.js, dashboard.css)
+set -euo pipefail
+
+OUT="${1:?usage: build.sh OUT_DIR}"
+TAILWIND_VERSION="${TAILWIND_VERSION:-3.4.16}"
+CHARTJS_VERSION="${CHARTJS_VERSION:-4.4.9}"
+
+case "$(uname -m)" in
+    x86_64) arch=x64 ;;
+    aarch64|arm64) arch=arm64 ;;
+    armv7l) arch=armv7 ;;
+    *) echo "unsupported architecture: $(uname -m)" >&2; exit 1 ;;
+esac
+
+mkdir -p "$OUT" build
+curl -fsSL -o build/tailwindcss \
+    "https://github.com/tailwindlabs/tailwindcss/releases/download/v${TAILWIND_VERSION}/tailwindcss-linux-${arch}"
+chmod +x build/tailwindcss
+build/tailwindcss -c tailwind.config.js -i dashboard.css -o build/dashboard.css --minify
+curl -fsSL -o build/chart.umd.js "https://cdn.jsdelivr.net/npm/chart.js@${CHARTJS_VERSION}/dist/chart.umd.js"
+
+manifest="{"
+sep=""
+for name in dashboard.css chart.umd.js; do
+    src="build/$name"
+    # the image ships no fallback: a missing or empty asset fails the build
+    [ -s "$src" ] || { echo "$name was not built" >&2; exit 1; }
+    hash=$(sha256sum "$src" | cut -c1-12)
+    hashed="${name%%.*}.${hash}.${name##*.}"
+    cp "$src" "$OUT/$hashed"
+    gzip -9 -n -k "$OUT/$hashed"
+    brotli -q 11 -k "$OUT/$hashed"
+    manifest="${manifest}${sep}\"${name}\": \"${hashed}\""
+    sep=", "
+    echo "$name -> $hashed ($(stat -c %s "$src") bytes, $(stat -c %s "$OUT/$hashed.br") br)"
+done
+echo "${manifest}}" > "$OUT/manifest.json"
@@ -0,0 +1,6 @@
+// Classes are picked up from the markup and JS strings in DASHBOARD_HTML
+module.exports = {
+  content: ['./dashboard.py'],
+  theme: { extend: {} },
+  plugins: [],
+};
@@ -9,10 +9,100 @@ RETENTION_DAYS="${BACKUP_RETENTION_DAYS:-7}"
 TIMESTAMP=$(date +%Y%m%d_%H%M%S)
 BACKUP_FILE="anki_backup_${TIMESTAMP}.tar.gz"
 
+STATE_DIR="${STATE_DIR:-/var/lib/anki}"
+LOCK_FILE="${BACKUP_LOCK_FILE:-$STATE_DIR/backup.lock}"
+# Yield to syncs: wait while users are mid-sync or syncs are slow, for at most
+# BACKUP_MAX_WAIT seconds per run, and leave out users still syncing at the end
+BACKUP_YIELD="${BACKUP_YIELD:-true}"
+BACKUP_YIELD_P95_MS="${BACKUP_YIELD_P95_MS:-1000}"
+BACKUP_MAX_WAIT="${BACKUP_MAX_WAIT:-1800}"
+BACKUP_LOW_PRIORITY="${BACKUP_LOW_PRIORITY:-true}"
+
 log() {
     echo "[$(date '+%Y-%m-%d %H:%M:%S')] [BACKUP] $*"
 }
 
+# Machine-readable progress for the dashboard's job runner, at most once a
+# second: PROGRESS phase=<name> key=value...
+LAST_PROGRESS=-1
+progress() {
+    if [ "$BACKUP_PROGRESS" = "1" ] && { [ "$SECONDS" != "$LAST_PROGRESS" ] || [ "$1" = "force" ]; }; then
+        [ "$1" = "force" ] && shift
+        echo "PROGRESS $*"
+        LAST_PROGRESS=$SECONDS
+    fi
+}
+
+# monitor.py rewrites sync_activity.json every few seconds; a stale file
+# means it is not running and there is nothing to yield to
+THROTTLED=0
+LAST_YIELD=0
+ACTIVE=0
+P95=0
+BUSY_USERS=""
+read_activity() {
+    local out
+    out=$(python3 - "$STATE_DIR/sync_activity.json" <<'PYEOF'
+import json, sys, time
+try:
+    with open(sys.argv[1]) as f:
+        d = json.load(f)
+except (OSError, ValueError):
+    d = {}
+if time.time() - d.get('updated', 0) > 30:
+    d = {}
+print(len(d.get('active', [])), int(d.get('recent_p95_ms', 0)), *d.get('active', []))
+PYEOF
+)
+    read -r ACTIVE P95 BUSY_USERS <<< "$out"
+}
+
+sync_busy() {
+    read_activity
+    [ "$ACTIVE" -gt 0 ] || [ "$P95" -gt "$BACKUP_YIELD_P95_MS" ]
+}
+
+yield_to_syncs() {
+    LAST_YIELD=$SECONDS
+    [ "$BACKUP_YIELD" = "true" ] || return 0
+    local start=$SECONDS
+    while [ $((THROTTLED + SECONDS - start)) -lt "$BACKUP_MAX_WAIT" ] && sync_busy; do
+        progress force phase=$PHASE waiting=$ACTIVE p95_ms=$P95 throttled=$((THROTTLED + SECONDS - start))
+        sleep 5
+    done
+    THROTTLED=$((THROTTLED + SECONDS - start))
+    LAST_YIELD=$SECONDS
+}
+
+user_busy() {
+    [ "$BACKUP_YIELD" = "true" ] || return 1
+    read_activity
+    case " $BUSY_USERS " in
+        *" $1 "*) return 0 ;;
+    esac
+    return 1
+}
+
+# Throttling totals for the exporter
+record_throttle() {
+    python3 - "$STATE_DIR/backup_throttle.json" "$THROTTLED" "$*" <<'PYEOF'
+import json, os, sys, time
+path, throttled, skipped = sys.argv[1], int(sys.argv[2]), sys.argv[3].split()
+try:
+    with open(path) as f:
+        d = json.load(f)
+except (OSError, ValueError):
+    d = {}
+d['runs'] = d.get('runs', 0) + 1
+d['throttled_seconds_total'] = d.get('throttled_seconds_total', 0) + throttled
+d['skipped_users_total'] = d.get('skipped_users_total', 0) + len(skipped)
+d.update(last_run=int(time.time()), last_throttled_seconds=throttled, last_skipped_users=skipped)
+with open(path + '.tmp', 'w') as f:
+    json.dump(d, f)
+os.replace(path + '.tmp', path)
+PYEOF
+}
+
 notify() {
     local message="$1"
 
@@ -141,45 +231,162 @@ except Exception as e:
 EOF
 }
 
-log "Starting backup..."
-
 mkdir -p "$BACKUP_DIR"
 
+# One backup at a time, whether started by cron or from the dashboard; wait a
+# little so a momentary probe of the lock (monitor, dashboard) never skips a run.
+# maintenance.py holds it shared while it works on a collection: wait for that,
+# but never queue behind another backup. The pending marker tells maintenance
+# to start no further users, so its shared holds can't outlast the wait.
+exec 9>>"$LOCK_FILE"
+if ! flock -w 10 9; then
+    if ! flock -s -n "$LOCK_FILE" true; then
+        log "Another backup is already running, skipping"
+        exit 75
+    fi
+    echo $$ > "$LOCK_FILE.pending.$$"
+    flock -w 1800 9
+    rc=$?
+    rm -f "$LOCK_FILE.pending.$$"
+    if [ "$rc" -ne 0 ]; then
+        log "Maintenance kept the backup lock for 30 minutes, skipping"
+        exit 75
+    fi
+fi
+
+# Stay out of the sync server's way: lowest CPU priority, idle-class I/O
+if [ "$BACKUP_LOW_PRIORITY" = "true" ]; then
+    renice -n 19 -p $$ > /dev/null 2>&1 || true
+    ionice -c 3 -p $$ > /dev/null 2>&1 || true
+fi
+
+log "Starting backup..."
+progress force phase=prepare
+
 DATA_SIZE=$(du -sh "$DATA_DIR" 2>/dev/null | cut -f1 || echo "unknown")
 log "Data directory size: $DATA_SIZE"
 
 # Stage a SQLite-safe snapshot; BACKUP_DIR because /tmp may be a small tmpfs
 STAGING=$(mktemp -d "${BACKUP_DIR}/.staging.XXXXXX")
-trap 'rm -rf "$STAGING"' EXIT
+COMPLETE=false
+TAR_PID=""
+cleanup() {
+    if [ -n "$TAR_PID" ]; then
+        kill -CONT "$TAR_PID" 2> /dev/null || true
+    fi
+    rm -rf "$STAGING"
+    [ "$COMPLETE" = "true" ] || rm -f "${BACKUP_DIR}/${BACKUP_FILE}"
+}
+trap cleanup EXIT
+trap 'log "Cancelled"; exit 143' TERM INT
 
 cd "$DATA_DIR"
-find . -type d -exec mkdir -p "$STAGING/{}" \;
-find . -type f ! -name '*.anki2*' ! -name '*.db' ! -name '*-wal' ! -name '*-shm' \
-    -exec cp -a {} "$STAGING/{}" \;
-find . -type f \( -name '*.anki2' -o -name '*.db' \) -print0 | while IFS= read -r -d '' db; do
-    if ! sqlite3 -cmd '.timeout 10000' "$db" ".backup '$STAGING/$db'" 2>/dev/null; then
-        # locked by the server (e.g. media.db): raw copy instead
-        cp -a "$db" "$STAGING/$db"
-        for sib in "$db-wal" "$db-shm"; do
-            [ -f "$sib" ] && cp -a "$sib" "$STAGING/$sib" || true
-        done
-        log "WARN: $db locked, copied raw instead of sqlite snapshot"
+read -r TOTAL_FILES TOTAL_BYTES < <(find . -path './.*' -prune -o -type f ! -name '*-wal' ! -name '*-shm' -printf '%s\n' \
+    | awk '{n++; b+=$1} END {printf "%d %d\n", n, b}')
+find . -path './.*' -prune -o -type d -exec mkdir -p "$STAGING/{}" \;
+FILES=0
+BYTES=0
+PHASE=snapshot
+
+# Copy one top-level entry of DATA_DIR (normally a user) into the staging area
+stage() {
+    local entry size f
+    while IFS= read -r -d '' entry; do
+        size="${entry%% *}"
+        f="${entry#* }"
+        case "$f" in
+            *-wal|*-shm) continue ;;
+        esac
+        case "$f" in
+            *.anki2|*.db)
+                if ! sqlite3 -cmd '.timeout 10000' "$f" ".backup '$STAGING/$f'" 2>/dev/null; then
+                    # locked by the server (e.g. media.db): raw copy instead
+                    cp -a "$f" "$STAGING/$f"
+                    for sib in "$f-wal" "$f-shm"; do
+                        [ -f "$sib" ] && cp -a "$sib" "$STAGING/$sib" || true
+                    done
+                    log "WARN: $f locked, copied raw instead of sqlite snapshot"
+                fi
+                ;;
+            *)
+                cp -a "$f" "$STAGING/$f"
+                ;;
+        esac
+        FILES=$((FILES + 1))
+        BYTES=$((BYTES + size))
+        progress phase=snapshot files=$FILES bytes=$BYTES total_files=$TOTAL_FILES total_bytes=$TOTAL_BYTES throttled=$THROTTLED
+        if [ $((SECONDS - LAST_YIELD)) -ge 5 ]; then
+            yield_to_syncs
+        fi
+    done < <(find "$1" -type f -printf '%s %p\0')
+}
+
+# A user who is mid-sync is retried once everyone else is done, and left out
+# of this backup if they are still syncing then. With SYNC_SHARDS the users
+# sit one level down, in shard-<i>/. Dot-directories are restore.sh's
+# extraction and safety copies.
+DEFERRED=()
+SKIPPED=()
+while IFS= read -r -d '' top; do
+    yield_to_syncs
+    if [ -d "$top" ] && user_busy "${top##*/}"; then
+        log "${top##*/} is syncing, retrying at the end"
+        DEFERRED+=("$top")
+        continue
     fi
+    stage "$top"
+done < <({ find . -mindepth 1 -maxdepth 1 ! -name 'shard-*' ! -name '.*' -print0
+           find . -mindepth 2 -maxdepth 2 -path './shard-*/*' -print0; } | sort -z)
+for top in "${DEFERRED[@]}"; do
+    yield_to_syncs
+    if user_busy "${top##*/}"; then
+        log "WARN: ${top##*/} still syncing, left out of this backup"
+        SKIPPED+=("${top##*/}")
+        rm -rf "${STAGING:?}/${top#./}"
+        continue
+    fi
+    stage "$top"
 done
+progress force phase=snapshot files=$FILES bytes=$BYTES total_files=$TOTAL_FILES total_bytes=$TOTAL_BYTES throttled=$THROTTLED
 
+# tar reports every 100 records (of 10240 bytes) it has written, as
+# "tar: PROGRESS ..." on stderr
+PHASE=compress
+CHECKPOINT=()
+if [ "$BACKUP_PROGRESS" = "1" ]; then
+    CHECKPOINT=(--checkpoint=100 "--checkpoint-action=echo=PROGRESS phase=compress records=%u record_bytes=10240 total_bytes=$BYTES")
+fi
+COMPRESS=(-z)
 if command -v pigz > /dev/null 2>&1; then
-    tar -C "$STAGING" -I pigz -cf "${BACKUP_DIR}/${BACKUP_FILE}" .
-else
-    tar -C "$STAGING" -czf "${BACKUP_DIR}/${BACKUP_FILE}" .
+    COMPRESS=(-I pigz)
 fi
+tar "${CHECKPOINT[@]}" -C "$STAGING" "${COMPRESS[@]}" -cf "${BACKUP_DIR}/${BACKUP_FILE}" . 2>&1 &
+TAR_PID=$!
+# compression is paused (SIGSTOP; pigz then blocks on its input) while syncs run
+while kill -0 "$TAR_PID" 2> /dev/null; do
+    sleep 1
+    if [ "$BACKUP_YIELD" = "true" ] && [ "$THROTTLED" -lt "$BACKUP_MAX_WAIT" ] && sync_busy; then
+        kill -STOP "$TAR_PID" 2> /dev/null || true
+        yield_to_syncs
+        kill -CONT "$TAR_PID" 2> /dev/null || true
+    fi
+done
+wait "$TAR_PID"
+TAR_PID=""
+COMPLETE=true
 rm -rf "$STAGING"
 trap - EXIT
 
 BACKUP_SIZE=$(du -sh "${BACKUP_DIR}/${BACKUP_FILE}" | cut -f1)
 log "Backup created: $BACKUP_FILE ($BACKUP_SIZE)"
+if [ "$THROTTLED" -gt 0 ] || [ ${#SKIPPED[@]} -gt 0 ]; then
+    log "Yielded to syncs for ${THROTTLED}s${SKIPPED[*]:+, left out: ${SKIPPED[*]}}"
+fi
+record_throttle "${SKIPPED[@]}"
 
 S3_STATUS="N/A"
 if [ "$S3_BACKUP_ENABLED" = "true" ]; then
+    progress force phase=upload
     if upload_to_s3; then
         S3_STATUS="OK"
         cleanup_s3
@@ -188,6 +395,7 @@ if [ "$S3_BACKUP_ENABLED" = "true" ]; then
     fi
 fi
 
+progress force phase=cleanup
 log "Cleaning up backups older than $RETENTION_DAYS days..."
 DELETED_COUNT=$(find "$BACKUP_DIR" \( -name "anki_backup_*.tar.gz" -o -name "pre_restore_*.tar.gz" \) -mtime +$RETENTION_DAYS -delete -print 2>/dev/null | wc -l || echo 0)
 log "Deleted $DELETED_COUNT old local backup(s)"
@@ -196,10 +404,12 @@ BACKUP_COUNT=$(ls -1 "$BACKUP_DIR"/anki_backup_*.tar.gz 2>/dev/null | wc -l || e
 TOTAL_SIZE=$(du -sh "$BACKUP_DIR" 2>/dev/null | cut -f1 || echo "unknown")
 log "Backup complete. Total: $BACKUP_COUNT backups, $TOTAL_SIZE"
 
+progress force phase=done file=$BACKUP_FILE
 notify "Backup complete
 File: $BACKUP_FILE
 Size: $BACKUP_SIZE
 S3: $S3_STATUS
-Total: $BACKUP_COUNT backups"
+Total: $BACKUP_COUNT backups${SKIPPED[*]:+
+Left out (syncing): ${SKIPPED[*]}}"
 
 exit 0
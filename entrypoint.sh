@@ -5,6 +5,59 @@ set -e
 # Anki Sync Server Enhanced - Entrypoint
 # =============================================================================
 
+# -----------------------------------------------------------------------------
+# Startup phases
+# -----------------------------------------------------------------------------
+# phase_done <name> records the time since the previous phase; the list ends up
+# in /var/lib/anki/startup.json, which the exporter publishes
+STARTUP_T0=${EPOCHREALTIME/./}
+PHASE_MARK=$STARTUP_T0
+PHASES=()
+
+phase_done() {
+    local now=${EPOCHREALTIME/./}
+    PHASES+=("$1 $(( (now - PHASE_MARK) / 1000 ))")
+    PHASE_MARK=$now
+}
+
+# milliseconds as a JSON number of seconds
+ms_json() {
+    printf '%d.%03d' $(($1 / 1000)) $(($1 % 1000))
+}
+
+# Merge a JSON object into startup.json; the background ownership repair
+# writes to it too, possibly at the same time
+startup_merge() {
+    STARTUP_UPDATE="$1" flock /var/lib/anki/startup.lock python3 -c '
+import json, os
+path = "/var/lib/anki/startup.json"
+try:
+    with open(path) as f:
+        data = json.load(f)
+except (OSError, ValueError):
+    data = {}
+data.update(json.loads(os.environ["STARTUP_UPDATE"]))
+with open(path + ".tmp", "w") as f:
+    json.dump(data, f, indent=2)
+os.replace(path + ".tmp", path)
+'
+}
+
+# wait_for_port <host> <port> <timeout s> [pid]: poll until the port accepts
+# connections; fails early if pid exits
+wait_for_port() {
+    local host=$1 port=$2 pid=$4
+    local deadline=$(( ${EPOCHREALTIME/./} + $3 * 1000000 ))
+    case "$host" in 0.0.0.0|::|"") host=127.0.0.1 ;; esac
+    while ! (exec 3<> "/dev/tcp/$host/$port") 2> /dev/null; do
+        if [ -n "$pid" ] && ! kill -0 "$pid" 2> /dev/null; then
+            return 1
+        fi
+        [ "${EPOCHREALTIME/./}" -lt "$deadline" ] || return 1
+        sleep 0.05
+    done
+}
+
 # -----------------------------------------------------------------------------
 # Handle PUID/PGID for file permissions
 # -----------------------------------------------------------------------------
@@ -16,12 +69,47 @@ if [ "$PUID" != "1000" ] || [ "$PGID" != "1000" ]; then
     usermod -o -u "$PUID" anki 2>/dev/null || true
 fi
 
-# Fix ownership of volumes created by older root-running releases
-for dir in /data /backups /config /var/log/anki /var/lib/anki; do
-    if [ -d "$dir" ] && [ "$(stat -c %u "$dir")" != "$(id -u anki)" ]; then
-        chown -R anki:anki "$dir" 2>/dev/null || true
-    fi
-done
+# Fix ownership of volumes created by older root-running releases or left
+# behind by a PUID/PGID change. Only entries with the wrong owner are touched.
+# The small volumes and the top of /data (user folders and the files directly
+# in them) are fixed before the server starts; the rest of /data and /backups
+# is repaired in the background, OWNERSHIP_JOBS folders at a time.
+# ownership.done holds the uid:gid of the last completed repair, so a finished
+# one is not repeated and an interrupted one resumes on the next start.
+OWNER="$(id -u anki):$(id -g anki)"
+OWNERSHIP_DONE=/var/lib/anki/ownership.done
+OWNERSHIP_JOBS="${OWNERSHIP_JOBS:-4}"
+
+fix_owner() {
+    find "$@" \( ! -user anki -o ! -group anki \) -print -exec chown -h anki:anki {} + 2> /dev/null | wc -l
+}
+
+OWNERSHIP_STATE=done
+if [ "$(cat "$OWNERSHIP_DONE" 2> /dev/null)" != "$OWNER" ] || [ "$(stat -c %u:%g /data 2> /dev/null)" != "$OWNER" ]; then
+    OWNERSHIP_STATE=running
+    fixed=$(fix_owner /config /var/log/anki /var/lib/anki)
+    # /data/<user>/* and /data/shard-N/<user>/*; media is left to the background pass
+    fixed=$((fixed + $(fix_owner /data -maxdepth 2)))
+    for shard in /data/shard-*; do
+        [ -d "$shard" ] && fixed=$((fixed + $(fix_owner "$shard" -mindepth 2 -maxdepth 2)))
+    done
+    echo "[INFO] Fixed ownership of $fixed entries, repairing the rest in the background"
+fi
+phase_done ownership
+
+echo "{\"started\": ${STARTUP_T0:0:-6}, \"ownership_repair\": {\"state\": \"$OWNERSHIP_STATE\"}}" > /var/lib/anki/startup.json
+if [ "$OWNERSHIP_STATE" = "running" ]; then
+    (
+        t0=${EPOCHREALTIME/./}
+        fixed=$( { find /data -mindepth 2 -maxdepth 2 -type d -print0 2> /dev/null; printf '/backups\0'; } \
+                 | xargs -0 -r -n 1 -P "$OWNERSHIP_JOBS" sh -c \
+                     'find "$1" \( ! -user anki -o ! -group anki \) -print -exec chown -h anki:anki {} + 2> /dev/null' _ \
+                 | wc -l)
+        echo "$OWNER" > "$OWNERSHIP_DONE"
+        startup_merge "{\"ownership_repair\": {\"state\": \"done\", \"fixed\": $fixed, \"seconds\": $(ms_json $(( (${EPOCHREALTIME/./} - t0) / 1000 )))}}"
+        echo "[INFO] Background ownership repair done: $fixed entries fixed"
+    ) &
+fi
 
 run_as_anki() {
     setpriv --reuid anki --regid anki --init-groups "$@"
@@ -33,6 +121,11 @@ run_as_anki() {
 export SYNC_BASE="${SYNC_BASE:-/data}"
 export SYNC_HOST="${SYNC_HOST:-0.0.0.0}"
 export SYNC_PORT="${SYNC_PORT:-8080}"
+# SYNC_SHARDS > 1: one sync server per shard behind a Caddy router on SYNC_PORT
+export SYNC_SHARDS="${SYNC_SHARDS:-1}"
+export SYNC_SHARD_BASE_PORT="${SYNC_SHARD_BASE_PORT:-8090}"
+# Indexed user store, seeded from SYNC_USERn and edited with user-manager.sh
+export USER_DB="${USER_DB:-/config/users.db}"
 export LOG_LEVEL="${LOG_LEVEL:-info}"
 export TZ="${TZ:-UTC}"
 
@@ -47,6 +140,10 @@ fi
 export BACKUP_ENABLED="${BACKUP_ENABLED:-false}"
 export BACKUP_SCHEDULE="${BACKUP_SCHEDULE:-0 3 * * *}"
 export BACKUP_RETENTION_DAYS="${BACKUP_RETENTION_DAYS:-7}"
+export BACKUP_YIELD="${BACKUP_YIELD:-true}"
+export BACKUP_YIELD_P95_MS="${BACKUP_YIELD_P95_MS:-1000}"
+export BACKUP_MAX_WAIT="${BACKUP_MAX_WAIT:-1800}"
+export BACKUP_LOW_PRIORITY="${BACKUP_LOW_PRIORITY:-true}"
 
 # S3 backup settings
 export S3_BACKUP_ENABLED="${S3_BACKUP_ENABLED:-false}"
@@ -55,6 +152,9 @@ export S3_BUCKET="${S3_BUCKET:-}"
 export S3_ACCESS_KEY="${S3_ACCESS_KEY:-}"
 export S3_SECRET_KEY="${S3_SECRET_KEY:-}"
 export S3_REGION="${S3_REGION:-us-east-1}"
+export S3_RESTORE_CONCURRENCY="${S3_RESTORE_CONCURRENCY:-8}"
+export S3_RESTORE_PART_MB="${S3_RESTORE_PART_MB:-8}"
+export S3_RESTORE_RETRIES="${S3_RESTORE_RETRIES:-5}"
 
 # TLS settings
 export TLS_ENABLED="${TLS_ENABLED:-false}"
@@ -88,11 +188,43 @@ export FAIL2BAN_FIND_TIME="${FAIL2BAN_FIND_TIME:-600}"
 # Metrics settings
 export METRICS_ENABLED="${METRICS_ENABLED:-false}"
 export METRICS_PORT="${METRICS_PORT:-9090}"
+export METRICS_USER_MODE="${METRICS_USER_MODE:-full}"
+export METRICS_TOP_N="${METRICS_TOP_N:-20}"
+export METRICS_TOP_BY="${METRICS_TOP_BY:-size}"
+export METRICS_USERS_TTL="${METRICS_USERS_TTL:-300}"
 
 # Dashboard settings
 export DASHBOARD_ENABLED="${DASHBOARD_ENABLED:-false}"
 export DASHBOARD_PORT="${DASHBOARD_PORT:-8081}"
 export DASHBOARD_AUTH="${DASHBOARD_AUTH:-}"
+export EXPORT_RATE_MB="${EXPORT_RATE_MB:-20}"
+export EXPORT_CONCURRENCY="${EXPORT_CONCURRENCY:-1}"
+export EXPORT_SNAPSHOT_MAX_MB="${EXPORT_SNAPSHOT_MAX_MB:-256}"
+
+# Log rotation settings
+export LOG_ROTATE_ENABLED="${LOG_ROTATE_ENABLED:-true}"
+export LOG_MAX_SIZE_MB="${LOG_MAX_SIZE_MB:-10}"
+export LOG_MAX_AGE_HOURS="${LOG_MAX_AGE_HOURS:-24}"
+export LOG_KEEP_SEGMENTS="${LOG_KEEP_SEGMENTS:-10}"
+export LOG_RETENTION_DAYS="${LOG_RETENTION_DAYS:-30}"
+export LOG_COMPRESS="${LOG_COMPRESS:-auto}"
+
+# Sync session tracing (monitor.py)
+export SYNC_SESSION_TIMEOUT="${SYNC_SESSION_TIMEOUT:-600}"
+
+# Collection maintenance settings (maintenance.py)
+export MAINT_ENABLED="${MAINT_ENABLED:-true}"
+export MAINT_INTERVAL="${MAINT_INTERVAL:-3600}"
+export MAINT_EVERY_HOURS="${MAINT_EVERY_HOURS:-24}"
+export MAINT_IDLE_MINUTES="${MAINT_IDLE_MINUTES:-15}"
+export MAINT_ANALYZE_DAYS="${MAINT_ANALYZE_DAYS:-7}"
+export MAINT_VACUUM_FREE_RATIO="${MAINT_VACUUM_FREE_RATIO:-0.2}"
+export MAINT_VACUUM_MIN_MB="${MAINT_VACUUM_MIN_MB:-8}"
+export MAINT_CONCURRENCY="${MAINT_CONCURRENCY:-1}"
+export MEDIA_ORPHANS_ENABLED="${MEDIA_ORPHANS_ENABLED:-true}"
+export MEDIA_RECLAIM="${MEDIA_RECLAIM:-off}"
+export MEDIA_ORPHAN_MIN_AGE_HOURS="${MEDIA_ORPHAN_MIN_AGE_HOURS:-24}"
+export MEDIA_QUARANTINE_DAYS="${MEDIA_QUARANTINE_DAYS:-14}"
 
 # Version info
 ANKI_VERSION=$(cat /anki_version.txt 2>/dev/null || echo "unknown")
@@ -190,10 +322,12 @@ shutdown_handler() {
     log_info "Received shutdown signal, stopping gracefully..."
     send_notification "Server shutting down" "Anki Sync Server"
 
-    if [ -n "$SYNC_PID" ]; then
-        kill -TERM "$SYNC_PID" 2>/dev/null || true
-        wait "$SYNC_PID" 2>/dev/null || true
-    fi
+    for pid in "${SYNC_PIDS[@]}"; do
+        kill -TERM "$pid" 2>/dev/null || true
+    done
+    for pid in "${SYNC_PIDS[@]}"; do
+        wait "$pid" 2>/dev/null || true
+    done
 
     if [ -n "$CADDY_PID" ]; then
         kill -TERM "$CADDY_PID" 2>/dev/null || true
@@ -211,6 +345,14 @@ shutdown_handler() {
         kill -TERM "$MONITOR_PID" 2>/dev/null || true
     fi
 
+    if [ -n "$LOGROTATE_PID" ]; then
+        kill -TERM "$LOGROTATE_PID" 2>/dev/null || true
+    fi
+
+    if [ -n "$MAINT_PID" ]; then
+        kill -TERM "$MAINT_PID" 2>/dev/null || true
+    fi
+
     if [ -f /var/run/crond.pid ]; then
         kill $(cat /var/run/crond.pid) 2>/dev/null || true
     fi
@@ -223,6 +365,35 @@ shutdown_handler() {
 
 trap shutdown_handler SIGTERM SIGINT SIGQUIT
 
+# user-manager.sh sends SIGHUP after changing the user store; the supervisor
+# loop at the end reloads users and restarts the sync servers they affect
+RELOAD=false
+trap 'RELOAD=true' SIGHUP
+SUPERVISOR_PID_FILE=/var/run/anki-supervisor.pid
+# while this file exists the sync servers are stopped and kept down; it holds
+# the holder's PID (restore.sh), so a holder that was killed doesn't keep them
+# down for good
+HOLD_FILE=/var/lib/anki/supervisor.hold
+echo $$ > "$SUPERVISOR_PID_FILE"
+# /var/lib/anki lives in the container layer: a restore interrupted by a crash
+# leaves its hold behind across the restart
+if [ -e "$HOLD_FILE" ]; then
+    log_warn "Removing $HOLD_FILE left by an interrupted restore"
+    rm -f "$HOLD_FILE"
+fi
+
+hold_active() {
+    [ -e "$HOLD_FILE" ] || return 1
+    local holder
+    holder=$(cat "$HOLD_FILE" 2>/dev/null)
+    if [ -n "$holder" ] && ! kill -0 "$holder" 2>/dev/null; then
+        log_warn "Removing $HOLD_FILE: its holder (PID $holder) is gone"
+        rm -f "$HOLD_FILE"
+        return 1
+    fi
+    return 0
+}
+
 # -----------------------------------------------------------------------------
 # Docker secrets support
 # -----------------------------------------------------------------------------
@@ -258,40 +429,251 @@ load_secret "DASHBOARD_AUTH"
 # -----------------------------------------------------------------------------
 # Build user list
 # -----------------------------------------------------------------------------
-USER_COUNT=0
-USER_NAMES=""
+# The store (userstore.py) is the list of record: SYNC_USERn variables are
+# merged into it here, and load_users re-exports its rows as SYNC_USER1..n,
+# which is all anki-sync-server reads. The exporter and dashboard read the
+# store directly.
+run_as_anki python3 /usr/local/bin/userstore.py seed || { log_error "Cannot open user store $USER_DB"; exit 1; }
+
+load_users() {
+    while IFS= read -r var; do
+        unset "${var%%=*}"
+    done < <(env | grep -E '^SYNC_USER[0-9]+=')
+    USER_COUNT=0
+    USER_NAMES=""
+    local value
+    while IFS= read -r value; do
+        [ -n "$value" ] || continue
+        USER_COUNT=$((USER_COUNT + 1))
+        export "SYNC_USER$USER_COUNT=$value"
+        if [ "$USER_COUNT" -le 5 ]; then
+            USER_NAMES="${USER_NAMES:+$USER_NAMES, }${value%%:*}"
+        fi
+    done < <(run_as_anki python3 /usr/local/bin/userstore.py env)
+    [ "$USER_COUNT" -le 5 ] || USER_NAMES+=", ..."
+    echo "$USER_COUNT" > /var/lib/anki/user_count.txt
+}
 
-# Save user list for dashboard (one username per line)
-: > /var/lib/anki/users.txt
-while IFS= read -r var; do
-    value="${var#*=}"
-    username="${value%%:*}"
-    USER_NAMES="${USER_NAMES:+$USER_NAMES, }$username"
-    USER_COUNT=$((USER_COUNT + 1))
-    echo "$username" >> /var/lib/anki/users.txt
-done < <(env | grep -E '^SYNC_USER[0-9]+=' | sort -t= -k1 -V)
+load_users
 
 if [ "$USER_COUNT" -eq 0 ]; then
-    log_error "No users defined. Set SYNC_USER1=username:password"
+    log_error "No users defined. Set SYNC_USER1=username:password or use user-manager.sh import"
     exit 1
 fi
 
-echo "$USER_COUNT" > /var/lib/anki/user_count.txt
-
 # Keep counters across restarts
 [ -f /var/lib/anki/sync_count.txt ] || echo "0" > /var/lib/anki/sync_count.txt
 [ -f /var/lib/anki/bytes_synced.txt ] || echo "0" > /var/lib/anki/bytes_synced.txt
+run_as_anki touch /var/lib/anki/backup.lock
+
+# -----------------------------------------------------------------------------
+# Shards
+# -----------------------------------------------------------------------------
+# Users are placed on shard sha1(name) mod SYNC_SHARDS (shards.py, which the
+# exporter and dashboard use too). Logins (/sync/hostKey) carry no host key
+# yet and go to shard 0, so shard 0 knows every user; every later request
+# carries the user's host key, sha1 of the SYNC_USER value, in its Anki-Sync
+# header and is routed on that.
+route_users() {
+    SHARD_USERS=()
+    SHARD_KEYS=()
+    PROXY_BLOCK="    reverse_proxy localhost:${SYNC_PORT}"
+    [ "$SYNC_SHARDS" -gt 1 ] || return 0
+    local shard hkey value i
+    while IFS=$'\t' read -r shard hkey value; do
+        SHARD_USERS[$shard]+="$value"$'\n'
+        SHARD_KEYS[$shard]="${SHARD_KEYS[$shard]:+${SHARD_KEYS[$shard]}|}$hkey"
+    done < <(env | grep -E '^SYNC_USER[0-9]+=' | sort -t= -k1 -V | cut -d= -f2- \
+             | python3 /usr/local/bin/shards.py --route)
+
+    PROXY_BLOCK=""
+    for i in $(seq 1 $((SYNC_SHARDS - 1))); do
+        [ -n "${SHARD_KEYS[$i]}" ] || continue
+        PROXY_BLOCK+="    @shard$i header_regexp Anki-Sync \`\"k\"\\s*:\\s*\"(${SHARD_KEYS[$i]})\"\`
+    handle @shard$i {
+        reverse_proxy localhost:$((SYNC_SHARD_BASE_PORT + i))
+    }
+"
+    done
+    PROXY_BLOCK+="    handle {
+        reverse_proxy localhost:${SYNC_SHARD_BASE_PORT}
+    }"
+}
+
+route_users
+
+# Move a user's data to where the current SYNC_SHARDS puts it: data synced
+# before sharding, under another shard count, or sharded before going back to
+# one server. The login shard leaves media-only stubs for everyone, so go by
+# the collection; a target that already has one is left alone.
+move_user_data() {
+    local username="$1" target="$2" where="$3" old
+    [ ! -e "$target/collection.anki2" ] || return 0
+    for old in "$SYNC_BASE/$username" "$SYNC_BASE"/shard-*/"$username"; do
+        if [ "$old" != "$target" ] && [ -e "$old/collection.anki2" ]; then
+            if [ -d "$target" ] && [ -z "$(find "$target" -type f ! -name 'media.db*' -print -quit)" ]; then
+                rm -rf "$target"
+            fi
+            if [ ! -e "$target" ]; then
+                mv "$old" "$target"
+                log_info "Moved $username's data to $where"
+            else
+                log_warn "$username has data in both $old and $target, leaving both in place"
+            fi
+            return 0
+        fi
+    done
+}
+
+if [ "$SYNC_SHARDS" -gt 1 ]; then
+    log_info "Sharding users across $SYNC_SHARDS sync servers"
+    for i in $(seq 0 $((SYNC_SHARDS - 1))); do
+        run_as_anki mkdir -p "$SYNC_BASE/shard-$i"
+        while IFS= read -r value; do
+            [ -n "$value" ] || continue
+            username="${value%%:*}"
+            move_user_data "$username" "$SYNC_BASE/shard-$i/$username" "shard $i"
+        done <<< "${SHARD_USERS[$i]}"
+    done
+elif compgen -G "$SYNC_BASE/shard-*" > /dev/null; then
+    # SYNC_SHARDS went back to 1: bring everyone home from their shard
+    while IFS= read -r value; do
+        username="${value%%:*}"
+        move_user_data "$username" "$SYNC_BASE/$username" "$SYNC_BASE"
+    done < <(env | grep -E '^SYNC_USER[0-9]+=' | cut -d= -f2-)
+fi
+
+# One anki-sync-server, or one per shard on SYNC_SHARD_BASE_PORT + i; shards
+# that already have a live server are left alone
+SYNC_PIDS=()
+start_sync_servers() {
+    local i
+    for i in $(seq 0 $((SYNC_SHARDS - 1))); do
+        if [ -n "${SYNC_PIDS[$i]}" ] && kill -0 "${SYNC_PIDS[$i]}" 2>/dev/null; then
+            continue
+        fi
+        if [ "$SYNC_SHARDS" -le 1 ]; then
+            run_as_anki anki-sync-server >> /var/log/anki/server.log 2>&1 &
+            SYNC_PIDS[0]=$!
+            break
+        fi
+        (
+            while IFS= read -r var; do
+                unset "${var%%=*}"
+            done < <(env | grep -E '^SYNC_USER[0-9]+=')
+            users="${SHARD_USERS[$i]}"
+            if [ "$i" -eq 0 ]; then
+                users=$(printf '%s' "${SHARD_USERS[@]}")
+            fi
+            n=0
+            while IFS= read -r value; do
+                [ -n "$value" ] || continue
+                n=$((n + 1))
+                export "SYNC_USER$n=$value"
+            done <<< "$users"
+            export SYNC_BASE="$SYNC_BASE/shard-$i" SYNC_HOST=127.0.0.1 SYNC_PORT=$((SYNC_SHARD_BASE_PORT + i))
+            exec setpriv --reuid anki --regid anki --init-groups anki-sync-server
+        ) >> /var/log/anki/server.log 2>&1 &
+        SYNC_PIDS[$i]=$!
+    done
+}
+
+stop_sync_server() {
+    local pid="${SYNC_PIDS[$1]}"
+    unset "SYNC_PIDS[$1]"
+    [ -n "$pid" ] || return 0
+    kill -TERM "$pid" 2>/dev/null || true
+    # a SIGHUP can cut the wait short; the port must be free before a restart
+    while kill -0 "$pid" 2>/dev/null; do
+        wait "$pid" 2>/dev/null || true
+    done
+}
+
+phase_done users
+
+# -----------------------------------------------------------------------------
+# Start the sync server
+# -----------------------------------------------------------------------------
+# Before Caddy, the dashboard and the rest, none of which it depends on
+log_info "Starting Anki sync server..."
+
+start_sync_servers
+
+# monitor.py follows server.log, writes auth/devices/sync/latency logs and
+# keeps in-memory state (e.g. failed logins per IP) in /var/lib/anki
+monitor_sync_output() {
+    LOG_DIR=/var/log/anki SERVER_LOG="$1" run_as_anki python3 /usr/local/bin/monitor.py
+}
+
+monitor_sync_output /var/log/anki/server.log &
+MONITOR_PID=$!
+
+for i in "${!SYNC_PIDS[@]}"; do
+    if [ "$SYNC_SHARDS" -le 1 ]; then
+        wait_for_port "$SYNC_HOST" "$SYNC_PORT" 60 "${SYNC_PIDS[$i]}" \
+            || log_error "Sync server is not accepting connections on port $SYNC_PORT"
+    else
+        wait_for_port 127.0.0.1 $((SYNC_SHARD_BASE_PORT + i)) 60 "${SYNC_PIDS[$i]}" \
+            || log_error "Shard $i is not accepting connections on port $((SYNC_SHARD_BASE_PORT + i))"
+    fi
+done
+SYNC_READY_MS=$(( (${EPOCHREALTIME/./} - STARTUP_T0) / 1000 ))
+phase_done sync_server
+
+log_info "Sync server started with PID ${SYNC_PIDS[*]} ($(ms_json "$SYNC_READY_MS")s after container start)"
 
 # -----------------------------------------------------------------------------
 # Setup TLS with Caddy
 # -----------------------------------------------------------------------------
-setup_tls() {
-    log_info "Setting up TLS with Caddy..."
+# Caddy runs with the admin API off, so a changed shard route means a restart
+write_caddyfile() {
 
     local CADDYFILE="/config/caddy/Caddyfile"
     mkdir -p /config/caddy
 
-    if [ -n "$TLS_DOMAIN" ]; then
+    # JSON access log for monitor.py: keep only the host key prefix from the
+    # Anki-Sync header so requests can be attributed, and drop credentials
+    local LOG_BLOCK
+    LOG_BLOCK=$(cat << 'EOF'
+    log {
+        output file /var/log/anki/caddy.log {
+            roll_disabled
+        }
+        format filter {
+            wrap json
+            fields {
+                request>headers>Anki-Sync regexp `^.*"k":"([0-9a-f]{8})[0-9a-f]*".*$` "${1}"
+                request>headers>Authorization delete
+                request>headers>Cookie delete
+            }
+        }
+    }
+EOF
+)
+    # rotated by logstore.py as anki
+    run_as_anki touch /var/log/anki/caddy.log
+
+    # sharded: plain HTTP clients reach the router on SYNC_PORT as before
+    local ROUTER_SITE=""
+    if [ "$SYNC_SHARDS" -gt 1 ]; then
+        ROUTER_SITE="
+http://:${SYNC_PORT} {
+${PROXY_BLOCK}
+
+${LOG_BLOCK}
+}"
+    fi
+
+    if [ "$TLS_ENABLED" != "true" ]; then
+        log_info "Generating Caddyfile for the shard router"
+        cat > "$CADDYFILE" << EOF
+{
+    admin off
+    auto_https off
+}
+${ROUTER_SITE}
+EOF
+    elif [ -n "$TLS_DOMAIN" ]; then
         log_info "Using Let's Encrypt for $TLS_DOMAIN"
         log_info "Generating Caddyfile for Let's Encrypt (domain: $TLS_DOMAIN)"
         cat > "$CADDYFILE" << EOF
@@ -302,13 +684,11 @@ setup_tls() {
 }
 
 ${TLS_DOMAIN} {
-    reverse_proxy localhost:${SYNC_PORT}
-    
-    log {
-        output file /var/log/anki/caddy.log
-        format console
-    }
+${PROXY_BLOCK}
+
+${LOG_BLOCK}
 }
+${ROUTER_SITE}
 EOF
     elif [ -n "$TLS_CERT" ] && [ -n "$TLS_KEY" ] && [ -f "$TLS_CERT" ] && [ -f "$TLS_KEY" ]; then
         log_info "Using provided TLS certificates"
@@ -322,13 +702,11 @@ EOF
 https://:${TLS_PORT} {
     tls ${TLS_CERT} ${TLS_KEY}
 
-    reverse_proxy localhost:${SYNC_PORT}
+${PROXY_BLOCK}
 
-    log {
-        output file /var/log/anki/caddy.log
-        format console
-    }
+${LOG_BLOCK}
 }
+${ROUTER_SITE}
 EOF
     else
         log_info "Using self-signed certificate (set TLS_DOMAIN for Let's Encrypt)"
@@ -344,25 +722,29 @@ https://:${TLS_PORT} {
         on_demand
     }
 
-    reverse_proxy localhost:${SYNC_PORT}
+${PROXY_BLOCK}
 
-    log {
-        output file /var/log/anki/caddy.log
-        format console
-    }
+${LOG_BLOCK}
 }
+${ROUTER_SITE}
 EOF
     fi
 
     log_debug "Caddyfile created at $CADDYFILE"
+}
 
-    log_info "Starting Caddy on port $TLS_PORT..."
-    XDG_DATA_HOME=/config/caddy caddy run --config "$CADDYFILE" --adapter caddyfile &
+start_caddy() {
+    local port="$SYNC_PORT"
+    if [ "$TLS_ENABLED" = "true" ]; then
+        port="$TLS_PORT"
+        [ -z "$TLS_DOMAIN" ] || port=443
+    fi
+    log_info "Starting Caddy on port $port..."
+    XDG_DATA_HOME=/config/caddy caddy run --config /config/caddy/Caddyfile --adapter caddyfile &
     CADDY_PID=$!
 
-    sleep 2
-
-    if kill -0 "$CADDY_PID" 2>/dev/null; then
+    # certificates are obtained in the background, so listening means ready
+    if wait_for_port 127.0.0.1 "$port" 30 "$CADDY_PID"; then
         log_info "Caddy started successfully (PID: $CADDY_PID)"
     else
         log_error "Caddy failed to start"
@@ -370,8 +752,17 @@ EOF
     fi
 }
 
-if [ "$TLS_ENABLED" = "true" ]; then
-    setup_tls
+if [ "$TLS_ENABLED" = "true" ] || [ "$SYNC_SHARDS" -gt 1 ]; then
+    if [ "$TLS_ENABLED" = "true" ] && [ "$SYNC_SHARDS" -gt 1 ]; then
+        log_info "Setting up Caddy for TLS and as the shard router..."
+    elif [ "$TLS_ENABLED" = "true" ]; then
+        log_info "Setting up TLS with Caddy..."
+    else
+        log_info "Setting up Caddy as the shard router (TLS off)..."
+    fi
+    write_caddyfile
+    start_caddy
+    phase_done caddy
 fi
 
 # -----------------------------------------------------------------------------
@@ -398,6 +789,24 @@ EOF
     chmod 640 /etc/msmtprc
 fi
 
+# -----------------------------------------------------------------------------
+# Setup log rotation
+# -----------------------------------------------------------------------------
+if [ "$LOG_ROTATE_ENABLED" = "true" ]; then
+    log_info "Rotating logs at ${LOG_MAX_SIZE_MB}MB or ${LOG_MAX_AGE_HOURS}h (keep $LOG_KEEP_SEGMENTS segments, $LOG_RETENTION_DAYS days)"
+    LOG_DIR=/var/log/anki run_as_anki python3 /usr/local/bin/logstore.py daemon &
+    LOGROTATE_PID=$!
+fi
+
+# -----------------------------------------------------------------------------
+# Setup collection maintenance
+# -----------------------------------------------------------------------------
+if [ "$MAINT_ENABLED" = "true" ]; then
+    log_info "Maintaining idle collections every ${MAINT_INTERVAL}s (VACUUM above $MAINT_VACUUM_FREE_RATIO free)"
+    run_as_anki python3 /usr/local/bin/maintenance.py daemon >> /var/log/anki/maintenance.log 2>&1 &
+    MAINT_PID=$!
+fi
+
 # -----------------------------------------------------------------------------
 # Setup fail2ban
 # -----------------------------------------------------------------------------
@@ -405,11 +814,15 @@ if [ "$FAIL2BAN_ENABLED" = "true" ]; then
     if command -v fail2ban-server > /dev/null 2>&1; then
         log_info "Setting up fail2ban (max retries: $FAIL2BAN_MAX_RETRIES, ban time: ${FAIL2BAN_BAN_TIME}s)"
 
+        # the newest sealed segment stays plain, so failures logged just
+        # before a rotation still count towards findtime
+        run_as_anki touch /var/log/anki/auth.log.1
         cat > /etc/fail2ban/jail.d/anki.local << EOF
 [anki-auth]
 enabled = true
 filter = anki-auth
 logpath = /var/log/anki/auth.log
+          /var/log/anki/auth.log.1
 maxretry = ${FAIL2BAN_MAX_RETRIES}
 bantime = ${FAIL2BAN_BAN_TIME}
 findtime = ${FAIL2BAN_FIND_TIME}
@@ -433,14 +846,16 @@ fi
 if [ "$BACKUP_ENABLED" = "true" ]; then
     log_info "Setting up automated backups (schedule: $BACKUP_SCHEDULE)"
 
-    echo "$BACKUP_SCHEDULE /usr/local/bin/backup.sh >> /var/log/anki/backup.log 2>&1" > /etc/cron.d/anki-backup
+    # cron.d entries need a user field; backups run as anki and share
+    # backup.lock with jobs started from the dashboard
+    echo "$BACKUP_SCHEDULE anki /usr/local/bin/backup.sh >> /var/log/anki/backup.log 2>&1" > /etc/cron.d/anki-backup
     chmod 0644 /etc/cron.d/anki-backup
 
     cron
 
     log_info "Backup cron started"
 fi
-
+phase_done services
 
 # -----------------------------------------------------------------------------
 # Setup dashboard
@@ -455,14 +870,8 @@ if [ "$DASHBOARD_ENABLED" = "true" ]; then
     
     run_as_anki python3 /usr/local/bin/dashboard.py &
     DASHBOARD_PID=$!
-    
-    sleep 1
-    if kill -0 "$DASHBOARD_PID" 2>/dev/null; then
-        log_info "Dashboard started (PID: $DASHBOARD_PID)"
-    else
-        log_error "Dashboard failed to start"
-    fi
 fi
+
 # -----------------------------------------------------------------------------
 # Setup metrics endpoint
 # -----------------------------------------------------------------------------
@@ -472,6 +881,20 @@ if [ "$METRICS_ENABLED" = "true" ]; then
     METRICS_PID=$!
 fi
 
+# both start in parallel; wait until they answer
+if [ -n "$DASHBOARD_PID" ]; then
+    if wait_for_port 127.0.0.1 "$DASHBOARD_PORT" 30 "$DASHBOARD_PID"; then
+        log_info "Dashboard started (PID: $DASHBOARD_PID)"
+    else
+        log_error "Dashboard failed to start"
+    fi
+    phase_done dashboard
+fi
+if [ -n "$METRICS_PID" ]; then
+    wait_for_port 127.0.0.1 "$METRICS_PORT" 30 "$METRICS_PID" || log_error "Metrics server failed to start"
+    phase_done metrics
+fi
+
 # -----------------------------------------------------------------------------
 # Create version endpoint file
 # -----------------------------------------------------------------------------
@@ -498,6 +921,9 @@ echo "║           Anki Sync Server Enhanced                          ║"
 echo "╠══════════════════════════════════════════════════════════════╣"
 printf "║  %-60s ║\n" "Version:     $ANKI_VERSION"
 printf "║  %-60s ║\n" "Sync:        ${SYNC_HOST}:${SYNC_PORT} (HTTP)"
+if [ "$SYNC_SHARDS" -gt 1 ]; then
+    printf "║  %-60s ║\n" "Shards:      ${SYNC_SHARDS} (ports ${SYNC_SHARD_BASE_PORT}-$((SYNC_SHARD_BASE_PORT + SYNC_SHARDS - 1)))"
+fi
 if [ "$TLS_ENABLED" = "true" ]; then
     if [ -n "$TLS_DOMAIN" ]; then
         printf "║  %-60s ║\n" "TLS:         https://${TLS_DOMAIN} (Let's Encrypt)"
@@ -522,6 +948,19 @@ printf "║    - Hashed Pass: %-42s ║\n" "$([ "$PASSWORDS_HASHED" = "1" ] && e
 echo "╚══════════════════════════════════════════════════════════════╝"
 echo ""
 
+# -----------------------------------------------------------------------------
+# Record startup timings
+# -----------------------------------------------------------------------------
+phase_done banner
+STARTUP_MS=$(( (${EPOCHREALTIME/./} - STARTUP_T0) / 1000 ))
+PHASES_JSON=""
+for entry in "${PHASES[@]}"; do
+    PHASES_JSON+="${PHASES_JSON:+, }\"${entry% *}\": $(ms_json "${entry#* }")"
+done
+startup_merge "{\"ready_seconds\": $(ms_json "$SYNC_READY_MS"), \"total_seconds\": $(ms_json "$STARTUP_MS"), \"phases\": {$PHASES_JSON}}" \
+    || log_warn "Could not write startup.json"
+log_info "Startup took $(ms_json "$STARTUP_MS")s (sync server ready after $(ms_json "$SYNC_READY_MS")s)"
+
 # -----------------------------------------------------------------------------
 # Send startup notification
 # -----------------------------------------------------------------------------
@@ -533,76 +972,77 @@ cp /anki_version.txt /var/lib/anki/version.txt 2>/dev/null || true
 echo $(date +%s) > /var/lib/anki/start_time.txt 2>/dev/null || true
 
 # -----------------------------------------------------------------------------
-# Monitor sync server output for sync/auth events
+# Supervise: reload users on SIGHUP, honour the hold file
 # -----------------------------------------------------------------------------
-# Server request lines: request{uri="..." ip=...}: finished ... httpstatus=NNN
-monitor_sync_output() {
-    local logfile="$1"
-    tail -F "$logfile" 2>/dev/null | sed -u 's/\x1b\[[0-9;]*m//g' | while IFS= read -r line; do
-        case "$line" in
-            *'finished'*'httpstatus='*) ;;
-            *) continue ;;
-        esac
-        status=$(echo "$line" | grep -o 'httpstatus=[0-9]*' | head -1)
-        status="${status#httpstatus=}"
-        ip=$(echo "$line" | grep -o 'ip=[^ }]*' | head -1)
-        ip="${ip#ip=}"; ip="${ip%\"}"; ip="${ip#\"}"
-
-        # authenticated requests carry uid=; record their latency
-        case "$line" in
-            *'uid="'*)
-                if [ "$status" = "200" ]; then
-                    elap=$(echo "$line" | grep -o 'elap_ms=[0-9]*' | head -1)
-                    elap="${elap#elap_ms=}"
-                    uri=$(echo "$line" | grep -o 'uri="[^"]*"' | head -1)
-                    [ -n "$elap" ] && echo "[$(date '+%Y-%m-%d %H:%M:%S')] LATENCY ${uri} ms=${elap}" >> /var/log/anki/latency.log
-                fi
-                ;;
-        esac
-
-        case "$line" in
-            *'uri="/sync/hostKey"'*)
-                if [ "$status" = "200" ]; then
-                    echo "[$(date '+%Y-%m-%d %H:%M:%S')] AUTH_SUCCESS ip=\"${ip:-unknown}\"" >> /var/log/anki/auth.log
-                else
-                    echo "[$(date '+%Y-%m-%d %H:%M:%S')] AUTH_FAILED ip=\"${ip:-unknown}\"" >> /var/log/anki/auth.log
-                fi
-                ;;
-            *'uri="/sync/meta"'*)
-                if [ "$status" = "200" ]; then
-                    uid=$(echo "$line" | grep -o 'uid="[^"]*"' | head -1)
-                    client=$(echo "$line" | grep -o 'client="[^"]*"' | head -1)
-                    [ -n "$uid" ] && echo "[$(date '+%Y-%m-%d %H:%M:%S')] DEVICE ${uid} ${client}" >> /var/log/anki/devices.log
-                fi
-                ;;
-            *'uri="/sync/finish"'*)
-                if [ "$status" = "200" ]; then
-                    uid=$(echo "$line" | grep -o 'uid="[^"]*"' | head -1)
-                    uid="${uid#uid=\"}"; uid="${uid%\"}"
-                    echo "[$(date '+%Y-%m-%d %H:%M:%S')] SYNC_COMPLETE uid=\"${uid:-unknown}\"" >> /var/log/anki/sync.log
-                    count=$(cat /var/lib/anki/sync_count.txt 2>/dev/null || echo 0)
-                    echo $((count + 1)) > /var/lib/anki/sync_count.txt
-                fi
-                ;;
-        esac
+# Re-export the store and restart only the servers whose user list changed:
+# shard 0 handles every login, so any change restarts it.
+reload_users() {
+    local -a before_users
+    local before_all before_keys i
+    for i in "${!SHARD_USERS[@]}"; do before_users[$i]="${SHARD_USERS[$i]}"; done
+    before_keys="${SHARD_KEYS[*]}"
+    before_all=$(env | grep -E '^SYNC_USER[0-9]+=' | sort)
+
+    if [ "$(run_as_anki python3 /usr/local/bin/userstore.py count)" = "0" ]; then
+        log_warn "User store is empty, keeping the current users"
+        return
+    fi
+    load_users
+    route_users
+    if [ "$(env | grep -E '^SYNC_USER[0-9]+=' | sort)" = "$before_all" ]; then
+        log_info "Users reloaded, nothing changed"
+        return
+    fi
+    log_info "Users reloaded ($USER_COUNT users), restarting affected sync servers"
+    stop_sync_server 0
+    for i in $(seq 1 $((SYNC_SHARDS - 1))); do
+        if [ "${SHARD_USERS[$i]}" != "${before_users[$i]}" ]; then
+            stop_sync_server "$i"
+        fi
     done
+    start_sync_servers
+    if [ "$SYNC_SHARDS" -gt 1 ] && [ "${SHARD_KEYS[*]}" != "$before_keys" ] && [ -n "$CADDY_PID" ]; then
+        write_caddyfile
+        kill -TERM "$CADDY_PID" 2>/dev/null || true
+        wait "$CADDY_PID" 2>/dev/null || true
+        start_caddy
+    fi
 }
 
-# Start the sync server
-# -----------------------------------------------------------------------------
-log_info "Starting Anki sync server..."
-
-run_as_anki anki-sync-server >> /var/log/anki/server.log 2>&1 &
-SYNC_PID=$!
-
-# Start monitoring sync server output for sync/auth events
-monitor_sync_output /var/log/anki/server.log &
-MONITOR_PID=$!
-
-log_info "Sync server started with PID $SYNC_PID"
-
-# || keeps set -e from skipping the cleanup below
-wait "$SYNC_PID" && EXIT_CODE=0 || EXIT_CODE=$?
+while true; do
+    if hold_active; then
+        if [ "${#SYNC_PIDS[@]}" -gt 0 ]; then
+            log_info "Hold file present, stopping sync servers"
+            for i in "${!SYNC_PIDS[@]}"; do
+                stop_sync_server "$i"
+            done
+            : > /var/lib/anki/sync_servers.pid
+        fi
+        sleep 1 & wait $! || true
+        continue
+    fi
+    if [ "$RELOAD" = "true" ]; then
+        RELOAD=false
+        reload_users
+    fi
+    if [ "${#SYNC_PIDS[@]}" -lt "$SYNC_SHARDS" ]; then
+        start_sync_servers
+        log_info "Sync servers running (PID ${SYNC_PIDS[*]})"
+    fi
+    printf '%s\n' "${SYNC_PIDS[@]}" > /var/lib/anki/sync_servers.pid
+
+    # || keeps set -e from skipping the cleanup below; a signal interrupts the
+    # wait, anything else means a server exited and, with shards, the first
+    # one to go takes the others down with it
+    wait -n "${SYNC_PIDS[@]}" && EXIT_CODE=0 || EXIT_CODE=$?
+    if [ "$RELOAD" = "true" ] || hold_active; then
+        continue
+    fi
+    break
+done
+for pid in "${SYNC_PIDS[@]}"; do
+    kill -TERM "$pid" 2>/dev/null || true
+done
 
 # Stop the monitor
 kill "$MONITOR_PID" 2>/dev/null || true
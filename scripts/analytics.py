@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""Incremental study analytics for synced collections.
+
+Aggregates are kept in a sidecar database (analytics.db in STATE_DIR) next to
+per-collection watermarks, so an update only reads rows the server has
+written since the last one: new revlog entries become per-day review counts,
+time spent and answer-button tallies, changed cards refresh a small due table
+the backlog is computed from.
+
+Watermarks are update sequence numbers rather than ids or mod times: the
+server stamps every row it receives with its usn (indexed in all three
+tables), while review ids come from the reviewing device's clock and arrive
+out of order when a phone syncs days of offline study at once. Rows from a
+sync that is still running carry the collection's current usn and are left
+for the next pass. A full upload replaces the file and resets usns, which
+forces a rebuild, as does a periodic count check that catches drift.
+"""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+import shards
+
+STATE_DIR = os.environ.get('STATE_DIR', '/var/lib/anki')
+DB_PATH = os.path.join(STATE_DIR, 'analytics.db')
+VERIFY_HOURS = float(os.environ.get('ANALYTICS_VERIFY_HOURS', 24))
+MAX_COPY_BYTES = 512 * 1024 * 1024
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS collections (
+    user TEXT PRIMARY KEY, ino INTEGER, size INTEGER, mtime REAL,
+    scm INTEGER, crt INTEGER, decks INTEGER DEFAULT 0,
+    revlog_usn INTEGER, card_usn INTEGER, note_usn INTEGER, grave_usn INTEGER,
+    last_review INTEGER DEFAULT 0, verified REAL DEFAULT 0, updated REAL DEFAULT 0,
+    revlog_rows INTEGER DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS daily (
+    user TEXT, day TEXT, reviews INTEGER, time_ms INTEGER,
+    again INTEGER, hard INTEGER, good INTEGER, easy INTEGER,
+    PRIMARY KEY (user, day)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS card_due (
+    user TEXT, id INTEGER, queue INTEGER, due INTEGER,
+    PRIMARY KEY (user, id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS note_ids (
+    user TEXT, id INTEGER, PRIMARY KEY (user, id)
+) WITHOUT ROWID;
+'''
+
+EASES = ('again', 'hard', 'good', 'easy')
+START = -2  # below any usn a server-side row can carry
+
+
+def connect():
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn.executescript(SCHEMA)
+    if 'revlog_rows' not in {r[1] for r in conn.execute('PRAGMA table_info(collections)')}:
+        # a sidecar from before revlog_rows: rebuild everyone so the count is complete
+        try:
+            conn.execute('ALTER TABLE collections ADD COLUMN revlog_rows INTEGER DEFAULT 0')
+            conn.execute('UPDATE collections SET scm = NULL, verified = 0')
+            conn.commit()
+        except sqlite3.OperationalError:
+            conn.rollback()  # another process added it first
+    return conn
+
+
+@contextmanager
+def open_collection(db_path):
+    """Read-only handle; the server holds synced collections locked, so fall
+    back to a temp copy"""
+    tmp = None
+    try:
+        try:
+            conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, timeout=1)
+            conn.execute('SELECT usn FROM col').fetchone()
+        except sqlite3.OperationalError:
+            if os.path.getsize(db_path) >= MAX_COPY_BYTES:
+                raise
+            fd, tmp = tempfile.mkstemp(suffix='.anki2')
+            os.close(fd)
+            shutil.copyfile(db_path, tmp)
+            conn = sqlite3.connect(f'file:{tmp}?mode=ro', uri=True)
+        # anki schemas use a custom collation vanilla sqlite doesn't have
+        conn.create_collation('unicase', lambda a, b: (a > b) - (a < b))
+        try:
+            yield conn
+        finally:
+            conn.close()
+    finally:
+        if tmp:
+            os.unlink(tmp)
+
+
+def _reset(db, user):
+    for table in ('daily', 'card_due', 'note_ids'):
+        db.execute(f'DELETE FROM {table} WHERE user = ?', (user,))
+    db.execute('UPDATE collections SET revlog_usn = ?, card_usn = ?, note_usn = ?, grave_usn = ?, '
+               'last_review = 0, verified = 0, revlog_rows = 0 WHERE user = ?', (START, START, START, START, user))
+
+
+def _count_decks(col):
+    try:
+        return col.execute('SELECT COUNT(*) FROM decks').fetchone()[0]
+    except sqlite3.Error:
+        pass
+    try:
+        # schema-11 collections keep decks as JSON in the col table
+        import json
+        return len(json.loads(col.execute('SELECT decks FROM col').fetchone()[0]))
+    except Exception:
+        return 0
+
+
+def _apply(db, col, user, state, now, rebuilt=False):
+    crt, scm, col_usn = col.execute('SELECT crt, scm, usn FROM col').fetchone()
+    if state['scm'] != scm or col_usn < state['revlog_usn']:
+        _reset(db, user)
+        state.update(revlog_usn=START, card_usn=START, note_usn=START, grave_usn=START,
+                     last_review=0, verified=0, revlog_rows=0)
+
+    days = {}
+    last_review = state['last_review']
+    top = state['revlog_usn']
+    for rid, ease, ms, usn in col.execute(
+            'SELECT id, ease, time, usn FROM revlog WHERE usn > ? AND usn < ?', (state['revlog_usn'], col_usn)):
+        top = max(top, usn)
+        last_review = max(last_review, rid)
+        # every entry, as anki_sync_reviews_total has always counted them
+        state['revlog_rows'] += 1
+        if not 1 <= ease <= 4:
+            continue  # manual reschedules, not answers
+        day = datetime.fromtimestamp(rid / 1000).strftime('%Y-%m-%d')
+        agg = days.setdefault(day, [0, 0, 0, 0, 0, 0])
+        agg[0] += 1
+        agg[1] += max(0, ms)
+        agg[1 + ease] += 1
+    for day, (n, ms, again, hard, good, easy) in days.items():
+        db.execute('INSERT INTO daily VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (user, day) DO UPDATE SET '
+                   'reviews = reviews + excluded.reviews, time_ms = time_ms + excluded.time_ms, '
+                   'again = again + excluded.again, hard = hard + excluded.hard, '
+                   'good = good + excluded.good, easy = easy + excluded.easy',
+                   (user, day, n, ms, again, hard, good, easy))
+    state['revlog_usn'] = top
+    state['last_review'] = last_review
+
+    top = state['card_usn']
+    rows = []
+    for cid, queue, due, odue, odid, usn in col.execute(
+            'SELECT id, queue, due, odue, odid, usn FROM cards WHERE usn > ? AND usn < ?',
+            (state['card_usn'], col_usn)):
+        top = max(top, usn)
+        # cards in filtered decks keep their real due date in odue
+        rows.append((user, cid, queue, odue if odid and odue else due))
+    db.executemany('INSERT OR REPLACE INTO card_due VALUES (?, ?, ?, ?)', rows)
+    state['card_usn'] = top
+
+    top = state['note_usn']
+    rows = []
+    for nid, usn in col.execute('SELECT id, usn FROM notes WHERE usn > ? AND usn < ?',
+                                (state['note_usn'], col_usn)):
+        top = max(top, usn)
+        rows.append((user, nid))
+    db.executemany('INSERT OR IGNORE INTO note_ids VALUES (?, ?)', rows)
+    state['note_usn'] = top
+
+    top = state['grave_usn']
+    for oid, kind, usn in col.execute('SELECT oid, type, usn FROM graves WHERE usn > ? AND usn < ?',
+                                      (state['grave_usn'], col_usn)):
+        top = max(top, usn)
+        if kind == 0:
+            db.execute('DELETE FROM card_due WHERE user = ? AND id = ?', (user, oid))
+        elif kind == 1:
+            db.execute('DELETE FROM note_ids WHERE user = ? AND id = ?', (user, oid))
+    state['grave_usn'] = top
+
+    if now - state['verified'] >= VERIFY_HOURS * 3600:
+        cards = col.execute('SELECT COUNT(*) FROM cards').fetchone()[0]
+        notes = col.execute('SELECT COUNT(*) FROM notes').fetchone()[0]
+        revlog = col.execute('SELECT COUNT(*) FROM revlog WHERE usn < ?', (col_usn,)).fetchone()[0]
+        have_cards = db.execute('SELECT COUNT(*) FROM card_due WHERE user = ?', (user,)).fetchone()[0]
+        have_notes = db.execute('SELECT COUNT(*) FROM note_ids WHERE user = ?', (user,)).fetchone()[0]
+        if (cards, notes, revlog) != (have_cards, have_notes, state['revlog_rows']) and not rebuilt:
+            print(f'[analytics] {user}: drifted ({have_cards}/{cards} cards, {have_notes}/{notes} notes, '
+                  f'{state["revlog_rows"]}/{revlog} revlog entries), rebuilding', file=sys.stderr)
+            state['scm'] = None
+            return _apply(db, col, user, state, now, rebuilt=True)
+        state['verified'] = now
+
+    state.update(crt=crt, scm=scm, decks=_count_decks(col))
+
+
+def update(user, db_path, db=None):
+    """Fold anything new in one user's collection into the sidecar; a stat()
+    when nothing changed"""
+    try:
+        st = os.stat(db_path)
+    except OSError:
+        return False
+    own = db is None
+    db = db or connect()
+    try:
+        row = db.execute('SELECT ino, size, mtime, scm, revlog_usn, card_usn, note_usn, grave_usn, '
+                         'last_review, verified, revlog_rows FROM collections WHERE user = ?', (user,)).fetchone()
+        now = time.time()
+        if row and row[:3] == (st.st_ino, st.st_size, st.st_mtime) and now - row[9] < VERIFY_HOURS * 3600:
+            return False
+        keys = ('scm', 'revlog_usn', 'card_usn', 'note_usn', 'grave_usn', 'last_review', 'verified', 'revlog_rows')
+        state = dict(zip(keys, row[3:])) if row else dict(zip(keys, (None, START, START, START, START, 0, 0, 0)))
+        if row and row[0] != st.st_ino:
+            state['scm'] = None  # replaced by a full upload
+        with open_collection(db_path) as col:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                # another process may have got here first
+                again = db.execute('SELECT ino, size, mtime FROM collections WHERE user = ?', (user,)).fetchone()
+                if again != (row[:3] if row else None):
+                    db.rollback()
+                    return False
+                if not row:
+                    db.execute('INSERT INTO collections (user) VALUES (?)', (user,))
+                _apply(db, col, user, state, now)
+                db.execute('UPDATE collections SET ino = ?, size = ?, mtime = ?, scm = ?, crt = ?, decks = ?, '
+                           'revlog_usn = ?, card_usn = ?, note_usn = ?, grave_usn = ?, last_review = ?, '
+                           'verified = ?, updated = ?, revlog_rows = ? WHERE user = ?',
+                           (st.st_ino, st.st_size, st.st_mtime, state['scm'], state['crt'], state['decks'],
+                            state['revlog_usn'], state['card_usn'], state['note_usn'], state['grave_usn'],
+                            state['last_review'], state['verified'], now, state['revlog_rows'], user))
+                db.commit()
+            except BaseException:
+                db.rollback()
+                raise
+        return True
+    except (OSError, sqlite3.Error) as e:
+        print(f'[analytics] {user}: {e}', file=sys.stderr)
+        return False
+    finally:
+        if own:
+            db.close()
+
+
+def update_all(users):
+    db = connect()
+    try:
+        for user in users:
+            update(user, os.path.join(shards.user_dir(user), 'collection.anki2'), db)
+    finally:
+        db.close()
+
+
+def summary(users, now=None):
+    """Per-user totals for the exporter"""
+    now = now or time.time()
+    today = date.fromtimestamp(now).isoformat()
+    db = connect()
+    try:
+        result = {}
+        for user in users:
+            row = db.execute('SELECT crt, decks, last_review, revlog_rows FROM collections WHERE user = ?',
+                             (user,)).fetchone()
+            if not row or row[0] is None:
+                continue
+            crt, decks, last_review, revlog_rows = row
+            totals = db.execute('SELECT COALESCE(SUM(reviews), 0), COALESCE(SUM(time_ms), 0), '
+                                'COALESCE(SUM(again), 0), COALESCE(SUM(hard), 0), COALESCE(SUM(good), 0), '
+                                'COALESCE(SUM(easy), 0) FROM daily WHERE user = ?', (user,)).fetchone()
+            day = db.execute('SELECT reviews, time_ms FROM daily WHERE user = ? AND day = ?',
+                             (user, today)).fetchone() or (0, 0)
+            result[user] = {
+                'cards': db.execute('SELECT COUNT(*) FROM card_due WHERE user = ?', (user,)).fetchone()[0],
+                'notes': db.execute('SELECT COUNT(*) FROM note_ids WHERE user = ?', (user,)).fetchone()[0],
+                'decks': decks,
+                'reviews': revlog_rows,
+                'review_seconds': totals[1] / 1000,
+                'answers': dict(zip(EASES, totals[2:])),
+                'reviews_today': day[0],
+                'review_seconds_today': day[1] / 1000,
+                'due': due_count(db, user, crt, now),
+                'last_review': last_review // 1000,
+            }
+        return result
+    finally:
+        db.close()
+
+
+def due_count(db, user, crt, now):
+    # review/day-learning due is in days since collection creation,
+    # intraday learning due is a unix timestamp
+    today = int((now - crt) // 86400)
+    return db.execute('SELECT COUNT(*) FROM card_due WHERE user = ? AND '
+                      '((queue IN (2, 3) AND due <= ?) OR (queue = 1 AND due <= ?))',
+                      (user, today, int(now))).fetchone()[0]
+
+
+def history(users, days=30, now=None):
+    """Per-user daily series for the dashboard chart"""
+    now = now or time.time()
+    end = date.fromtimestamp(now)
+    labels = [(end - timedelta(days=i)).isoformat() for i in range(days - 1, -1, -1)]
+    db = connect()
+    try:
+        series = {}
+        for user in users:
+            rows = dict((d, (n, ms, a, h, g, e)) for d, n, ms, a, h, g, e in db.execute(
+                'SELECT day, reviews, time_ms, again, hard, good, easy FROM daily WHERE user = ? AND day >= ?',
+                (user, labels[0])))
+            crt = db.execute('SELECT crt FROM collections WHERE user = ?', (user,)).fetchone()
+            if not crt or crt[0] is None:
+                continue
+            empty = (0, 0, 0, 0, 0, 0)
+            series[user] = {
+                'reviews': [rows.get(d, empty)[0] for d in labels],
+                'minutes': [round(rows.get(d, empty)[1] / 60000, 1) for d in labels],
+                'answers': dict(zip(EASES, (sum(r[i] for r in rows.values()) for i in range(2, 6)))),
+                'due': due_count(db, user, crt[0], now),
+            }
+        return {'labels': labels, 'users': series}
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    import userstore
+    update_all(sys.argv[1:] or userstore.names())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Sliding-window heavy hitters for failed logins.
+
+Counts live in count-min sketches, one per time bucket, so memory is fixed by
+the sketch size and the longest window no matter how many distinct IPs a
+credential-stuffing run brings. A small candidate set (pruned with a heap)
+remembers which IPs to report.
+"""
+
+import hashlib
+import heapq
+from array import array
+from collections import deque
+
+WINDOWS = {'1m': 60, '10m': 600, '1h': 3600}
+
+
+class SlidingTopK:
+    def __init__(self, windows=None, k=10, width=1024, depth=4, bucket=15):
+        self.windows = dict(windows or WINDOWS)
+        self.k = k
+        self.width = width
+        self.depth = depth
+        self.bucket = bucket
+        self.horizon = max(self.windows.values())
+        self.buckets = deque()  # (start, rows), oldest first
+        # running sums per window, so an estimate costs `depth` lookups
+        self.totals = {w: self._rows() for w in self.windows}
+        self.members = {w: deque() for w in self.windows}
+        self.candidates = {}  # ip -> last seen
+        self.cap = k * 4
+        self.total = 0
+
+    def _rows(self):
+        return [array('I', bytes(4 * self.width)) for _ in range(self.depth)]
+
+    def _slots(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=4 * self.depth).digest()
+        return [int.from_bytes(digest[i * 4:i * 4 + 4], 'little') % self.width
+                for i in range(self.depth)]
+
+    def _expire(self, now):
+        for w, span in self.windows.items():
+            members = self.members[w]
+            total = self.totals[w]
+            while members and members[0][0] + self.bucket <= now - span:
+                _, rows = members.popleft()
+                for t, r in zip(total, rows):
+                    for i, v in enumerate(r):
+                        if v:
+                            t[i] -= v
+        while self.buckets and self.buckets[0][0] + self.bucket <= now - self.horizon:
+            self.buckets.popleft()
+
+    def add(self, key, now):
+        self._expire(now)
+        start = now - now % self.bucket
+        if not self.buckets or self.buckets[-1][0] != start:
+            entry = (start, self._rows())
+            self.buckets.append(entry)
+            for members in self.members.values():
+                members.append(entry)
+        rows = self.buckets[-1][1]
+        slots = self._slots(key)
+        for d, s in enumerate(slots):
+            rows[d][s] += 1
+            for total in self.totals.values():
+                total[d][s] += 1
+        self.total += 1
+
+        if key in self.candidates or len(self.candidates) < self.cap:
+            self.candidates[key] = now
+            return
+        # replace the weakest candidate if the newcomer already beats it
+        longest = max(self.windows, key=self.windows.get)
+        weakest = min(self.candidates, key=lambda c: self._estimate(c, longest))
+        if self._estimate(key, longest) > self._estimate(weakest, longest):
+            del self.candidates[weakest]
+            self.candidates[key] = now
+
+    def _estimate(self, key, window):
+        total = self.totals[window]
+        return min(total[d][s] for d, s in enumerate(self._slots(key)))
+
+    def top(self, window, now):
+        self._expire(now)
+        scored = ((self._estimate(c, window), c) for c in self.candidates)
+        return [(c, n) for n, c in heapq.nlargest(self.k, scored) if n > 0]
+
+    def snapshot(self, now):
+        self._expire(now)
+        longest = max(self.windows, key=self.windows.get)
+        for c in [c for c in self.candidates if self._estimate(c, longest) == 0]:
+            del self.candidates[c]
+        return {w: [{'ip': c, 'failed': n} for c, n in self.top(w, now)] for w in self.windows}
+
+    def memory_bytes(self):
+        per_bucket = self.depth * self.width * 4
+        return per_bucket * (len(self.buckets) + len(self.totals))
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""Join Caddy's JSON access log to the sync server's own request lines.
+
+Caddy sees bytes on the wire and the time spent at the TLS edge; the upstream
+line knows the user and how long the server itself took. Entries are paired
+by endpoint, status and completion time. Caddy keeps only an 8-character
+prefix of the client's host key, which is remembered per user so requests
+that never pair up can still be attributed.
+
+Unpaired entries are given up on by log time, not wall time, so catching up
+on a backlog pairs as well as following live: an entry is expired once the
+other log has moved past it (or, when the other log has nothing more to
+read, once its own log has). Each side is also capped at
+MAX_PENDING entries, which bounds both memory and the scan for a partner.
+"""
+
+import json
+import re
+from collections import deque
+
+OVERHEAD_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+JOIN_WINDOW = 5.0
+MAX_KEYS = 10000
+MAX_PENDING = 2000
+
+_KEY = re.compile(r'"k"\s*:\s*"([0-9a-f]{8})')
+
+
+def parse_access(line):
+    """Fields of one Caddy JSON access-log entry, or None for other log lines"""
+    try:
+        entry = json.loads(line)
+    except ValueError:
+        return None
+    req = entry.get('request') if isinstance(entry, dict) else None
+    if not isinstance(req, dict) or 'status' not in entry:
+        return None
+    headers = req.get('headers') or {}
+    sync = (headers.get('Anki-Sync') or [''])[0] or ''
+    if re.fullmatch(r'[0-9a-f]{8}', sync):
+        key = sync
+    else:
+        # the Caddyfile filter was customised away; pick the key out ourselves
+        m = _KEY.search(sync)
+        key = m.group(1) if m else ''
+    try:
+        return {
+            'ts': float(entry.get('ts', 0)),
+            'uri': str(req.get('uri', '')).split('?', 1)[0],
+            'status': str(entry.get('status', '')),
+            'duration_ms': float(entry.get('duration', 0)) * 1000,
+            'bytes_in': int(entry.get('bytes_read', 0)),
+            'bytes_out': int(entry.get('size', 0)),
+            'key': key,
+        }
+    except (TypeError, ValueError):
+        return None
+
+
+class ProxyJoin:
+    def __init__(self, saved=None):
+        saved = saved or {}
+        self.bytes = {(e['uri'], e['user']): [e['in'], e['out']] for e in saved.get('bytes', [])}
+        overhead = saved.get('overhead', {})
+        self.overhead = overhead.get('buckets') or [0] * (len(OVERHEAD_BUCKETS) + 1)
+        self.overhead_sum = overhead.get('sum', 0.0)
+        self.keys = dict(saved.get('keys', {}))  # host key prefix -> user
+        self.joined = saved.get('joined', 0)
+        self.edge_only = saved.get('edge_only', 0)
+        self.upstream = deque()  # (ts, uri, status, uid, elap_ms)
+        self.edge = deque()
+        self.upstream_ts = self.edge_ts = 0.0  # newest log time seen on each side
+
+    @staticmethod
+    def _take(queue, match):
+        for i, item in enumerate(queue):
+            if match(item):
+                del queue[i]
+                return item
+        return None
+
+    def add_upstream(self, ts, uri, status, uid, elap_ms):
+        self.upstream_ts = max(self.upstream_ts, ts)
+        entry = self._take(self.edge, lambda e: e['uri'] == uri and e['status'] == status
+                           and abs(e['ts'] - ts) <= JOIN_WINDOW)
+        if entry:
+            self._record(entry, uid, elap_ms)
+        else:
+            self.upstream.append((ts, uri, status, uid, elap_ms))
+            if len(self.upstream) > MAX_PENDING:
+                self.upstream.popleft()
+
+    def add_edge(self, entry):
+        self.edge_ts = max(self.edge_ts, entry['ts'])
+        up = self._take(self.upstream, lambda u: u[1] == entry['uri'] and u[2] == entry['status']
+                        and abs(u[0] - entry['ts']) <= JOIN_WINDOW)
+        if up:
+            self._record(entry, up[3], up[4])
+        else:
+            self.edge.append(entry)
+            if len(self.edge) > MAX_PENDING:
+                self._record(self.edge.popleft(), None, None)
+
+    def expire(self, now, upstream_idle=False, edge_idle=False):
+        """Give up on unpaired entries the other log has moved past (or, when
+        the other log is idle, that their own log has; when both are caught
+        up, log time is wall time); returns how many edge entries were
+        recorded alone"""
+        live = now if upstream_idle and edge_idle else 0
+        upstream_horizon = max(self.edge_ts, self.upstream_ts if edge_idle else 0, live) - 2 * JOIN_WINDOW
+        edge_horizon = max(self.upstream_ts, self.edge_ts if upstream_idle else 0, live) - 2 * JOIN_WINDOW
+        # upstream lines without a partner came in on plain HTTP
+        while self.upstream and self.upstream[0][0] < upstream_horizon:
+            self.upstream.popleft()
+        expired = 0
+        while self.edge and self.edge[0]['ts'] < edge_horizon:
+            self._record(self.edge.popleft(), None, None)
+            expired += 1
+        return expired
+
+    def _record(self, entry, uid, elap_ms):
+        key = entry['key']
+        if uid and key:
+            self.keys.pop(key, None)
+            self.keys[key] = uid
+            while len(self.keys) > MAX_KEYS:
+                del self.keys[next(iter(self.keys))]
+        user = uid or self.keys.get(key) or 'unknown'
+        counts = self.bytes.setdefault((entry['uri'], user), [0, 0])
+        counts[0] += entry['bytes_in']
+        counts[1] += entry['bytes_out']
+        if elap_ms is None:
+            self.edge_only += 1
+            return
+        self.joined += 1
+        overhead = max(0.0, entry['duration_ms'] - elap_ms)
+        self.overhead_sum += overhead
+        for i, le in enumerate(OVERHEAD_BUCKETS):
+            if overhead <= le:
+                self.overhead[i] += 1
+                break
+        else:
+            self.overhead[-1] += 1
+
+    def total_bytes(self):
+        return sum(i + o for i, o in self.bytes.values())
+
+    def snapshot(self, now):
+        return {
+            'updated': int(now),
+            'bytes': [{'uri': u, 'user': usr, 'in': i, 'out': o}
+                      for (u, usr), (i, o) in sorted(self.bytes.items())],
+            'overhead': {'bounds': list(OVERHEAD_BUCKETS), 'buckets': self.overhead,
+                         'sum': round(self.overhead_sum, 3), 'count': self.joined},
+            'joined': self.joined,
+            'edge_only': self.edge_only,
+            'keys': self.keys,
+        }
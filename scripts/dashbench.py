@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""Time a dashboard page load the way a browser would fetch it.
+
+Fetches the page and every /static asset it references, then reports bytes
+on the wire and wall time for a cold load (empty cache) and a warm one (assets
+marked immutable are not requested again).
+
+  dashbench.py [URL] [--runs N] [--auth user:pass] [--encoding br,gzip|identity]
+"""
+
+import argparse
+import base64
+import os
+import re
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import Request, urlopen
+
+
+def fetch(url, headers):
+    start = time.perf_counter()
+    with urlopen(Request(url, headers=headers), timeout=30) as r:
+        body = r.read()
+        return body, dict(r.headers), time.perf_counter() - start
+
+
+def load(base, headers, cached=()):
+    """One page load; assets in `cached` are skipped. Returns (seconds, bytes, assets)"""
+    start = time.perf_counter()
+    page, _, _ = fetch(base + '/', headers)
+    refs = re.findall(rb'(?:src|href)="(/static/[^"]+)"', page)
+    wanted = [r.decode() for r in refs if r.decode() not in cached]
+    # browsers fetch a page's assets in parallel
+    with ThreadPoolExecutor(max(1, len(wanted))) as pool:
+        results = list(pool.map(lambda ref: (ref, fetch(base + ref, headers)), wanted))
+    total = len(page) + sum(len(body) for _, (body, _, _) in results)
+    assets = {ref: {'bytes': len(body), 'encoding': h.get('Content-Encoding', 'identity'),
+                    'cache': h.get('Cache-Control', ''), 'ms': round(t * 1000, 1)}
+              for ref, (body, h, t) in results}
+    return time.perf_counter() - start, total, assets
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('url', nargs='?', default=f'http://localhost:{os.environ.get("DASHBOARD_PORT", 8081)}')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--auth', default=os.environ.get('DASHBOARD_AUTH', ''))
+    parser.add_argument('--encoding', default='br, gzip')
+    args = parser.parse_args()
+
+    base = args.url.rstrip('/')
+    headers = {'Accept-Encoding': args.encoding}
+    if args.auth:
+        headers['Authorization'] = 'Basic ' + base64.b64encode(args.auth.encode()).decode()
+
+    _, _, assets = load(base, headers)  # warm up the server
+    immutable = {ref for ref, a in assets.items() if 'immutable' in a['cache']}
+    for ref, a in assets.items():
+        print(f'{ref:40} {a["bytes"]:>9} B  {a["encoding"]:8} {a["cache"] or "-"}')
+
+    for name, cached in (('cold', ()), ('warm', immutable)):
+        times, sizes = [], []
+        for _ in range(args.runs):
+            seconds, size, _ = load(base, headers, cached)
+            times.append(seconds * 1000)
+            sizes.append(size)
+        print(f'{name}: median {statistics.median(times):.1f} ms, max {max(times):.1f} ms, '
+              f'{sizes[-1]} bytes over {args.runs} runs')
+
+
+if __name__ == '__main__':
+    main()
@@ -5,9 +5,11 @@ Features: Dark/light mode, storage breakdown, collection details, container info
 """
 
 import hmac
+import json
 import os
 import re
 import subprocess
+import threading
 import time
 import sqlite3
 from datetime import datetime, timedelta
@@ -16,6 +18,14 @@ from functools import wraps
 
 from flask import Flask, render_template_string, jsonify, request, Response, send_from_directory
 
+import analytics
+import mediarefs
+import mediastats
+import shards
+import statcache
+import userstore
+from logstore import tail_lines
+
 app = Flask(__name__)
 
 STATIC_DIR = os.environ.get('DASHBOARD_STATIC_DIR', '/usr/local/share/anki-dashboard')
@@ -51,23 +61,11 @@ def requires_auth(f):
         return f(*args, **kwargs)
     return decorated
 
-_dir_size_cache = {}
+CACHE = statcache.StatCache('dashboard')
 
 def get_dir_size(path, ttl=60):
     # the 10s poll shouldn't rescan all media every time
-    now = time.time()
-    cached = _dir_size_cache.get(path)
-    if cached and now - cached[0] < ttl:
-        return cached[1]
-    total = 0
-    try:
-        for entry in Path(path).rglob('*'):
-            if entry.is_file():
-                total += entry.stat().st_size
-    except Exception:
-        pass
-    _dir_size_cache[path] = (now, total)
-    return total
+    return statcache.dir_size(CACHE, path, ttl)
 
 def format_bytes(size):
     for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
@@ -94,61 +92,44 @@ def read_file_safe(path, default=''):
         return default
 
 def read_log_lines(path, lines=100):
+    # spans the live file and as many rotated segments as needed
     try:
-        result = subprocess.run(['tail', '-n', str(lines), path],
-                                capture_output=True, text=True, timeout=5)
-        return result.stdout.strip().split('\n') if result.stdout else []
+        return tail_lines(path, lines)
     except Exception:
         return []
 
 def get_users():
-    users_file = os.path.join(STATE_DIR, 'users.txt')
-    if os.path.exists(users_file):
-        with open(users_file, 'r') as f:
-            content = f.read().strip()
-        if not content:
-            return []
-        users = []
-        for line in content.split('\n'):
-            # Handle both one-per-line and comma-separated formats
-            for user in line.split(','):
-                user = user.strip()
-                if user:
-                    users.append(user)
-        return users
-    return []
-
-_card_cache = {}
+    # cached in userstore until the store changes
+    return userstore.names()
+
+def count_cards(db_path):
+    """The server holds synced collections locked, so fall back to querying
+    a temp copy"""
+    try:
+        conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, timeout=1)
+        cards = conn.execute("SELECT COUNT(*) FROM cards").fetchone()[0]
+        conn.close()
+        return cards
+    except sqlite3.OperationalError:
+        if os.path.getsize(db_path) >= 512 * 1024 * 1024:
+            return None
+    import shutil
+    import tempfile
+    fd, tmp = tempfile.mkstemp(suffix='.anki2')
+    os.close(fd)
+    try:
+        shutil.copyfile(db_path, tmp)
+        conn = sqlite3.connect(f'file:{tmp}?mode=ro', uri=True)
+        cards = conn.execute("SELECT COUNT(*) FROM cards").fetchone()[0]
+        conn.close()
+        return cards
+    finally:
+        os.unlink(tmp)
 
 def get_collection_info(db_path):
-    """Card count; the server holds synced collections locked, so fall back
-    to querying a temp copy and cache by mtime"""
+    """Card count, cached until the file changes"""
     try:
-        mtime = os.path.getmtime(db_path)
-        cached = _card_cache.get(db_path)
-        if cached and cached[0] == mtime:
-            return {'cards': cached[1]}
-        cards = None
-        try:
-            conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, timeout=1)
-            cards = conn.execute("SELECT COUNT(*) FROM cards").fetchone()[0]
-            conn.close()
-        except sqlite3.OperationalError:
-            if os.path.getsize(db_path) < 512 * 1024 * 1024:
-                import shutil
-                import tempfile
-                fd, tmp = tempfile.mkstemp(suffix='.anki2')
-                os.close(fd)
-                try:
-                    shutil.copyfile(db_path, tmp)
-                    conn = sqlite3.connect(f'file:{tmp}?mode=ro', uri=True)
-                    cards = conn.execute("SELECT COUNT(*) FROM cards").fetchone()[0]
-                    conn.close()
-                finally:
-                    os.unlink(tmp)
-        if cards is not None:
-            _card_cache[db_path] = (mtime, cards)
-        return {'cards': cards}
+        return {'cards': CACHE.get(db_path, count_cards)}
     except Exception:
         return {'cards': None}
 
@@ -181,84 +162,140 @@ def get_latency_stats():
     return {'count': len(vals), 'avg': round(sum(vals) / len(vals), 1),
             'p95': vals[min(len(vals) - 1, int(len(vals) * 0.95))], 'max': vals[-1]}
 
-def get_user_details():
-    """Get detailed user statistics including collection info"""
+def get_user_detail(user, devices=None):
+    """Collections, media and devices for one user"""
+    user_dir = shards.user_dir(user)
+    if not os.path.isdir(user_dir):
+        return None
+    total_size = get_dir_size(user_dir)
+    collections = []
+
+    for db_file in Path(user_dir).glob('*.anki2'):
+        size = db_file.stat().st_size
+        info = get_collection_info(str(db_file))
+        try:
+            mtime = datetime.fromtimestamp(db_file.stat().st_mtime).strftime('%Y-%m-%d %H:%M')
+        except Exception:
+            mtime = 'Unknown'
+        collections.append({
+            'name': db_file.name,
+            'size': size,
+            'size_formatted': format_bytes(size),
+            'cards': info['cards'],
+            'modified': mtime,
+            'type': 'database'
+        })
+
+    media_dir = os.path.join(user_dir, 'collection.media')
+    if os.path.exists(media_dir):
+        mediastats.update(user)
+        media = mediastats.summary([user]).get(user, {})
+        try:
+            mtime = datetime.fromtimestamp(os.path.getmtime(media_dir)).strftime('%Y-%m-%d %H:%M')
+        except Exception:
+            mtime = 'Unknown'
+        collections.append({
+            'name': 'collection.media',
+            'size': media.get('bytes', 0),
+            'size_formatted': format_bytes(media.get('bytes', 0)),
+            'files': media.get('files', 0),
+            'added_7d': media.get('added', 0),
+            'deleted_7d': media.get('deleted', 0),
+            'modified': mtime,
+            'type': 'media'
+        })
+    # from the last orphan check (maintenance.py); never scanned here
+    orphans = mediarefs.summary([user]).get(user)
+    if orphans:
+        orphans = {**orphans, 'orphaned_bytes_formatted': format_bytes(orphans['orphaned_bytes']),
+                   'untracked_bytes_formatted': format_bytes(orphans['untracked_bytes']),
+                   'quarantined_bytes_formatted': format_bytes(orphans['quarantined_bytes']),
+                   'largest': [{'name': n, 'size_formatted': format_bytes(sz), 'tracked': bool(t)}
+                               for n, sz, t in mediarefs.largest(user, 20)]}
+
+    try:
+        last_sync = datetime.fromtimestamp(os.path.getmtime(user_dir)).strftime('%Y-%m-%d %H:%M')
+    except Exception:
+        last_sync = 'Unknown'
+
+    if devices is None:
+        devices = get_devices()
+    return {
+        'username': user,
+        'total_size': total_size,
+        'total_size_formatted': format_bytes(total_size),
+        'last_sync': last_sync,
+        'collections': collections,
+        'orphans': orphans,
+        'devices': devices.get(user, [])
+    }
+
+# Per-user summary rows for the paginated Users tab. Rebuilt in the background
+# once stale, so a request never waits for 1,500 directory walks; sizes come
+# from the stat cache and card counts from the analytics sidecar, never from
+# opening collections.
+USER_INDEX_TTL = 60
+_user_index = {'built': 0, 'rows': []}
+_user_index_lock = threading.Lock()
+
+def _build_user_index():
     users = get_users()
-    all_devices = get_devices()
-    details = []
+    cards = {u: s['cards'] for u, s in analytics.summary(users).items()}
+    orphaned = {u: o['orphaned_bytes'] for u, o in mediarefs.summary(users).items()}
+    rows = []
     for user in users:
-        user_dir = os.path.join(DATA_DIR, user)
-        if not os.path.exists(user_dir):
+        user_dir = shards.user_dir(user)
+        try:
+            last_sync = int(os.path.getmtime(user_dir))
+        except OSError:
             continue
-        
-        total_size = get_dir_size(user_dir)
-        collections = []
-        
-        for db_file in Path(user_dir).glob('**/*.anki2'):
-            size = db_file.stat().st_size
-            info = get_collection_info(str(db_file))
-            try:
-                mtime = datetime.fromtimestamp(db_file.stat().st_mtime).strftime('%Y-%m-%d %H:%M')
-            except Exception:
-                mtime = 'Unknown'
-            collections.append({
-                'name': db_file.name,
-                'size': size,
-                'size_formatted': format_bytes(size),
-                'cards': info['cards'],
-                'modified': mtime,
-                'type': 'database'
-            })
-        
-        media_dir = os.path.join(user_dir, 'collection.media')
-        if os.path.exists(media_dir):
-            media_size = get_dir_size(media_dir)
-            try:
-                media_files = len([f for f in os.listdir(media_dir) if os.path.isfile(os.path.join(media_dir, f))])
-            except Exception:
-                media_files = 0
-            try:
-                mtime = datetime.fromtimestamp(os.path.getmtime(media_dir)).strftime('%Y-%m-%d %H:%M')
-            except Exception:
-                mtime = 'Unknown'
-            collections.append({
-                'name': 'collection.media',
-                'size': media_size,
-                'size_formatted': format_bytes(media_size),
-                'files': media_files,
-                'modified': mtime,
-                'type': 'media'
-            })
-        
+        rows.append({'username': user, 'total_size': get_dir_size(user_dir),
+                     'last_sync': last_sync, 'cards': cards.get(user), 'orphaned_bytes': orphaned.get(user, 0)})
+    index = {'built': int(time.time()), 'rows': rows}
+    path = os.path.join(STATE_DIR, 'users_index.json')
+    try:
+        with open(path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(path + '.tmp', path)
+    except OSError:
+        pass
+    return index
+
+def _refresh_user_index():
+    try:
+        index = _build_user_index()
+        _user_index.update(index)
+    finally:
+        _user_index_lock.release()
+
+def get_user_index():
+    if not _user_index['built']:
+        # warm start from the last index this process (or a previous one) wrote
         try:
-            last_sync = datetime.fromtimestamp(os.path.getmtime(user_dir)).strftime('%Y-%m-%d %H:%M')
-        except Exception:
-            last_sync = 'Unknown'
-        
-        details.append({
-            'username': user,
-            'total_size': total_size,
-            'total_size_formatted': format_bytes(total_size),
-            'last_sync': last_sync,
-            'collections': collections,
-            'devices': all_devices.get(user, [])
-        })
-    
-    return details
+            with open(os.path.join(STATE_DIR, 'users_index.json')) as f:
+                _user_index.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+    stale = time.time() - _user_index['built'] >= USER_INDEX_TTL
+    if stale and _user_index_lock.acquire(blocking=False):
+        if _user_index['built']:
+            threading.Thread(target=_refresh_user_index, daemon=True).start()
+        else:
+            _refresh_user_index()
+    return _user_index
 
 def get_storage_breakdown():
     """Get storage breakdown by category"""
     collections_size = 0
-    media_size = 0
-    
-    for user in get_users():
-        user_dir = os.path.join(DATA_DIR, user)
+
+    users = get_users()
+    for user in users:
+        user_dir = shards.user_dir(user)
         if os.path.exists(user_dir):
             for db_file in Path(user_dir).glob('**/*.anki2'):
                 collections_size += db_file.stat().st_size
-            media_dir = os.path.join(user_dir, 'collection.media')
-            if os.path.exists(media_dir):
-                media_size += get_dir_size(media_dir)
+    mediastats.update_all(users)
+    media_size = sum(m['bytes'] for m in mediastats.summary(users).values())
     
     backups_size = get_dir_size(BACKUP_DIR) if os.path.exists(BACKUP_DIR) else 0
     logs_size = get_dir_size(LOG_DIR) if os.path.exists(LOG_DIR) else 0
@@ -418,10 +455,222 @@ def api_stats():
         'auth_failed': auth['failed']
     })
 
+USER_SORT_KEYS = {
+    'name': lambda r: r['username'].lower(),
+    'size': lambda r: r['total_size'],
+    'last_sync': lambda r: r['last_sync'],
+    'cards': lambda r: r['cards'] if r['cards'] is not None else -1,
+    'orphaned': lambda r: r.get('orphaned_bytes', 0),
+}
+
 @app.route('/api/users')
 @requires_auth
 def api_users():
-    return jsonify(get_user_details())
+    index = get_user_index()
+    rows = index['rows']
+    q = request.args.get('q', '').strip().lower()
+    if q:
+        rows = [r for r in rows if q in r['username'].lower()]
+    sort = request.args.get('sort', 'name')
+    if sort not in USER_SORT_KEYS:
+        return jsonify({'error': f'sort must be one of {", ".join(USER_SORT_KEYS)}'}), 400
+    order = request.args.get('order', 'asc' if sort == 'name' else 'desc')
+    rows = sorted(rows, key=USER_SORT_KEYS[sort], reverse=order == 'desc')
+    per_page = min(max(request.args.get('per_page', 50, type=int), 1), 200)
+    page = max(request.args.get('page', 1, type=int), 1)
+    start = (page - 1) * per_page
+    return jsonify({
+        'total': len(rows),
+        'page': page,
+        'per_page': per_page,
+        'total_size': sum(r['total_size'] for r in index['rows']),
+        'built': index['built'],
+        'users': [{**r, 'total_size_formatted': format_bytes(r['total_size']),
+                   'orphaned_bytes_formatted': format_bytes(r.get('orphaned_bytes', 0)),
+                   'last_sync_formatted': datetime.fromtimestamp(r['last_sync']).strftime('%Y-%m-%d %H:%M')}
+                  for r in rows[start:start + per_page]],
+    })
+
+@app.route('/api/users/<username>')
+@requires_auth
+def api_user(username):
+    if username not in get_users():
+        return jsonify({'error': 'unknown user'}), 404
+    detail = get_user_detail(username)
+    if detail is None:
+        return jsonify({'error': 'no data for user yet'}), 404
+    return jsonify(detail)
+
+# Per-user export: a tar built on the fly. SQLite files are snapshotted with
+# the backup API first (into memory, or a temporary file in paged steps when
+# large), so a locked database turns into a 503 before anything is sent; media
+# is read straight from disk, and output is paced so an export never floods
+# the disk or the network.
+EXPORT_RATE = float(os.environ.get('EXPORT_RATE_MB', 20)) * 1024 * 1024
+EXPORT_SNAPSHOT_MAX = int(float(os.environ.get('EXPORT_SNAPSHOT_MAX_MB', 256)) * 1024 * 1024)
+_export_slots = threading.BoundedSemaphore(int(os.environ.get('EXPORT_CONCURRENCY', 1)))
+EXPORT_CHUNK = 256 * 1024
+EXPORT_BACKUP_PAGES = 4096  # per step of a large snapshot; the server can write in between
+EXPORT_LOCK_WAIT = 20  # seconds a database may stay locked before the export gets a 503
+
+class SnapshotBusy(Exception):
+    pass
+
+def snapshot_sqlite(path, tmpdir):
+    """Consistent copy of a database: bytes when it fits in EXPORT_SNAPSHOT_MAX,
+    else the path of a copy in tmpdir. None when it isn't a readable database
+    (it is then exported as-is); raises SnapshotBusy when the server keeps it
+    locked for EXPORT_LOCK_WAIT."""
+    deadline = time.monotonic() + EXPORT_LOCK_WAIT
+
+    def progress(status, remaining, total):
+        # sqlite3 retries a busy step forever on its own; give up at the deadline
+        if status in (5, 6) and time.monotonic() > deadline:  # SQLITE_BUSY, SQLITE_LOCKED
+            raise SnapshotBusy(path)
+
+    try:
+        src = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=1)
+        try:
+            size = os.path.getsize(path)
+            if os.path.exists(path + '-wal'):
+                size += os.path.getsize(path + '-wal')
+            if size <= EXPORT_SNAPSHOT_MAX:
+                dst = sqlite3.connect(':memory:')
+                try:
+                    src.backup(dst, progress=progress, sleep=0.5)
+                    return dst.serialize()
+                finally:
+                    dst.close()
+            copy = os.path.join(tmpdir, f'{len(os.listdir(tmpdir))}.db')
+            dst = sqlite3.connect(copy)
+            try:
+                src.backup(dst, pages=EXPORT_BACKUP_PAGES, progress=progress, sleep=0.5)
+            finally:
+                dst.close()
+            return copy
+        finally:
+            src.close()
+    except sqlite3.OperationalError as e:
+        if 'locked' in str(e) or 'busy' in str(e):
+            raise SnapshotBusy(path) from e
+        return None
+    except (sqlite3.Error, OSError):
+        return None
+
+def is_sqlite(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(16) == b'SQLite format 3\x00'
+    except OSError:
+        return False
+
+def snapshot_user_dir(user_dir, tmpdir):
+    """Snapshots of every database under user_dir, by path"""
+    snapshots = {}
+    for root, _, files in os.walk(user_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            if is_sqlite(path):
+                data = snapshot_sqlite(path, tmpdir)
+                if data is not None:
+                    snapshots[path] = data
+    return snapshots
+
+def tar_user_dir(user_dir, prefix, snapshots):
+    """Yield a ustar/pax stream of user_dir, chunk by chunk, with databases
+    taken from snapshots"""
+    import tarfile
+
+    def header(name, size, mtime, mode=0o644):
+        info = tarfile.TarInfo(f'{prefix}/{name}')
+        info.size, info.mtime, info.mode = size, int(mtime), mode
+        return info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+
+    def padding(size):
+        return b'\0' * (-size % tarfile.BLOCKSIZE)
+
+    for root, dirs, files in os.walk(user_dir):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, user_dir)
+            if any(path == s + ext for s in snapshots for ext in ('-wal', '-shm', '-journal')):
+                continue  # already folded into the snapshot
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            data = snapshots.get(path)
+            if isinstance(data, bytes):
+                yield header(rel, len(data), st.st_mtime)
+                for i in range(0, len(data), EXPORT_CHUNK):
+                    yield data[i:i + EXPORT_CHUNK]
+                yield padding(len(data))
+                continue
+            try:
+                f = open(data or path, 'rb')
+            except OSError:
+                continue
+            with f:
+                size = os.fstat(f.fileno()).st_size if data else st.st_size
+                yield header(rel, size, st.st_mtime)
+                left = size
+                while left > 0:
+                    chunk = f.read(min(EXPORT_CHUNK, left))
+                    if not chunk:
+                        break
+                    left -= len(chunk)
+                    yield chunk
+                if left:
+                    yield b'\0' * left  # truncated while reading; keep the archive aligned
+                yield padding(size)
+    yield b'\0' * (2 * tarfile.BLOCKSIZE)
+
+def paced(chunks, rate):
+    start = time.monotonic()
+    sent = 0
+    for chunk in chunks:
+        yield chunk
+        sent += len(chunk)
+        if rate:
+            ahead = sent / rate - (time.monotonic() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+
+@app.route('/api/users/<username>/export')
+@requires_auth
+def api_user_export(username):
+    user_dir = shards.user_dir(username)
+    if username not in get_users() or not os.path.isdir(user_dir):
+        return jsonify({'error': 'unknown user'}), 404
+    if not _export_slots.acquire(blocking=False):
+        return jsonify({'error': 'another export is running, try again shortly'}), 429, {'Retry-After': '30'}
+
+    import shutil
+    import tempfile
+    tmpdir = None
+
+    def done():
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        _export_slots.release()
+
+    try:
+        tmpdir = tempfile.mkdtemp(prefix='anki-export-')
+        snapshots = snapshot_user_dir(user_dir, tmpdir)
+    except SnapshotBusy:
+        done()
+        return jsonify({'error': 'the collection is busy syncing, try again shortly'}), 503, {'Retry-After': '30'}
+    except BaseException:
+        done()
+        raise
+    filename = f"{username}-export-{datetime.now().strftime('%Y%m%d-%H%M%S')}.tar"
+    resp = Response(paced(tar_user_dir(user_dir, username, snapshots), EXPORT_RATE), mimetype='application/x-tar',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"',
+                             'Cache-Control': 'no-store'})
+    # the server closes the response when it is done or the client went away
+    resp.call_on_close(done)
+    return resp
 
 @app.route('/api/storage')
 @requires_auth
@@ -438,14 +687,176 @@ def api_container():
 def api_backups():
     return jsonify(get_backups())
 
+# Backup jobs: backup.sh runs in its own process group so a cancel reaches
+# sqlite3/tar/pigz as well. Its PROGRESS lines drive the job, everything else
+# goes to backup.log like a cron run. backup.lock (flock) is shared with cron
+# so two backups never overlap.
+BACKUP_SCRIPT = '/usr/local/bin/backup.sh'
+BACKUP_LOCK = os.path.join(STATE_DIR, 'backup.lock')
+BACKUP_JOBS_KEEP = 50
+BACKUP_LOCKED_EXIT = 75
+_backup_jobs = {}  # id -> job, oldest first
+_backup_procs = {}  # id -> Popen while running
+_backup_jobs_lock = threading.Lock()
+
+def _load_backup_jobs():
+    try:
+        with open(os.path.join(STATE_DIR, 'backup_jobs.json')) as f:
+            jobs = json.load(f)
+    except (OSError, ValueError):
+        return
+    for job in jobs:
+        if job.get('state') == 'running':
+            job['state'] = 'interrupted'  # the dashboard restarted under it
+        _backup_jobs[job['id']] = job
+
+def _save_backup_jobs():
+    with _backup_jobs_lock:
+        for old in list(_backup_jobs)[:-BACKUP_JOBS_KEEP]:
+            del _backup_jobs[old]
+        jobs = [dict(j, log=j['log'][-5:]) for j in _backup_jobs.values()]
+    path = os.path.join(STATE_DIR, 'backup_jobs.json')
+    try:
+        with open(path + '.tmp', 'w') as f:
+            json.dump(jobs, f)
+        os.replace(path + '.tmp', path)
+    except OSError:
+        pass
+
+def backup_lock_held():
+    """True while any backup.sh (cron or dashboard) or restore.sh holds
+    backup.lock; maintenance.py's shared hold doesn't count"""
+    import fcntl
+    try:
+        fd = os.open(BACKUP_LOCK, os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        return False
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
+
+def _backup_progress(job, line):
+    fields = dict(kv.split('=', 1) for kv in line.split() if '=' in kv)
+    now = time.time()
+    phase = fields.get('phase', job['phase'])
+    if fields.get('throttled', '').isdigit():
+        job['throttled_seconds'] = int(fields['throttled'])
+    if phase != job['phase']:
+        job['phase'], job['phase_started'], job['phase_throttled'] = phase, now, job['throttled_seconds']
+    # backup.sh yields while users sync: waiting=<syncs in flight>
+    job['waiting'] = int(fields['waiting']) if fields.get('waiting', '').isdigit() else 0
+    if 'file' in fields:
+        job['file'] = fields['file']
+    for key in ('files', 'total_files', 'total_bytes'):
+        if fields.get(key, '').isdigit():
+            job[key] = int(fields[key])
+    if fields.get('bytes', '').isdigit():
+        job['bytes'] = int(fields['bytes'])
+    elif fields.get('records', '').isdigit():
+        job['bytes'] = min(int(fields['records']) * int(fields.get('record_bytes', 10240)),
+                           job['total_bytes'])
+    if phase in ('snapshot', 'compress') and job['total_bytes']:
+        done = job['bytes'] / job['total_bytes']
+        elapsed = now - job['phase_started'] - (job['throttled_seconds'] - job['phase_throttled'])
+        job['percent'] = round(done * 100, 1)
+        working = done > 0.01 and elapsed > 1 and not job['waiting']
+        job['eta_seconds'] = int(elapsed / done * (1 - done)) if working else None
+    else:
+        job['percent'], job['eta_seconds'] = None, None
+
+def _run_backup_job(job, proc):
+    with open(os.path.join(LOG_DIR, 'backup.log'), 'a') as log:
+        for line in proc.stdout:
+            if line.startswith(('PROGRESS ', 'tar: PROGRESS ')):
+                _backup_progress(job, line.split('PROGRESS ', 1)[1])
+                continue
+            log.write(line)
+            log.flush()
+            job['log'] = (job['log'] + [line.rstrip()])[-20:]
+    code = proc.wait()
+    if job['cancel_requested']:
+        state = 'cancelled'
+    elif code == BACKUP_LOCKED_EXIT:
+        state = 'skipped'  # lost the race against a cron run
+    else:
+        state = 'done' if code == 0 else 'failed'
+    job.update(state=state, returncode=code, finished=int(time.time()), eta_seconds=None)
+    _backup_procs.pop(job['id'], None)
+    _save_backup_jobs()
+
+def start_backup_job():
+    """(job, None) or (None, reason) when a backup is already running"""
+    import secrets
+    with _backup_jobs_lock:
+        if _backup_procs:
+            return None, 'A backup started from the dashboard is still running'
+        if backup_lock_held():
+            return None, 'A scheduled backup is running'
+        now = time.time()
+        job = {'id': f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(3)}",
+               'state': 'running', 'phase': 'starting', 'started': int(now), 'phase_started': now,
+               'finished': None, 'files': 0, 'total_files': 0, 'bytes': 0, 'total_bytes': 0,
+               'percent': None, 'eta_seconds': None, 'file': None, 'returncode': None,
+               'waiting': 0, 'throttled_seconds': 0, 'phase_throttled': 0,
+               'cancel_requested': False, 'log': []}
+        proc = subprocess.Popen([BACKUP_SCRIPT], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                text=True, bufsize=1, start_new_session=True,
+                                env={**os.environ, 'BACKUP_PROGRESS': '1', 'BACKUP_LOCK_FILE': BACKUP_LOCK})
+        _backup_jobs[job['id']] = job
+        _backup_procs[job['id']] = proc
+    _save_backup_jobs()
+    threading.Thread(target=_run_backup_job, args=(job, proc), daemon=True).start()
+    return job, None
+
+_load_backup_jobs()
+
+@app.route('/api/backups/jobs', methods=['POST'])
 @app.route('/api/backups/create', methods=['POST'])
 @requires_auth
 def api_create_backup():
     try:
-        result = subprocess.run(['/usr/local/bin/backup.sh'], capture_output=True, text=True, timeout=1800)
-        return jsonify({'success': result.returncode == 0, 'message': 'Backup created' if result.returncode == 0 else result.stderr or 'Failed'})
-    except Exception as e:
+        job, reason = start_backup_job()
+    except OSError as e:
         return jsonify({'success': False, 'message': str(e)}), 500
+    if job is None:
+        return jsonify({'success': False, 'message': reason}), 409
+    return jsonify({'success': True, 'message': 'Backup started', **job}), 202
+
+@app.route('/api/backups/jobs')
+@requires_auth
+def api_backup_jobs():
+    with _backup_jobs_lock:
+        jobs = list(reversed(_backup_jobs.values()))
+    return jsonify({'jobs': jobs, 'running': bool(_backup_procs), 'locked': backup_lock_held()})
+
+@app.route('/api/backups/jobs/<job_id>')
+@requires_auth
+def api_backup_job(job_id):
+    job = _backup_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'unknown job'}), 404
+    return jsonify(job)
+
+@app.route('/api/backups/jobs/<job_id>/cancel', methods=['POST'])
+@requires_auth
+def api_cancel_backup_job(job_id):
+    import signal
+    job = _backup_jobs.get(job_id)
+    proc = _backup_procs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'unknown job'}), 404
+    if proc is None:
+        return jsonify({'error': f"job is {job['state']}"}), 409
+    job['cancel_requested'] = True
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+    return jsonify(job), 202
 
 @app.route('/api/backups/download/<filename>')
 @requires_auth
@@ -473,7 +884,6 @@ _update_cache = {'ts': 0.0, 'latest': ''}
 @app.route('/api/update')
 @requires_auth
 def api_update():
-    import json as _json
     from urllib.request import urlopen, Request
     now = time.time()
     if now - _update_cache['ts'] > 21600:
@@ -482,7 +892,7 @@ def api_update():
             req = Request('https://api.github.com/repos/ankitects/anki/releases/latest',
                           headers={'User-Agent': 'anki-sync-dashboard'})
             with urlopen(req, timeout=5) as r:
-                latest = _json.load(r).get('tag_name', '')
+                latest = json.load(r).get('tag_name', '')
         except Exception:
             pass
         _update_cache.update(ts=now, latest=latest)
@@ -491,9 +901,39 @@ def api_update():
     return jsonify({'current': current, 'latest': latest,
                     'update_available': bool(latest) and bool(current) and latest != current})
 
+def load_asset_manifest():
+    # logical name -> content-hashed file, written by assets/build.sh
+    try:
+        with open(os.path.join(STATIC_DIR, 'manifest.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+ASSETS = load_asset_manifest()
+HASHED_ASSETS = set(ASSETS.values())
+
 @app.route('/static/<filename>')
 def static_assets(filename):
-    return send_from_directory(STATIC_DIR, filename)
+    import mimetypes
+    # q-values parsed by werkzeug: the preferred encoding wins, br on a tie,
+    # and q=0 refuses one
+    accepted = request.accept_encodings
+    served, encoding = filename, None
+    for enc, ext in sorted((('br', '.br'), ('gzip', '.gz')), key=lambda e: -accepted[e[0]]):
+        if accepted[enc] > 0 and os.path.isfile(os.path.join(STATIC_DIR, filename + ext)):
+            served, encoding = filename + ext, enc
+            break
+    resp = send_from_directory(STATIC_DIR, served,
+                               mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    if encoding:
+        resp.headers['Content-Encoding'] = encoding
+    resp.headers['Vary'] = 'Accept-Encoding'
+    if filename in HASHED_ASSETS:
+        # the name changes whenever the content does
+        resp.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        resp.headers['Cache-Control'] = 'no-cache'
+    return resp
 
 @app.route('/api/notify/test', methods=['POST'])
 @requires_auth
@@ -515,11 +955,75 @@ def api_logs(log_type):
         return jsonify({'error': 'Invalid'}), 400
     return jsonify({'lines': read_log_lines(os.path.join(LOG_DIR, files[log_type]), int(request.args.get('lines', 100)))})
 
+@app.route('/api/auth/top')
+@requires_auth
+def api_auth_top():
+    # written every few seconds by monitor.py's sliding-window tracker
+    try:
+        with open(os.path.join(STATE_DIR, 'auth_top.json')) as f:
+            return jsonify(json.load(f))
+    except (OSError, ValueError):
+        return jsonify({'updated': 0, 'windows': {}})
+
+@app.route('/api/endpoints')
+@requires_auth
+def api_endpoints():
+    # cumulative per-endpoint counters maintained by monitor.py
+    try:
+        with open(os.path.join(STATE_DIR, 'requests.json')) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        data = {}
+    rows = {}
+    for e in data.get('requests', []):
+        row = rows.setdefault(e['uri'], {'uri': e['uri'], 'count': 0, 'errors': 0, 'ms_sum': 0, 'statuses': {}})
+        row['count'] += e['count']
+        row['ms_sum'] += e['ms_sum']
+        row['statuses'][e['status']] = e['count']
+        if not e['status'].startswith(('1', '2', '3')):
+            row['errors'] += e['count']
+    ratios = data.get('error_ratio', {})
+    for row in rows.values():
+        row['avg_ms'] = round(row.pop('ms_sum') / row['count'], 1) if row['count'] else 0
+        row['recent_error_ratio'] = ratios.get(row['uri'])
+    return jsonify(sorted(rows.values(), key=lambda r: r['count'], reverse=True))
+
+@app.route('/api/sessions/slowest')
+@requires_auth
+def api_sessions_slowest():
+    # whole sync sessions recorded by monitor.py, slowest first
+    hours = min(max(request.args.get('hours', 24, type=float), 0.1), 24 * 30)
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 200)
+    kind = request.args.get('type')
+    since = time.time() - hours * 3600
+    sessions = []
+    for line in read_log_lines(os.path.join(LOG_DIR, 'sessions.log'), 5000):
+        _, sep, record = line.partition('] SESSION ')
+        if not sep:
+            continue
+        try:
+            s = json.loads(record)
+        except ValueError:
+            continue
+        if s.get('start', 0) >= since and (not kind or s.get('type') == kind):
+            sessions.append(s)
+    sessions.sort(key=lambda s: s.get('wall_ms', 0), reverse=True)
+    return jsonify(sessions[:limit])
+
 @app.route('/api/chart')
 @requires_auth
 def api_chart():
     return jsonify(get_sync_chart_data())
 
+@app.route('/api/analytics')
+@requires_auth
+def api_analytics():
+    days = min(max(request.args.get('days', 30, type=int), 1), 365)
+    users = get_users()
+    # folds in whatever was synced since the last call, then reads the sidecar
+    analytics.update_all(users)
+    return jsonify(analytics.history(users, days))
+
 @app.route('/api/latency')
 @requires_auth
 def api_latency():
@@ -555,8 +1059,8 @@ DASHBOARD_HTML = '''<!DOCTYPE html>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Anki Sync Server</title>
-    <script src="/static/tailwind.js"></script>
-    <script src="/static/chart.umd.js"></script>
+    <link rel="stylesheet" href="/static/{{ assets['dashboard.css'] or 'dashboard.css' }}">
+    <script src="/static/{{ assets['chart.umd.js'] or 'chart.umd.js' }}"></script>
 </head>
 <body class="min-h-screen p-6 bg-slate-900 text-slate-200" id="body">
     <div class="max-w-6xl mx-auto">
@@ -594,20 +1098,35 @@ DASHBOARD_HTML = '''<!DOCTYPE html>
             <div class="grid grid-cols-1 lg:grid-cols-3 gap-4 mb-6">
                 <div class="card bg-slate-800 rounded-xl p-5"><div class="text-xs text-slate-500 uppercase tracking-wider mb-4">Features</div><div id="features" class="space-y-2"></div></div>
                 <div class="card bg-slate-800 rounded-xl p-5"><div class="text-xs text-slate-500 uppercase tracking-wider mb-4">Backups</div><div class="text-4xl font-bold text-slate-300" id="backups">--</div><div class="text-sm text-slate-500 mt-1" id="backups-size">--</div></div>
-                <div class="card bg-slate-800 rounded-xl p-5"><div class="text-xs text-slate-500 uppercase tracking-wider mb-4">Auth Stats</div><div class="space-y-1 mt-2"><div>Success: <span class="text-green-400 font-semibold" id="auth-ok">0</span></div><div>Failed: <span class="text-red-400 font-semibold" id="auth-fail">0</span></div></div><button id="notify-btn" onclick="testNotify()" class="mt-4 w-full px-3 py-1.5 bg-blue-600 hover:bg-blue-700 rounded-lg text-sm transition text-white disabled:opacity-40 disabled:cursor-not-allowed">Test Notification</button></div>
+                <div class="card bg-slate-800 rounded-xl p-5"><div class="text-xs text-slate-500 uppercase tracking-wider mb-4">Auth Stats</div><div class="space-y-1 mt-2"><div>Success: <span class="text-green-400 font-semibold" id="auth-ok">0</span></div><div>Failed: <span class="text-red-400 font-semibold" id="auth-fail">0</span></div></div><div class="flex justify-between items-center mt-3 mb-1"><span class="text-xs text-slate-500 uppercase">Top failing IPs</span><select id="auth-window" onchange="loadAuthTop()" class="text-xs rounded bg-slate-700 text-slate-300 px-1 py-0.5"><option>1m</option><option selected>10m</option><option>1h</option></select></div><div id="auth-top" class="space-y-1 text-sm max-h-32 overflow-auto"></div><button id="notify-btn" onclick="testNotify()" class="mt-4 w-full px-3 py-1.5 bg-blue-600 hover:bg-blue-700 rounded-lg text-sm transition text-white disabled:opacity-40 disabled:cursor-not-allowed">Test Notification</button></div>
             </div>
             <div class="grid grid-cols-1 lg:grid-cols-2 gap-4">
                 <div class="card bg-slate-800 rounded-xl p-5"><div class="text-xs text-slate-500 uppercase tracking-wider mb-4">Sync Activity (7 Days)</div><canvas id="chart" height="180"></canvas></div>
                 <div class="card bg-slate-800 rounded-xl p-5"><div class="text-xs text-slate-500 uppercase tracking-wider mb-4">Recent Syncs</div><div id="recent" class="space-y-2 max-h-52 overflow-auto"></div></div>
             </div>
+            <div class="card bg-slate-800 rounded-xl p-5 mt-6">
+                <div class="text-xs text-slate-500 uppercase tracking-wider mb-4">Endpoints</div>
+                <div class="overflow-auto max-h-80"><table class="w-full text-sm"><thead><tr class="text-left text-slate-500 text-xs border-b border-slate-700"><th class="pb-2">Endpoint</th><th class="pb-2 text-right">Requests</th><th class="pb-2 text-right">Errors</th><th class="pb-2 text-right">Error rate (5m)</th><th class="pb-2 text-right">Avg ms</th><th class="pb-2 pl-4">Statuses</th></tr></thead><tbody id="endpoints"></tbody></table></div>
+            </div>
+            <div class="card bg-slate-800 rounded-xl p-5 mt-6">
+                <div class="flex justify-between items-center mb-4"><span class="text-xs text-slate-500 uppercase tracking-wider">Slowest Sync Sessions (24h)</span><select id="session-type" onchange="loadSessions()" class="text-xs rounded bg-slate-700 text-slate-300 px-1 py-0.5"><option value="">All types</option><option value="normal">Normal</option><option value="full_upload">Full upload</option><option value="full_download">Full download</option><option value="media">Media only</option></select></div>
+                <div class="overflow-auto max-h-80"><table class="w-full text-sm"><thead><tr class="text-left text-slate-500 text-xs border-b border-slate-700"><th class="pb-2">Started</th><th class="pb-2">User</th><th class="pb-2">Device</th><th class="pb-2">Type</th><th class="pb-2">Outcome</th><th class="pb-2 text-right">Total</th><th class="pb-2 pl-4">Server time by phase</th></tr></thead><tbody id="sessions"></tbody></table></div>
+            </div>
         </div>
 
         <!-- Users -->
         <div id="tab-users" class="tab-content hidden">
             <div class="card bg-slate-800 rounded-xl p-5">
-                <div class="flex justify-between mb-4"><span class="text-xs text-slate-500 uppercase">User Statistics</span><button onclick="loadUsers()" class="px-4 py-1.5 bg-blue-600 rounded-lg text-sm hover:bg-blue-700 text-white">Refresh</button></div>
+                <div class="flex justify-between mb-4"><span class="text-xs text-slate-500 uppercase">User Statistics</span><button onclick="loadUsers();loadAnalytics()" class="px-4 py-1.5 bg-blue-600 rounded-lg text-sm hover:bg-blue-700 text-white">Refresh</button></div>
                 <div id="user-storage-chart" class="bg-slate-700/50 rounded-lg p-4 mb-4"></div>
+                <div class="bg-slate-700/50 rounded-lg p-4 mb-4"><div class="text-xs text-slate-500 uppercase mb-3">Reviews per Day (30 Days)</div><canvas id="review-chart" height="110"></canvas><div id="review-summary" class="mt-3 space-y-1 text-sm"></div></div>
+                <div class="flex flex-wrap gap-2 items-center mb-3">
+                    <input id="user-search" type="search" placeholder="Search users" oninput="searchUsers()" class="px-3 py-1.5 rounded-lg text-sm bg-slate-700 text-slate-200 placeholder-slate-500 outline-none">
+                    <select id="user-sort" onchange="loadUsers()" class="px-3 py-1.5 rounded-lg text-sm bg-slate-700 text-slate-200"><option value="name">Name</option><option value="size">Size</option><option value="last_sync">Last sync</option><option value="cards">Cards</option><option value="orphaned">Orphaned media</option></select>
+                    <span id="users-count" class="text-xs text-slate-500 ml-auto"></span>
+                </div>
                 <div id="users-list" class="space-y-2"></div>
+                <div id="users-more" class="text-center text-xs text-slate-500 py-3"></div>
             </div>
         </div>
 
@@ -616,8 +1135,17 @@ DASHBOARD_HTML = '''<!DOCTYPE html>
             <div class="card bg-slate-800 rounded-xl p-5">
                 <div class="flex justify-between mb-4"><span class="text-xs text-slate-500 uppercase">Backup Files</span><button id="bkbtn" onclick="createBackup()" class="px-4 py-1.5 bg-green-600 rounded-lg text-sm hover:bg-green-700 text-white">Create Backup</button></div>
                 <div id="bkalert" class="hidden mb-4 p-3 rounded-lg text-sm"></div>
+                <div id="bkjob" class="hidden mb-4 p-3 rounded-lg bg-slate-900/50">
+                    <div class="flex justify-between items-center text-sm mb-2"><span id="bkphase">--</span><button id="bkcancel" onclick="cancelBackup()" class="px-3 py-1 bg-red-600 hover:bg-red-700 rounded text-xs text-white">✕ Cancel</button></div>
+                    <div class="w-full h-2 rounded bg-slate-700 overflow-hidden"><div id="bkbar" class="h-2 bg-green-500" style="width:0%"></div></div>
+                    <div id="bkstats" class="text-xs text-slate-500 mt-2">--</div>
+                </div>
                 <table class="w-full"><thead><tr class="text-left text-slate-500 text-xs border-b border-slate-700"><th class="pb-2">Filename</th><th class="pb-2">Size</th><th class="pb-2">Created</th><th class="pb-2 text-right">Actions</th></tr></thead><tbody id="bktbl"></tbody></table>
             </div>
+            <div class="card bg-slate-800 rounded-xl p-5 mt-4">
+                <div class="text-xs text-slate-500 uppercase mb-4">Backup Jobs</div>
+                <table class="w-full"><thead><tr class="text-left text-slate-500 text-xs border-b border-slate-700"><th class="pb-2">Started</th><th class="pb-2">State</th><th class="pb-2">Duration</th><th class="pb-2">Archive</th></tr></thead><tbody id="bkjobs"></tbody></table>
+            </div>
         </div>
 
         <!-- Logs -->
@@ -652,7 +1180,7 @@ DASHBOARD_HTML = '''<!DOCTYPE html>
         <footer class="text-center text-slate-600 text-sm mt-8">Anki Sync Server Enhanced | Auto-refresh: <span id="cd">10</span>s</footer>
     </div>
 <script>
-let logType='sync',chart,cd=10,darkMode=true,expandedUser=null;
+let logType='sync',chart,reviewChart,cd=10,darkMode=true;
 function esc(s){return String(s).replace(/&/g,'&amp;').replace(/</g,'&lt;').replace(/>/g,'&gt;').replace(/"/g,'&quot;');}
 function rel(epoch){const d=Date.now()/1000-epoch;if(d<60)return Math.max(0,Math.floor(d))+'s ago';if(d<3600)return Math.floor(d/60)+'m ago';if(d<86400)return Math.floor(d/3600)+'h ago';return Math.floor(d/86400)+'d ago';}
 const storageColors={collections:'#06b6d4',media:'#3b82f6',backups:'#a855f7',logs:'#64748b'};
@@ -688,8 +1216,8 @@ function showTab(t){
     });
     event.target.classList.remove(darkMode?'bg-slate-800':'bg-gray-200',darkMode?'text-slate-400':'text-gray-600');
     event.target.classList.add('bg-blue-600','text-white');
-    if(t==='users')loadUsers();
-    if(t==='backups')loadBackups();
+    if(t==='users'){loadUsers();loadAnalytics();}
+    if(t==='backups'){loadBackups();loadBackupJobs();}
     if(t==='logs')loadLogs(logType);
     if(t==='system')loadSystem();
 }
@@ -703,12 +1231,15 @@ function initChart(){
 }
 
 function applyChartTheme(){
-    if(!chart)return;
     const t=chartTheme();
-    chart.options.scales.y.grid.color=t.grid;
-    chart.options.scales.y.ticks.color=t.ticks;
-    chart.options.scales.x.ticks.color=t.ticks;
-    chart.update();
+    [chart,reviewChart].forEach(c=>{
+        if(!c)return;
+        c.options.scales.y.grid.color=t.grid;
+        c.options.scales.y.ticks.color=t.ticks;
+        c.options.scales.x.ticks.color=t.ticks;
+        if(c.options.plugins.legend.labels)c.options.plugins.legend.labels.color=t.ticks;
+        c.update();
+    });
 }
 
 async function refreshAll(){
@@ -761,53 +1292,152 @@ async function refreshAll(){
         else b.classList.add('hidden');
     }catch(e){}
 
+    loadAuthTop();
+
+    try{
+        const r=await fetch('/api/endpoints');const d=await r.json();
+        document.getElementById('endpoints').innerHTML=d.length?d.map(e=>`<tr class="border-b ${darkMode?'border-slate-700':'border-gray-200'}"><td class="py-1.5 font-mono text-xs">${esc(e.uri)}</td><td class="py-1.5 text-right">${e.count.toLocaleString()}</td><td class="py-1.5 text-right ${e.errors?'text-red-400':''}">${e.errors.toLocaleString()}</td><td class="py-1.5 text-right">${e.recent_error_ratio==null?'<span class="text-slate-500">–</span>':(e.recent_error_ratio*100).toFixed(1)+'%'}</td><td class="py-1.5 text-right">${e.avg_ms}</td><td class="py-1.5 pl-4 text-xs text-slate-500">${Object.entries(e.statuses).map(([k,v])=>esc(k)+'×'+v).join(' ')}</td></tr>`).join(''):'<tr><td colspan="6" class="py-4 text-center text-slate-500">No requests yet</td></tr>';
+    }catch(e){}
+
+    loadSessions();
+
     try{
         const r=await fetch('/api/latency');const d=await r.json();
         document.getElementById('latency').textContent=d.count?`avg ${d.avg} ms · p95 ${d.p95} ms`:'no data yet';
     }catch(e){}
 }
 
-let usersData=[];
+async function loadSessions(){
+    try{
+        const t=document.getElementById('session-type').value;
+        const r=await fetch('/api/sessions/slowest'+(t?'?type='+t:''));const d=await r.json();
+        const secs=ms=>ms>=1000?(ms/1000).toFixed(1)+' s':ms+' ms';
+        document.getElementById('sessions').innerHTML=d.length?d.map(s=>{
+            const phases=Object.entries(s.phases).sort((a,b)=>b[1]-a[1]);
+            return `<tr class="border-b ${darkMode?'border-slate-700':'border-gray-200'}"><td class="py-1.5 text-xs">${new Date(s.start*1000).toLocaleString()}</td><td class="py-1.5">${esc(s.user)}</td><td class="py-1.5 text-xs text-slate-500">${esc(s.device||'–')}</td><td class="py-1.5 text-xs">${esc(s.type)}</td><td class="py-1.5 text-xs ${s.outcome==='ok'?'text-green-400':'text-red-400'}">${esc(s.outcome)}${s.error_at?' at '+esc(s.error_at):''}</td><td class="py-1.5 text-right">${secs(s.wall_ms)}</td><td class="py-1.5 pl-4 text-xs text-slate-500">${phases.map(([k,v],i)=>(i?'':'<span class="text-orange-400">')+esc(k)+' '+secs(v)+(i?'':'</span>')).join(' · ')}</td></tr>`;
+        }).join(''):'<tr><td colspan="7" class="py-4 text-center text-slate-500">No sessions yet</td></tr>';
+    }catch(e){}
+}
+
+async function loadAuthTop(){
+    try{
+        const r=await fetch('/api/auth/top');const d=await r.json();
+        const w=document.getElementById('auth-window').value;
+        const rows=(d.windows&&d.windows[w])||[];
+        document.getElementById('auth-top').innerHTML=rows.length?rows.map(e=>`<div class="flex justify-between"><span class="font-mono text-xs">${esc(e.ip)}</span><span class="text-red-400">${e.failed}</span></div>`).join(''):'<div class="text-slate-500 text-xs">No failures</div>';
+    }catch(e){}
+}
+
+const USERS_PAGE=50;
+let usersState={page:0,total:0,loading:false,gen:0},searchTimer;
+function searchUsers(){clearTimeout(searchTimer);searchTimer=setTimeout(loadUsers,250);}
 async function loadUsers(){
+    usersState={page:0,total:0,loading:false,gen:usersState.gen+1};
+    document.getElementById('users-list').innerHTML='';
+    await loadMoreUsers();
+    loadStorageChart();
+}
+async function loadMoreUsers(){
+    if(usersState.loading||(usersState.page&&usersState.page*USERS_PAGE>=usersState.total))return;
+    usersState.loading=true;
+    const gen=usersState.gen;
     try{
-        const r=await fetch('/api/users');usersData=await r.json();
-        renderUsers();
+        const q=encodeURIComponent(document.getElementById('user-search').value.trim());
+        const sort=document.getElementById('user-sort').value;
+        const r=await fetch(`/api/users?page=${usersState.page+1}&per_page=${USERS_PAGE}&sort=${sort}&q=${q}`);const d=await r.json();
+        if(gen!==usersState.gen)return;  // search or sort changed meanwhile
+        usersState.page=d.page;usersState.total=d.total;
+        // append only the new page; rows already on screen are left alone
+        document.getElementById('users-list').insertAdjacentHTML('beforeend',d.users.map(userRow).join(''));
+        const shown=Math.min(d.page*d.per_page,d.total);
+        document.getElementById('users-count').textContent=`${shown.toLocaleString()} of ${d.total.toLocaleString()} users`;
+        document.getElementById('users-more').textContent=shown<d.total?'Scroll for more…':'';
+        // re-arm the sentinel in case it is still on screen after this page
+        const more=document.getElementById('users-more');usersMore.unobserve(more);usersMore.observe(more);
     }catch(e){}
+    finally{if(gen===usersState.gen)usersState.loading=false;}
 }
+const usersMore=new IntersectionObserver(es=>{if(es.some(e=>e.isIntersecting))loadMoreUsers();});
+usersMore.observe(document.getElementById('users-more'));
 
-function renderUsers(){
+async function loadStorageChart(){
     try{
-        const d=usersData;
-        const totalSize=d.reduce((a,b)=>a+b.total_size,0)||1;
-        
-        document.getElementById('user-storage-chart').innerHTML='<div class="text-xs text-slate-500 uppercase mb-3">Storage per User</div>'+d.map(u=>`<div class="mb-3"><div class="flex justify-between text-sm mb-1"><span class="text-cyan-400 font-medium">${u.username}</span><span>${u.total_size_formatted}</span></div><div class="h-2 ${darkMode?'bg-slate-600':'bg-gray-300'} rounded-full overflow-hidden"><div class="h-full bg-cyan-500 rounded-full" style="width:${(u.total_size/totalSize)*100}%"></div></div></div>`).join('');
-        
-        document.getElementById('users-list').innerHTML=d.map((u,i)=>`
+        const r=await fetch('/api/users?sort=size&per_page=10');const d=await r.json();
+        const total=d.total_size||1;
+        document.getElementById('user-storage-chart').innerHTML=`<div class="text-xs text-slate-500 uppercase mb-3">Storage per User${d.total>10?' (top 10 of '+d.total.toLocaleString()+')':''}</div>`+d.users.map(u=>`<div class="mb-3"><div class="flex justify-between text-sm mb-1"><span class="text-cyan-400 font-medium">${esc(u.username)}</span><span>${u.total_size_formatted}</span></div><div class="h-2 ${darkMode?'bg-slate-600':'bg-gray-300'} rounded-full overflow-hidden"><div class="h-full bg-cyan-500 rounded-full" style="width:${(u.total_size/total)*100}%"></div></div></div>`).join('');
+    }catch(e){}
+}
+
+const userColors=['#06b6d4','#3b82f6','#a855f7','#22c55e','#f59e0b','#ef4444','#ec4899','#64748b'];
+async function loadAnalytics(){
+    try{
+        const r=await fetch('/api/analytics?days=30');const d=await r.json();
+        // the busiest users get their own series, everyone else is summed
+        const sum=a=>a.reduce((x,y)=>x+y,0);
+        const names=Object.keys(d.users).sort((a,b)=>sum(d.users[b].reviews)-sum(d.users[a].reviews));
+        const top=names.slice(0,userColors.length-1),rest=names.slice(userColors.length-1);
+        const datasets=top.map((u,i)=>({label:u,data:d.users[u].reviews,backgroundColor:userColors[i]}));
+        if(rest.length)datasets.push({label:`${rest.length} others`,data:d.labels.map((_,j)=>sum(rest.map(u=>d.users[u].reviews[j]))),backgroundColor:userColors[userColors.length-1]});
+        if(!reviewChart){
+            const t=chartTheme();
+            reviewChart=new Chart(document.getElementById('review-chart').getContext('2d'),{type:'bar',data:{labels:[],datasets:[]},options:{responsive:true,plugins:{legend:{display:true,labels:{color:t.ticks,boxWidth:12}}},scales:{y:{stacked:true,beginAtZero:true,grid:{color:t.grid},ticks:{color:t.ticks,precision:0}},x:{stacked:true,grid:{display:false},ticks:{color:t.ticks}}}}});
+        }
+        reviewChart.data.labels=d.labels.map(l=>l.slice(5));
+        reviewChart.data.datasets=datasets;
+        reviewChart.update();
+        document.getElementById('review-summary').innerHTML=top.map(u=>{
+            const s=d.users[u],a=s.answers,n=a.again+a.hard+a.good+a.easy,mins=s.minutes.reduce((x,y)=>x+y,0);
+            const pct=k=>n?Math.round(a[k]*100/n)+'%':'-';
+            return `<div class="flex justify-between"><span class="text-cyan-400 font-medium">${esc(u)}</span><span class="text-slate-400">${s.due.toLocaleString()} due · ${Math.round(mins)} min · again ${pct('again')} / hard ${pct('hard')} / good ${pct('good')} / easy ${pct('easy')}</span></div>`;
+        }).join('')||'<div class="text-slate-500 text-xs">No reviews synced yet</div>';
+    }catch(e){}
+}
+
+function userRow(u){
+    return `
             <div class="border ${darkMode?'border-slate-700':'border-gray-200'} rounded-lg overflow-hidden">
-                <div class="flex items-center justify-between p-4 cursor-pointer ${darkMode?'hover:bg-slate-700':'hover:bg-gray-100'}" onclick="toggleUser(${i})">
+                <div class="flex items-center justify-between p-4 cursor-pointer ${darkMode?'hover:bg-slate-700':'hover:bg-gray-100'}" data-user="${esc(u.username)}" onclick="toggleUser(this)">
                     <div class="flex items-center gap-3">
-                        <span class="transition-transform ${expandedUser===i?'rotate-90':''}" id="arrow-${i}">▶</span>
-                        <span class="text-cyan-400 font-medium">${u.username}</span>
+                        <span class="user-arrow transition-transform">▶</span>
+                        <span class="text-cyan-400 font-medium">${esc(u.username)}</span>
                     </div>
                     <div class="flex gap-6 text-sm">
+                        <span class="text-slate-500">${u.cards!=null?u.cards.toLocaleString()+' cards':''}</span>
+                        ${u.orphaned_bytes?`<span class="text-orange-400" title="Media no note refers to">${u.orphaned_bytes_formatted} orphaned</span>`:''}
                         <span>${u.total_size_formatted}</span>
-                        <span class="text-slate-500">${u.last_sync}</span>
+                        <span class="text-slate-500">${u.last_sync_formatted}</span>
                     </div>
                 </div>
-                <div id="detail-${i}" class="${expandedUser===i?'':'hidden'} ${darkMode?'bg-slate-700/50':'bg-gray-100'} p-4 border-t ${darkMode?'border-slate-700':'border-gray-200'}">
-                    <div class="text-xs text-slate-500 uppercase mb-3">Collection Details</div>
+                <div class="user-detail hidden ${darkMode?'bg-slate-700/50':'bg-gray-100'} p-4 border-t ${darkMode?'border-slate-700':'border-gray-200'}"></div>
+            </div>`;
+}
+
+function userDetail(u){
+    return `
+                    <div class="flex justify-between items-center mb-3"><span class="text-xs text-slate-500 uppercase">Collection Details</span><a href="/api/users/${encodeURIComponent(u.username)}/export" class="px-3 py-1 bg-blue-600 hover:bg-blue-700 rounded text-xs text-white">↓ Export</a></div>
                     <div class="grid grid-cols-1 md:grid-cols-2 gap-3">
                         ${u.collections.map(c=>`
                             <div class="${darkMode?'bg-slate-800':'bg-white'} rounded-lg p-3">
                                 <div class="flex justify-between mb-2">
-                                    <span class="font-mono text-sm">${c.name}</span>
+                                    <span class="font-mono text-sm">${esc(c.name)}</span>
                                     <span class="text-cyan-400 font-semibold">${c.size_formatted}</span>
                                 </div>
-                                <div class="text-xs text-slate-500">${c.type==='database'?(c.cards!=null?c.cards.toLocaleString()+' cards':'card count unavailable'):c.files+' files'}</div>
+                                <div class="text-xs text-slate-500">${c.type==='database'?(c.cards!=null?c.cards.toLocaleString()+' cards':'card count unavailable'):c.files+' files'+(c.added_7d||c.deleted_7d?' · +'+c.added_7d+' / −'+c.deleted_7d+' this week':'')}</div>
                                 <div class="text-xs text-slate-500">Modified: ${c.modified}</div>
                             </div>
                         `).join('')}
                     </div>
+                    ${u.orphans&&(u.orphans.orphaned_files||u.orphans.quarantined_files)?`
+                    <div class="text-xs text-slate-500 uppercase mt-4 mb-2">Orphaned Media</div>
+                    <div class="text-sm mb-2">${u.orphans.orphaned_files.toLocaleString()} files (${u.orphans.orphaned_bytes_formatted}) no note refers to · ${u.orphans.untracked_files.toLocaleString()} unknown to the server (${u.orphans.untracked_bytes_formatted})${u.orphans.quarantined_files?' · '+u.orphans.quarantined_files.toLocaleString()+' quarantined ('+u.orphans.quarantined_bytes_formatted+')':''} <span class="text-xs text-slate-500">checked ${new Date(u.orphans.checked*1000).toLocaleString()}</span></div>
+                    <div class="space-y-1 max-h-40 overflow-auto">
+                        ${u.orphans.largest.map(o=>`
+                            <div class="flex justify-between text-xs ${darkMode?'bg-slate-800':'bg-white'} rounded px-3 py-1.5">
+                                <span class="font-mono truncate">${esc(o.name)}</span>
+                                <span class="text-slate-500 whitespace-nowrap ml-3">${o.tracked?'unused':'untracked'} · ${o.size_formatted}</span>
+                            </div>
+                        `).join('')}
+                    </div>`:''}
                     ${u.devices&&u.devices.length?`
                     <div class="text-xs text-slate-500 uppercase mt-4 mb-2">Devices</div>
                     <div class="space-y-1.5">
@@ -817,14 +1447,22 @@ function renderUsers(){
                                 <span class="text-slate-500 text-xs">last seen ${dv.last_seen}</span>
                             </div>
                         `).join('')}
-                    </div>`:''}
-                </div>
-            </div>
-        `).join('');
-    }catch(e){}
+                    </div>`:''}`;
 }
 
-function toggleUser(i){expandedUser=expandedUser===i?null:i;renderUsers();}
+async function toggleUser(row){
+    const detail=row.nextElementSibling,arrow=row.querySelector('.user-arrow');
+    const open=detail.classList.toggle('hidden')===false;
+    arrow.classList.toggle('rotate-90',open);
+    if(!open||detail.dataset.loaded)return;
+    detail.innerHTML='<div class="text-xs text-slate-500">Loading…</div>';
+    try{
+        const r=await fetch('/api/users/'+encodeURIComponent(row.dataset.user));
+        if(!r.ok)throw new Error();
+        detail.innerHTML=userDetail(await r.json());
+        detail.dataset.loaded='1';
+    }catch(e){detail.innerHTML='<div class="text-xs text-red-400">Could not load details</div>';}
+}
 
 async function loadBackups(){
     try{
@@ -849,19 +1487,82 @@ async function deleteBackup(n){
     }catch(e){alert('Failed to delete');}
 }
 
+let bkJob=null,bkTimer=null;
+function fmtBytes(b){const u=['B','KB','MB','GB','TB'];let i=0;while(b>=1024&&i<u.length-1){b/=1024;i++;}return (i?b.toFixed(1):b)+' '+u[i];}
+function fmtDuration(s){s=Math.max(0,Math.round(s));return s>=3600?Math.floor(s/3600)+'h '+Math.floor(s%3600/60)+'m':s>=60?Math.floor(s/60)+'m '+s%60+'s':s+'s';}
+
+function showBackupJob(j){
+    const box=document.getElementById('bkjob'),btn=document.getElementById('bkbtn');
+    const running=j&&j.state==='running';
+    box.classList.toggle('hidden',!running);
+    btn.disabled=running;btn.textContent=running?'Backing up...':'Create Backup';
+    if(!running)return;
+    document.getElementById('bkphase').textContent=j.phase+(j.waiting?' · paused, '+j.waiting+' sync'+(j.waiting>1?'s':'')+' in progress':'')+(j.cancel_requested?' (cancelling)':'');
+    document.getElementById('bkbar').style.width=(j.percent||0)+'%';
+    const parts=[];
+    if(j.total_files)parts.push(j.files+' / '+j.total_files+' files');
+    if(j.total_bytes)parts.push(fmtBytes(j.bytes)+' / '+fmtBytes(j.total_bytes));
+    if(j.eta_seconds!=null)parts.push('ETA '+fmtDuration(j.eta_seconds));
+    if(j.throttled_seconds)parts.push('yielded '+fmtDuration(j.throttled_seconds));
+    parts.push('elapsed '+fmtDuration(Date.now()/1000-j.started));
+    document.getElementById('bkstats').textContent=parts.join(' · ');
+}
+
+async function loadBackupJobs(){
+    try{
+        const r=await fetch('/api/backups/jobs');const d=await r.json();
+        const states={done:'text-green-400',running:'text-blue-400',failed:'text-red-400',cancelled:'text-amber-400',skipped:'text-slate-400',interrupted:'text-red-400'};
+        document.getElementById('bkjobs').innerHTML=d.jobs.map(j=>`
+            <tr class="border-b ${darkMode?'border-slate-700':'border-gray-200'}" title="${esc(j.log.join('\\n'))}">
+                <td class="py-2 text-xs text-slate-500">${new Date(j.started*1000).toLocaleString()}</td>
+                <td class="py-2 text-xs ${states[j.state]||''}">${esc(j.state)}${j.state==='running'?' · '+esc(j.phase):''}</td>
+                <td class="py-2 text-xs">${fmtDuration((j.finished||Date.now()/1000)-j.started)}</td>
+                <td class="py-2 font-mono text-xs">${j.file?esc(j.file):'--'}</td>
+            </tr>
+        `).join('')||'<tr><td colspan="4" class="py-4 text-center text-slate-500">No jobs yet</td></tr>';
+        const running=d.jobs.find(j=>j.state==='running');
+        if(running&&!bkTimer)pollBackup(running.id);
+        else if(!running)showBackupJob(null);
+        if(d.locked&&!running){const btn=document.getElementById('bkbtn');btn.disabled=true;btn.textContent='Scheduled backup running';}
+    }catch(e){}
+}
+
+async function pollBackup(id){
+    bkJob=id;
+    try{
+        const r=await fetch('/api/backups/jobs/'+encodeURIComponent(id));const j=await r.json();
+        showBackupJob(j);
+        if(j.state==='running'){bkTimer=setTimeout(()=>pollBackup(id),1000);return;}
+        const al=document.getElementById('bkalert');
+        al.className='mb-4 p-3 rounded-lg text-sm '+(j.state==='done'?'bg-green-900/50 text-green-400':'bg-red-900/50 text-red-400');
+        al.textContent=j.state==='done'?'Backup created: '+j.file:'Backup '+j.state+(j.log.length?': '+j.log[j.log.length-1]:'');
+        loadBackups();
+    }catch(e){}
+    bkTimer=null;bkJob=null;
+    loadBackupJobs();
+}
+
 async function createBackup(){
-    const btn=document.getElementById('bkbtn'),al=document.getElementById('bkalert');
-    btn.disabled=true;btn.textContent='Creating...';
+    const al=document.getElementById('bkalert');
+    al.className='hidden';
     try{
-        const r=await fetch('/api/backups/create',{method:'POST'});const d=await r.json();
-        al.className='mb-4 p-3 rounded-lg text-sm '+(d.success?'bg-green-900/50 text-green-400':'bg-red-900/50 text-red-400');
-        al.textContent=d.message;
-        if(d.success)loadBackups();
+        const r=await fetch('/api/backups/jobs',{method:'POST'});const d=await r.json();
+        if(!d.success){
+            al.className='mb-4 p-3 rounded-lg text-sm bg-red-900/50 text-red-400';
+            al.textContent=d.message;
+            return;
+        }
+        showBackupJob(d);
+        if(!bkTimer)pollBackup(d.id);
     }catch(e){
         al.className='mb-4 p-3 rounded-lg text-sm bg-red-900/50 text-red-400';
         al.textContent='Failed';
     }
-    btn.disabled=false;btn.textContent='Create Backup';
+}
+
+async function cancelBackup(){
+    if(!bkJob||!confirm('Cancel the running backup?'))return;
+    try{await fetch('/api/backups/jobs/'+encodeURIComponent(bkJob)+'/cancel',{method:'POST'});}catch(e){}
 }
 
 async function testNotify(){
@@ -937,7 +1638,7 @@ async function loadSystem(){
 @app.route('/')
 @requires_auth
 def dashboard():
-    return render_template_string(DASHBOARD_HTML)
+    return render_template_string(DASHBOARD_HTML, assets={'dashboard.css': None, 'chart.umd.js': None, **ASSETS})
 
 if __name__ == '__main__':
     port = int(os.environ.get('DASHBOARD_PORT', 8081))
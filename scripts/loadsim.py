@@ -0,0 +1,1034 @@
+#!/usr/bin/env python3
+"""Load-test the sync server with many simulated Anki clients.
+
+Each simulated user is one device speaking the sync protocol (v11: JSON
+bodies, zstd-compressed). During setup every user logs in, gets a collection
+of the configured size onto the server with a full upload (or downloads the
+one already there), and uploads its initial media. Then the timed run plays
+sync sessions the way clients do: meta, then start/applyGraves/applyChanges,
+chunk and applyChunk carrying the reviews and new notes, sanityCheck2 and
+finish; a full download now and then (a new device); and a media sync
+(begin, mediaChanges, uploadChanges, mediaSanity) at the end of each session.
+A share of sessions logs in again first.
+
+Session start times follow --pattern over --duration seconds:
+
+  steady    spread evenly over the run
+  burst     --burst-share of them in the first --burst-window of the run,
+            peaking in its middle (the morning burst), the rest spread evenly
+  ramp      arrivals rising linearly towards the end
+
+By default a private stack is started the way entrypoint.sh starts it, in
+--workdir: anki-sync-server with SYNC_USERn accounts for the simulated users,
+monitor.py following its log and metrics.py on a free port, with the
+settings under test taken from the environment (sharding and TLS aside).
+With --url the load goes to a running server instead, using the accounts in
+--accounts (name:password lines, e.g. from user-manager.sh export).
+
+Meanwhile the server's RSS, CPU time and disk I/O are sampled from /proc,
+along with how far monitor.py (sync_count.txt) and the exporter
+(anki_sync_requests_total) trail the requests the clients saw complete. The
+JSON report holds throughput, latency percentiles per endpoint and session
+type, a timeline, resource use and lag; compare two of them (e.g. from two
+image versions or settings) with the compare command.
+
+Bodies are compressed with the zstandard package (installed in the image);
+without it every body goes through the zstd CLI, which costs a process per
+request on the host being measured.
+
+  loadsim.py run [--users N] [--notes N|MIN-MAX] [--pattern P] [--report FILE] ...
+  loadsim.py compare OLD.json NEW.json
+"""
+
+import argparse
+import hashlib
+import http.client
+import io
+import json
+import math
+import os
+import random
+import re
+import shutil
+import signal
+import socket
+import sqlite3
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from urllib.request import urlopen
+
+from monitor import percentile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+SYNC_VERSION = 11
+CLIENT_VERSION = 'anki,25.02 (loadsim),linux'
+# rows per applyChunk call, as the desktop client sends them
+CHUNK_ROWS = 250
+# media uploads are batched like the client's zips
+MEDIA_ZIP_FILES = 25
+MEDIA_ZIP_BYTES = 2_500_000
+REPORT_VERSION = 1
+# settings worth recording with a report; secrets and accounts are left out
+SETTING_PREFIXES = ('SYNC_', 'METRICS_', 'MAINT_', 'MEDIA_', 'BACKUP_', 'MAX_SYNC', 'LOG_', 'STATCACHE_')
+SECRET = re.compile(r'KEY|SECRET|PASS|TOKEN|^SYNC_USER\d+')
+PROGRESS_INTERVAL = 10
+
+
+def log(msg):
+    print(f'[{time.strftime("%Y-%m-%d %H:%M:%S")}] [LOADSIM] {msg}', file=sys.stderr, flush=True)
+
+
+def compress(data):
+    if zstandard:
+        return zstandard.ZstdCompressor().compress(data)
+    return subprocess.run(['zstd', '-q', '-c'], input=data, stdout=subprocess.PIPE, check=True).stdout
+
+
+def decompress(data):
+    if zstandard:
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return subprocess.run(['zstd', '-dcq'], input=data, stdout=subprocess.PIPE, check=True).stdout
+
+
+class SyncError(Exception):
+    def __init__(self, uri, status, detail=''):
+        super().__init__(f'{uri} {status} {detail}'.strip())
+        self.key = f'{uri} {status}'
+
+
+class Recorder:
+    """Every request and session of the run, for the report"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = []  # (end, uri, status, ms, bytes_out, bytes_in)
+        self.sessions = []  # (end, type, outcome, ms, requests)
+        self.finishes = []  # end times of successful /sync/finish
+        self.errors = {}
+        self.active = False
+
+    def request(self, uri, status, ms, sent, received):
+        if not self.active:
+            return
+        now = time.time()
+        with self.lock:
+            self.requests.append((now, uri, status, ms, sent, received))
+            if uri == '/sync/finish' and status == 200:
+                self.finishes.append(now)
+
+    def session(self, kind, outcome, ms, requests, error=None):
+        if not self.active:
+            return
+        with self.lock:
+            self.sessions.append((time.time(), kind, outcome, ms, requests))
+            if error:
+                self.errors[error] = self.errors.get(error, 0) + 1
+
+
+class Client:
+    """One simulated device of one user"""
+
+    def __init__(self, url, name, password, recorder, rng, insecure=False):
+        self.url = urlsplit(url)
+        self.name, self.password = name, password
+        self.recorder = recorder
+        self.rng = rng
+        self.insecure = insecure
+        self.conn = None
+        self.hkey = ''
+        self.session_key = ''
+        self.requests = 0
+        # what the client knows of its collection
+        self.usn = 0
+        self.mod = 0
+        self.scm = 0
+        self.counts = {}
+        self.cards = []  # (cid, nid, did, ord)
+        self.notetype = (0, 2)  # (id, field count) new notes are added with
+        self.crt = 0
+        self.next_id = int(time.time() * 1000)
+        self.media_usn = 0
+        self.media_files = 0
+        self.media_serial = 0
+
+    def new_id(self):
+        # ids are millisecond stamps; one client never hands out the same one twice
+        self.next_id = max(self.next_id + 1, int(time.time() * 1000))
+        return self.next_id
+
+    def connect(self):
+        host, port = self.url.hostname, self.url.port
+        if self.url.scheme == 'https':
+            ctx = ssl._create_unverified_context() if self.insecure else ssl.create_default_context()
+            return http.client.HTTPSConnection(host, port or 443, timeout=300, context=ctx)
+        return http.client.HTTPConnection(host, port or 80, timeout=300)
+
+    def post(self, uri, body=None, raw=None):
+        """POST a JSON body (or raw bytes) and return the decoded response bytes"""
+        data = raw if raw is not None else json.dumps(body if body is not None else {}).encode()
+        payload = compress(data)
+        header = json.dumps({'v': SYNC_VERSION, 'k': self.hkey, 'c': CLIENT_VERSION, 's': self.session_key},
+                            separators=(',', ':'))
+        headers = {'anki-sync': header, 'anki-original-size': str(len(data)),
+                   'Content-Type': 'application/octet-stream'}
+        start = time.perf_counter()
+        status = 0
+        received = b''
+        try:
+            if self.conn is None:
+                self.conn = self.connect()
+                self.conn.connect()
+                # like the desktop client; Nagle would add delayed-ACK stalls to small requests
+                self.conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.conn.request('POST', self.url.path.rstrip('/') + uri, payload, headers)
+            resp = self.conn.getresponse()
+            status = resp.status
+            received = resp.read()
+        except (OSError, http.client.HTTPException) as e:
+            if self.conn is not None:
+                self.conn.close()
+            self.conn = None
+            raise SyncError(uri, 'conn', type(e).__name__) from e
+        finally:
+            self.requests += 1
+            self.recorder.request(uri, status, (time.perf_counter() - start) * 1000, len(payload), len(received))
+        if status != 200:
+            raise SyncError(uri, status, received[:120].decode(errors='replace').strip())
+        if received[:4] == b'\x28\xb5\x2f\xfd':
+            received = decompress(received)
+        return received
+
+    def call(self, uri, body=None):
+        return json.loads(self.post(uri, body) or b'null')
+
+    def media(self, uri, body=None, raw=None):
+        result = json.loads(self.post(uri, body, raw))
+        if result.get('err'):
+            raise SyncError(uri, 'err', result['err'])
+        return result.get('data')
+
+    # -- collection sync ----------------------------------------------------
+
+    def login(self):
+        self.hkey = self.call('/sync/hostKey', {'u': self.name, 'p': self.password})['key']
+
+    def meta(self):
+        return self.call('/sync/meta', {'v': SYNC_VERSION, 'cv': CLIENT_VERSION})
+
+    def full_download(self):
+        data = self.post('/sync/download')
+        with tempfile.NamedTemporaryFile(suffix='.anki2') as f:
+            f.write(data)
+            f.flush()
+            self.load(f.name)
+        return data
+
+    def full_upload(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.post('/sync/upload', raw=data)
+        self.load(path)
+
+    def load(self, path):
+        """Learn ids and counts from a collection file, for later syncs and
+        their sanity checks"""
+        conn = sqlite3.connect(path)
+        try:
+            self.crt, self.scm, self.mod, self.usn = conn.execute('SELECT crt, scm, mod, usn FROM col').fetchone()
+            tables = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            if 'notetypes' in tables:  # schema 18
+                ntid = conn.execute("SELECT id FROM notetypes ORDER BY name != 'Basic', id LIMIT 1").fetchone()[0]
+                fields = conn.execute('SELECT count() FROM fields WHERE ntid = ?', (ntid,)).fetchone()[0]
+                notetypes, decks, dconf = (conn.execute(f'SELECT count() FROM {t}').fetchone()[0]
+                                           for t in ('notetypes', 'decks', 'deck_config'))
+            else:  # schema 11 keeps them as JSON in col
+                models, deck_json, dconf_json = conn.execute('SELECT models, decks, dconf FROM col').fetchone()
+                models = json.loads(models)
+                basic = sorted(models.values(), key=lambda m: (m['name'] != 'Basic', int(m['id'])))[0]
+                ntid, fields = int(basic['id']), len(basic['flds'])
+                notetypes, decks, dconf = len(models), len(json.loads(deck_json)), len(json.loads(dconf_json))
+            self.notetype = (ntid, fields)
+            self.cards = conn.execute('SELECT id, nid, did, ord FROM cards').fetchall()
+            self.counts = {
+                'cards': len(self.cards),
+                'notes': conn.execute('SELECT count() FROM notes').fetchone()[0],
+                'revlog': conn.execute('SELECT count() FROM revlog').fetchone()[0],
+                'graves': conn.execute('SELECT count() FROM graves').fetchone()[0],
+                'notetypes': notetypes, 'decks': decks, 'deck_config': dconf,
+            }
+        finally:
+            conn.close()
+
+    def sanity_counts(self):
+        c = self.counts
+        # due counts are not compared by current servers
+        return [[0, 0, 0], c['cards'], c['notes'], c['revlog'], c['graves'], c['notetypes'], c['decks'],
+                c['deck_config']]
+
+    def note_row(self, nid, text):
+        ntid, fields = self.notetype
+        flds = '\x1f'.join([text] + [f'{text} ({i})' for i in range(1, fields)])
+        return [nid, guid(nid), ntid, int(time.time()), -1, ' loadsim ', flds, '', '', 0, '']
+
+    def card_row(self, cid, nid, did, ordinal, ivl, reps):
+        today = int((time.time() - self.crt) // 86400) if self.crt else 0
+        if ivl:
+            return [cid, nid, did, ordinal, int(time.time()), -1, 2, 2, today + ivl, ivl, 2500, reps, 0, 0, 0, 0, 0, '']
+        return [cid, nid, did, ordinal, int(time.time()), -1, 0, 0, nid % 100000, 0, 0, 0, 0, 0, 0, 0, 0, '']
+
+    def normal_sync(self, server, reviews, adds):
+        """Incremental sync carrying `reviews` answers and `adds` new notes;
+        returns the sanity check's verdict"""
+        self.call('/sync/start', {'minUsn': self.usn, 'lnewer': True, 'graves': None})
+        self.call('/sync/applyChanges', {'changes': {'models': [], 'decks': [[], []], 'tags': []}})
+        while True:
+            chunk = self.call('/sync/chunk')
+            if chunk.get('done', True):
+                break
+
+        revlog, cards, notes = [], [], []
+        for _ in range(reviews if self.cards else 0):
+            cid, nid, did, ordinal = self.rng.choice(self.cards)
+            ivl = self.rng.choice((1, 3, 7, 15, 30, 60))
+            ease = self.rng.choices((1, 2, 3, 4), (10, 15, 65, 10))[0]
+            revlog.append([self.new_id(), cid, -1, ease, ivl, max(1, ivl // 2), 2500,
+                           self.rng.randint(2000, 20000), 1])
+            cards.append(self.card_row(cid, nid, did, ordinal, ivl, self.rng.randint(1, 20)))
+        for _ in range(adds):
+            nid, cid = self.new_id(), self.new_id()
+            notes.append(self.note_row(nid, f'added {nid}'))
+            cards.append(self.card_row(cid, nid, 1, 0, 0, 0))
+            self.cards.append((cid, nid, 1, 0))
+        rows = [('revlog', r) for r in revlog] + [('cards', r) for r in cards] + [('notes', r) for r in notes]
+        for i in range(0, max(1, len(rows)), CHUNK_ROWS):
+            part = rows[i:i + CHUNK_ROWS]
+            chunk = {'done': i + CHUNK_ROWS >= len(rows), 'revlog': [], 'cards': [], 'notes': []}
+            for table, row in part:
+                chunk[table].append(row)
+            self.call('/sync/applyChunk', {'chunk': chunk})
+        self.counts['revlog'] += len(revlog)
+        self.counts['cards'] += adds
+        self.counts['notes'] += adds
+
+        sanity = self.call('/sync/sanityCheck2', {'client': self.sanity_counts()})
+        if sanity.get('status') != 'ok':
+            self.call('/sync/abort')
+            return False
+        self.mod = self.call('/sync/finish')
+        self.usn = server['usn'] + 1
+        return True
+
+    # -- media --------------------------------------------------------------
+
+    def new_media(self, names, size_kb):
+        """Random (incompressible, like images) contents for `names`"""
+        return [(name, self.rng.randbytes(max(1, int(self.rng.expovariate(1 / (size_kb * 1024))))))
+                for name in names]
+
+    def media_sync(self, files=()):
+        """Media sync uploading `files` as (name, data) pairs; returns the
+        sanity check's verdict"""
+        begin = self.media('/msync/begin', {'v': CLIENT_VERSION})
+        server_usn = begin.get('usn', 0)
+        while self.media_usn < server_usn:
+            changes = self.media('/msync/mediaChanges', {'lastUsn': self.media_usn})
+            if not changes:
+                break
+            self.media_usn = max(self.media_usn, max(c[1] for c in changes))
+        batches, batch_bytes = [[]], 0
+        for name, data in files:
+            if batches[-1] and (len(batches[-1]) >= MEDIA_ZIP_FILES or batch_bytes + len(data) > MEDIA_ZIP_BYTES):
+                batches.append([])
+                batch_bytes = 0
+            batches[-1].append((name, data))
+            batch_bytes += len(data)
+        for batch in batches:
+            if batch:
+                processed, self.media_usn = self.media('/msync/uploadChanges', raw=media_zip(batch))
+                self.media_files += processed
+        return self.media('/msync/mediaSanity', {'local': self.media_files}) == 'OK'
+
+
+def guid(nid):
+    return hashlib.sha1(str(nid).encode()).hexdigest()[:10]
+
+
+def field_checksum(text):
+    return int(hashlib.sha1(re.sub(r'<[^>]+>', '', text).encode()).hexdigest()[:8], 16)
+
+
+def media_zip(files):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as z:
+        for i, (_, data) in enumerate(files):
+            z.writestr(str(i), data)
+        z.writestr('_meta', json.dumps([[name, str(i)] for i, (name, _) in enumerate(files)]))
+    return buf.getvalue()
+
+
+def build_collection(template, path, client, notes, history, media_names):
+    """Fill the server's own (empty) collection file with `notes` Basic notes,
+    a card each and `history` past reviews per card, so the upload is one the
+    server accepts"""
+    with open(path, 'wb') as f:
+        f.write(template)
+    client.load(path)
+    ntid, fields = client.notetype
+    conn = sqlite3.connect(path)
+    try:
+        now = int(time.time())
+        base = (now - 365 * 86400) * 1000
+        note_rows, card_rows, revlog_rows = [], [], []
+        for i in range(notes):
+            nid = cid = base + i
+            front = f'loadsim {client.name} note {i} ' + 'lorem ipsum ' * client.rng.randint(1, 12)
+            if i < len(media_names):
+                front += f'<img src="{media_names[i]}">'
+            flds = '\x1f'.join([front] + [f'back of {i} ' + 'dolor sit amet ' * client.rng.randint(1, 20)
+                                          for _ in range(1, fields)])
+            note_rows.append((nid, guid(nid), ntid, now, -1, ' loadsim ', flds, re.sub(r'<[^>]+>', '', front),
+                              field_checksum(front), 0, ''))
+            ivl = client.rng.choice((0, 1, 4, 10, 25, 60, 120)) if history else 0
+            card_rows.append((cid, nid, 1, 0, now, -1, 2 if ivl else 0, 2 if ivl else 0,
+                              client.rng.randint(0, 400) if ivl else i, ivl, 2500 if ivl else 0,
+                              history if ivl else 0, 0, 0, 0, 0, 0, ''))
+            if ivl:
+                for r in range(history):
+                    revlog_rows.append((base + notes + len(revlog_rows), cid, -1, client.rng.choice((1, 3, 3, 3, 4)),
+                                        ivl, max(1, ivl // 2), 2500, client.rng.randint(2000, 20000), 1))
+        conn.executemany('INSERT INTO notes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', note_rows)
+        conn.executemany('INSERT INTO cards VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', card_rows)
+        conn.executemany('INSERT INTO revlog VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', revlog_rows)
+        conn.execute('UPDATE col SET mod = ?', (now * 1000,))
+        conn.commit()
+        client.next_id = max(client.next_id, base + notes + len(revlog_rows))
+    finally:
+        conn.close()
+
+
+def size_range(value):
+    """'2000' or '500-20000' (drawn log-uniformly per user)"""
+    lo, _, hi = value.partition('-')
+    lo, hi = int(lo), int(hi or lo)
+    if lo < 0 or hi < lo:
+        raise argparse.ArgumentTypeError(f'bad range: {value}')
+    return lo, hi
+
+
+def draw(rng, bounds):
+    lo, hi = bounds
+    if lo == hi or hi <= 0:
+        return lo
+    return int(round(math.exp(rng.uniform(math.log(max(lo, 1)), math.log(hi)))))
+
+
+def schedule(args, users, rng):
+    """Session start offsets per user, sorted"""
+    plan = {}
+    for user in range(users):
+        times = []
+        for _ in range(args.syncs_per_user):
+            if args.pattern == 'burst' and rng.random() < args.burst_share:
+                window = args.duration * args.burst_window
+                t = min(window, max(0.0, rng.gauss(window / 2, window / 6)))
+            elif args.pattern == 'ramp':
+                t = args.duration * math.sqrt(rng.random())
+            else:
+                t = rng.uniform(0, args.duration)
+            times.append(t)
+        plan[user] = sorted(times)
+    return plan
+
+
+# -- private stack ----------------------------------------------------------
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, proc, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            return False
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+class Stack:
+    """anki-sync-server, monitor.py and metrics.py started as entrypoint.sh
+    starts them, in a private directory and on free ports"""
+
+    def __init__(self, workdir, accounts, server_bin, metrics=True):
+        self.workdir = workdir
+        for d in ('data', 'log', 'state', 'config', 'backups'):
+            os.makedirs(os.path.join(workdir, d), exist_ok=True)
+        self.port = free_port()
+        self.metrics_port = free_port() if metrics else None
+        env = {k: v for k, v in os.environ.items() if not re.match(r'^SYNC_USER\d+(_FILE)?$', k)}
+        env.pop('PASSWORDS_HASHED', None)
+        env.update(
+            SYNC_BASE=os.path.join(workdir, 'data'), SYNC_HOST='127.0.0.1', SYNC_PORT=str(self.port),
+            SYNC_SHARDS='1', LOG_DIR=os.path.join(workdir, 'log'), STATE_DIR=os.path.join(workdir, 'state'),
+            SERVER_LOG=os.path.join(workdir, 'log', 'server.log'),
+            CADDY_LOG=os.path.join(workdir, 'log', 'caddy.log'),
+            USER_DB=os.path.join(workdir, 'config', 'users.db'), BACKUP_DIR=os.path.join(workdir, 'backups'),
+            METRICS_PORT=str(self.metrics_port or 0))
+        for i, (name, password) in enumerate(accounts, 1):
+            env[f'SYNC_USER{i}'] = f'{name}:{password}'
+        self.env = env
+        self.state_dir = env['STATE_DIR']
+        self.data_dir = env['SYNC_BASE']
+        for name in ('server.log', 'caddy.log'):
+            open(os.path.join(workdir, 'log', name), 'a').close()
+        for name in ('sync_count.txt', 'bytes_synced.txt'):
+            with open(os.path.join(self.state_dir, name), 'w') as f:
+                f.write('0\n')
+        subprocess.run([sys.executable, os.path.join(SCRIPTS, 'userstore.py'), 'seed'], env=env, check=True,
+                       stdout=subprocess.DEVNULL)
+        self.procs = {}
+        with open(env['SERVER_LOG'], 'ab') as out:
+            self.procs['server'] = subprocess.Popen([server_bin], env=env, stdout=out, stderr=subprocess.STDOUT)
+        if not wait_for_port(self.port, self.procs['server']):
+            self.stop()
+            raise RuntimeError(f'anki-sync-server did not start; see {env["SERVER_LOG"]}')
+        self.spawn('monitor', 'monitor.py')
+        if metrics:
+            self.spawn('metrics', 'metrics.py')
+            wait_for_port(self.metrics_port, self.procs['metrics'], 30)
+
+    def spawn(self, name, script):
+        with open(os.path.join(self.workdir, 'log', f'{name}.log'), 'ab') as out:
+            self.procs[name] = subprocess.Popen([sys.executable, os.path.join(SCRIPTS, script)], env=self.env,
+                                                stdout=out, stderr=subprocess.STDOUT)
+
+    def stop(self):
+        for proc in self.procs.values():
+            if proc.poll() is None:
+                proc.send_signal(signal.SIGTERM)
+        for proc in self.procs.values():
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+# -- sampling ---------------------------------------------------------------
+
+def server_pids():
+    pids = []
+    for pid in os.listdir('/proc'):
+        if pid.isdigit():
+            try:
+                with open(f'/proc/{pid}/comm') as f:
+                    if f.read().strip().startswith('anki-sync-serv'):
+                        pids.append(int(pid))
+            except OSError:
+                pass
+    return pids
+
+
+def proc_sample(pids):
+    """Summed RSS bytes, CPU seconds and storage read/write bytes of `pids`;
+    I/O is None where /proc/PID/io can't be read (another user's process)"""
+    rss = cpu = 0
+    io_bytes = [0, 0]
+    readable = True
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss += int(line.split()[1]) * 1024
+            with open(f'/proc/{pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+                cpu += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        except (OSError, ValueError, IndexError):
+            continue
+        try:
+            with open(f'/proc/{pid}/io') as f:
+                stats = dict(line.split(': ') for line in f.read().splitlines())
+            io_bytes[0] += int(stats['read_bytes'])
+            io_bytes[1] += int(stats['write_bytes'])
+        except (OSError, ValueError, KeyError):
+            readable = False
+    return rss, cpu, io_bytes if readable and pids else None
+
+
+def read_monitor_count(state_dir):
+    try:
+        with open(os.path.join(state_dir, 'sync_count.txt')) as f:
+            return int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return None
+
+
+def read_exporter_count(url):
+    try:
+        with urlopen(url, timeout=5) as r:
+            text = r.read().decode()
+    except (OSError, ValueError):
+        return None
+    return sum(float(m.group(1)) for m in re.finditer(r'^anki_sync_requests_total\{[^}]*\} (\S+)$', text, re.M))
+
+
+class Sampler(threading.Thread):
+    def __init__(self, pids, state_dir, metrics_url, interval):
+        super().__init__(daemon=True)
+        self.pids = pids
+        self.state_dir = state_dir
+        self.metrics_url = metrics_url
+        self.interval = interval
+        self.samples = []  # (t, rss, cpu, io, monitor_count, exporter_count)
+        self.stopping = threading.Event()
+
+    def sample(self):
+        pids = self.pids() if callable(self.pids) else self.pids
+        rss, cpu, io_bytes = proc_sample(pids)
+        monitor = read_monitor_count(self.state_dir) if self.state_dir else None
+        exporter = read_exporter_count(self.metrics_url) if self.metrics_url else None
+        self.samples.append((time.time(), rss, cpu, io_bytes, monitor, exporter))
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.sample()
+            self.stopping.wait(self.interval)
+
+
+def lag(completions, observed, baseline):
+    """Seconds from each completion until the observed counter covered it"""
+    samples = [(t, v - baseline) for t, v in observed if v is not None]
+    lags, missing, j = [], 0, 0
+    for k, done in enumerate(sorted(completions), 1):
+        while j < len(samples) and samples[j][1] < k:
+            j += 1
+        if j == len(samples):
+            missing += 1
+            continue
+        # a sample can predate the client's own clock reading by a little
+        lags.append(max(0.0, samples[j][0] - done))
+    return summary(lags, 's', extra={'missing': missing})
+
+
+def summary(values, unit, extra=None):
+    result = {'count': len(values)}
+    if values:
+        result.update({f'p50_{unit}': round(percentile(values, 0.5), 3),
+                       f'p90_{unit}': round(percentile(values, 0.9), 3),
+                       f'p99_{unit}': round(percentile(values, 0.99), 3),
+                       f'max_{unit}': round(max(values), 3),
+                       f'mean_{unit}': round(sum(values) / len(values), 3)})
+    result.update(extra or {})
+    return result
+
+
+# -- run --------------------------------------------------------------------
+
+def setup_user(client, args, recorder):
+    """Login, seed the collection and the initial media; not timed"""
+    client.login()
+    meta = client.meta()
+    media_names = []
+    if meta.get('empty'):
+        template = client.full_download()
+        n_media = draw(client.rng, args.media_files)
+        media_names = [f'loadsim-{client.name}-init-{i}.jpg' for i in range(n_media)]
+        path = os.path.join(args.tmp, f'{client.name}.anki2')
+        build_collection(template, path, client, draw(client.rng, args.notes), args.history, media_names)
+        client.full_upload(path)
+        os.unlink(path)
+    else:
+        client.full_download()
+    if args.media:
+        client.media_sync(client.new_media(media_names, args.media_kb))
+
+
+def run_session(client, args):
+    """One sync session; returns its type and raises SyncError on failure"""
+    rng = client.rng
+    if rng.random() < args.login_ratio:
+        client.login()
+    meta = client.meta()
+    if meta.get('scm') != client.scm or rng.random() < args.full_download_ratio:
+        client.full_download()
+        kind = 'full_download'
+    else:
+        reviews = int(rng.expovariate(1 / args.reviews)) if args.reviews and rng.random() >= args.idle_ratio else 0
+        adds = int(rng.expovariate(1 / args.adds)) if args.adds and reviews else 0
+        if reviews or adds:
+            if not client.normal_sync(meta, reviews, adds):
+                raise SyncError('/sync/sanityCheck2', 'bad')
+            kind = 'normal'
+        else:
+            kind = 'check'
+    if args.media:
+        names = []
+        if rng.random() < args.media_add_ratio:
+            for _ in range(rng.randint(1, 3)):
+                client.media_serial += 1
+                names.append(f'loadsim-{client.name}-{client.media_serial}-{rng.getrandbits(32):08x}.jpg')
+        if not client.media_sync(client.new_media(names, args.media_kb)):
+            raise SyncError('/msync/mediaSanity', 'failed')
+    return kind
+
+
+def user_loop(client, times, start, args, recorder, late):
+    for offset in times:
+        delay = start + offset - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -1:
+            late.append(-delay)  # the previous session overran this one's slot
+        began = time.perf_counter()
+        before = client.requests
+        try:
+            kind = run_session(client, args)
+            outcome, error = 'ok', None
+        except SyncError as e:
+            kind, outcome, error = 'failed', 'error', e.key
+        except (ValueError, KeyError, TypeError, sqlite3.Error) as e:
+            kind, outcome, error = 'failed', 'error', f'{type(e).__name__}: {e}'
+        recorder.session(kind, outcome, (time.perf_counter() - began) * 1000, client.requests - before, error)
+
+
+def build_report(args, recorder, sampler, start, end, baselines, stack, setup_seconds, late):
+    elapsed = max(end - start, 1e-9)
+    requests = recorder.requests
+    by_uri = {}
+    for _, uri, status, ms, _, _ in requests:
+        by_uri.setdefault(uri, []).append((status, ms))
+    endpoints = {uri: summary([ms for _, ms in rows], 'ms',
+                              extra={'errors': sum(1 for s, _ in rows if s != 200)})
+                 for uri, rows in sorted(by_uri.items())}
+    by_type = {}
+    for _, kind, outcome, ms, _ in recorder.sessions:
+        by_type.setdefault(kind, []).append(ms)
+    ok = sum(1 for s in recorder.sessions if s[2] == 'ok')
+
+    timeline = []
+    step = args.interval
+    for i in range(int(math.ceil(elapsed / step))):
+        lo, hi = start + i * step, start + (i + 1) * step
+        window = [r for r in requests if lo <= r[0] < hi]
+        rss = [s[1] for s in sampler.samples if lo <= s[0] < hi]
+        timeline.append({
+            't': round(i * step, 1),
+            'requests': len(window),
+            'errors': sum(1 for r in window if r[2] != 200),
+            'sessions': sum(1 for s in recorder.sessions if lo <= s[0] < hi),
+            'p50_ms': round(percentile([r[3] for r in window], 0.5), 1),
+            'p99_ms': round(percentile([r[3] for r in window], 0.99), 1),
+            'rss_mb': round(max(rss) / 1048576, 1) if rss else None,
+        })
+
+    during = [s for s in sampler.samples if start <= s[0] <= end] or sampler.samples
+    server = {}
+    if during:
+        first, last = during[0], during[-1]
+        rss = [s[1] for s in during]
+        server = {
+            'rss_peak_mb': round(max(rss) / 1048576, 1),
+            'rss_mean_mb': round(sum(rss) / len(rss) / 1048576, 1),
+            'cpu_seconds': round(last[2] - first[2], 2),
+            'cpu_utilization': round((last[2] - first[2]) / elapsed, 3),
+            'read_bytes': last[3][0] - first[3][0] if first[3] and last[3] else None,
+            'write_bytes': last[3][1] - first[3][1] if first[3] and last[3] else None,
+        }
+    if stack:
+        server['data_bytes'] = sum(os.path.getsize(os.path.join(d, f))
+                                   for d, _, files in os.walk(stack.data_dir) for f in files)
+
+    lags = {}
+    if baselines['monitor'] is not None:
+        lags['monitor'] = lag(recorder.finishes, [(s[0], s[4]) for s in sampler.samples], baselines['monitor'])
+    if baselines['exporter'] is not None:
+        lags['exporter'] = lag([r[0] for r in requests],
+                               [(s[0], s[5]) for s in sampler.samples], baselines['exporter'])
+
+    settings = {k: v for k, v in vars(args).items() if k not in ('func', 'tmp', 'accounts')}
+    settings['env'] = {k: v for k, v in sorted(os.environ.items())
+                       if k.startswith(SETTING_PREFIXES) and not SECRET.search(k)}
+    try:
+        with open('/anki_version.txt') as f:
+            anki_version = f.read().strip()
+    except OSError:
+        anki_version = 'unknown'
+    return {
+        'version': REPORT_VERSION,
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(start)),
+        'anki_version': anki_version,
+        'host': socket.gethostname(),
+        'target': args.url or 'private stack',
+        'zstd': 'zstandard' if zstandard else 'cli',
+        'settings': settings,
+        'setup_seconds': round(setup_seconds, 1),
+        'duration_seconds': round(elapsed, 1),
+        'sessions': {
+            'total': len(recorder.sessions),
+            'ok': ok,
+            'failed': len(recorder.sessions) - ok,
+            'per_second': round(len(recorder.sessions) / elapsed, 3),
+            'late_starts': len(late),
+            'late_p90_s': round(percentile(late, 0.9), 2),
+            'by_type': {k: summary(v, 'ms') for k, v in sorted(by_type.items())},
+        },
+        'requests': {
+            'total': len(requests),
+            'errors': sum(1 for r in requests if r[2] != 200),
+            'per_second': round(len(requests) / elapsed, 2),
+            'bytes_sent': sum(r[4] for r in requests),
+            'bytes_received': sum(r[5] for r in requests),
+            'latency': summary([r[3] for r in requests], 'ms'),
+            'by_endpoint': endpoints,
+        },
+        'errors': dict(sorted(recorder.errors.items(), key=lambda e: -e[1])[:20]),
+        'server': server,
+        'lag': lags,
+        'timeline': timeline,
+    }
+
+
+def read_accounts(path):
+    accounts = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                name, _, password = line.split('=', 1)[-1].partition(':')
+                accounts.append((name, password))
+    return accounts
+
+
+def cmd_run(args):
+    rng = random.Random(args.seed)
+    stack = None
+    workdir = args.workdir or tempfile.mkdtemp(prefix='loadsim-')
+    args.tmp = os.path.join(workdir, 'tmp')
+    os.makedirs(args.tmp, exist_ok=True)
+    if args.url:
+        accounts = read_accounts(args.accounts)[:args.users] if args.accounts else []
+        if not accounts:
+            log('--url needs --accounts with name:password lines')
+            return 2
+        args.users = len(accounts)
+        url = args.url
+        pids = server_pids
+        state_dir = args.state_dir
+        metrics_url = args.metrics_url
+    else:
+        server_bin = args.server_bin or shutil.which('anki-sync-server')
+        if not server_bin:
+            log('anki-sync-server not found; pass --server-bin or --url')
+            return 2
+        accounts = [(f'loadsim{i:04d}', f'pw{rng.getrandbits(48):012x}') for i in range(args.users)]
+        log(f'Starting a private stack in {workdir}')
+        stack = Stack(workdir, accounts, server_bin, metrics=not args.no_metrics)
+        url = f'http://127.0.0.1:{stack.port}'
+        pids = [stack.procs['server'].pid]
+        state_dir = stack.state_dir
+        metrics_url = f'http://127.0.0.1:{stack.metrics_port}/metrics' if stack.metrics_port else None
+
+    recorder = Recorder()
+    clients = [Client(url, name, password, recorder, random.Random(rng.getrandbits(64)), args.insecure)
+               for name, password in accounts]
+    try:
+        log(f'Setting up {len(clients)} users')
+        began = time.time()
+        failed = []
+
+        def setup(client):
+            try:
+                setup_user(client, args, recorder)
+            except (SyncError, ValueError, KeyError, TypeError, sqlite3.Error) as e:
+                failed.append(client)
+                log(f'{client.name}: setup failed: {e}')
+
+        with ThreadPoolExecutor(args.setup_concurrency) as pool:
+            list(pool.map(setup, clients))
+        clients = [c for c in clients if c not in failed]
+        if not clients:
+            log('every user failed setup')
+            return 1
+        setup_seconds = time.time() - began
+
+        sampler = Sampler(pids, state_dir, metrics_url, args.sample_interval)
+        sampler.sample()
+        baselines = {'monitor': sampler.samples[-1][4], 'exporter': sampler.samples[-1][5]}
+        plan = schedule(args, len(clients), rng)
+        late = []
+        log(f'Running {sum(len(t) for t in plan.values())} sessions over {args.duration}s ({args.pattern})')
+        recorder.active = True
+        sampler.start()
+        start = time.time()
+        threads = [threading.Thread(target=user_loop, args=(c, plan[i], start, args, recorder, late), daemon=True)
+                   for i, c in enumerate(clients)]
+        for t in threads:
+            t.start()
+        progress = start + PROGRESS_INTERVAL
+        for t in threads:
+            while t.is_alive():
+                t.join(max(0.05, progress - time.time()))
+                if time.time() >= progress:
+                    progress += PROGRESS_INTERVAL
+                    log(f'{int(time.time() - start)}s: {len(recorder.sessions)} sessions, '
+                        f'{len(recorder.requests)} requests, '
+                        f'{sum(1 for r in recorder.requests if r[2] != 200)} errors')
+        end = time.time()
+        recorder.active = False
+
+        # let monitor.py and the exporter catch up before measuring their lag
+        deadline = end + args.lag_grace
+        while time.time() < deadline:
+            last = sampler.samples[-1]
+            caught_up = ((baselines['monitor'] is None or last[4] is None
+                          or last[4] - baselines['monitor'] >= len(recorder.finishes))
+                         and (baselines['exporter'] is None or last[5] is None
+                              or last[5] - baselines['exporter'] >= len(recorder.requests)))
+            if caught_up:
+                break
+            time.sleep(args.sample_interval)
+        sampler.stopping.set()
+        sampler.join()
+
+        report = build_report(args, recorder, sampler, start, end, baselines, stack, setup_seconds, late)
+    finally:
+        for c in clients:
+            if c.conn:
+                c.conn.close()
+        if stack:
+            stack.stop()
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    path = args.report or f'loadsim-{time.strftime("%Y%m%d-%H%M%S")}.json'
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp, path)
+    print_summary(report)
+    print(f'report: {path}')
+    return 0 if report['sessions']['ok'] else 1
+
+
+def print_summary(report):
+    s, r, server = report['sessions'], report['requests'], report['server']
+    print(f'sessions: {s["ok"]}/{s["total"]} ok, {s["per_second"]}/s, {s["late_starts"]} started late')
+    print(f'requests: {r["total"]}, {r["per_second"]}/s, {r["errors"]} errors, '
+          f'p50 {r["latency"].get("p50_ms", 0)} ms, p99 {r["latency"].get("p99_ms", 0)} ms')
+    for uri, e in r['by_endpoint'].items():
+        print(f'  {uri:24} {e["count"]:>7}  p50 {e.get("p50_ms", 0):>8} ms  p99 {e.get("p99_ms", 0):>8} ms  '
+              f'errors {e["errors"]}')
+    for kind, e in s['by_type'].items():
+        print(f'  session {kind:16} {e["count"]:>5}  p50 {e.get("p50_ms", 0):>8} ms  p99 {e.get("p99_ms", 0):>8} ms')
+    if server:
+        print(f'server: RSS peak {server.get("rss_peak_mb")} MB, CPU {server.get("cpu_seconds")}s, '
+              f'read {server.get("read_bytes")} B, written {server.get("write_bytes")} B')
+    for name, e in report['lag'].items():
+        print(f'{name} lag: p50 {e.get("p50_s", "-")}s, max {e.get("max_s", "-")}s, {e["missing"]} never seen')
+    for error, n in report['errors'].items():
+        print(f'error: {error} x{n}')
+
+
+def flatten(data, prefix=''):
+    out = {}
+    for k, v in data.items():
+        key = f'{prefix}{k}'
+        if isinstance(v, dict):
+            out.update(flatten(v, key + '.'))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            out[key] = v
+    return out
+
+
+def cmd_compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print(f'old: {args.old} (Anki {old.get("anki_version")}, {old.get("started")})')
+    print(f'new: {args.new} (Anki {new.get("anki_version")}, {new.get("started")})')
+    settings = flatten(old.get('settings', {}))
+    for key, value in flatten(new.get('settings', {})).items():
+        if settings.get(key) != value:
+            print(f'setting {key}: {settings.get(key)} -> {value}')
+    a = flatten({k: v for k, v in old.items() if k not in ('settings', 'timeline')})
+    b = flatten({k: v for k, v in new.items() if k not in ('settings', 'timeline')})
+    for key in sorted(a.keys() & b.keys()):
+        if key == 'version':
+            continue
+        change = f'{(b[key] - a[key]) * 100 / a[key]:+.1f}%' if a[key] else ''
+        print(f'{key:50} {a[key]:>14} {b[key]:>14} {change:>9}')
+    return 0
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='cmd', required=True)
+
+    run = sub.add_parser('run', help='simulate clients and write a report')
+    run.add_argument('--users', type=int, default=20)
+    run.add_argument('--syncs-per-user', type=int, default=3)
+    run.add_argument('--duration', type=float, default=300, help='seconds the sessions are spread over')
+    run.add_argument('--pattern', choices=('steady', 'burst', 'ramp'), default='steady')
+    run.add_argument('--burst-share', type=float, default=0.8)
+    run.add_argument('--burst-window', type=float, default=0.2, help='share of the run the burst lasts')
+    run.add_argument('--notes', type=size_range, default=(2000, 2000), help='notes per user, N or MIN-MAX')
+    run.add_argument('--history', type=int, default=3, help='past reviews per studied card')
+    run.add_argument('--reviews', type=float, default=100, help='mean answers per normal sync')
+    run.add_argument('--adds', type=float, default=5, help='mean notes added per normal sync')
+    run.add_argument('--idle-ratio', type=float, default=0.2, help='share of sessions with nothing to sync')
+    run.add_argument('--full-download-ratio', type=float, default=0.02)
+    run.add_argument('--login-ratio', type=float, default=0.1, help='share of sessions that log in again')
+    run.add_argument('--no-media', dest='media', action='store_false')
+    run.add_argument('--media-files', type=size_range, default=(20, 20), help='initial files per user, N or MIN-MAX')
+    run.add_argument('--media-kb', type=float, default=60, help='mean media file size')
+    run.add_argument('--media-add-ratio', type=float, default=0.3, help='share of sessions adding media')
+    run.add_argument('--url', help='load a running server instead of a private stack')
+    run.add_argument('--accounts', help='name:password lines for --url')
+    run.add_argument('--state-dir', default=os.environ.get('STATE_DIR', '/var/lib/anki'),
+                     help="monitor.py's state directory, for --url")
+    run.add_argument('--metrics-url', default=(f'http://127.0.0.1:{os.environ.get("METRICS_PORT", 9090)}/metrics'
+                                               if os.environ.get('METRICS_ENABLED') == 'true' else None),
+                     help='exporter to measure lag against, for --url')
+    run.add_argument('--insecure', action='store_true', help="don't verify TLS certificates")
+    run.add_argument('--server-bin', help='anki-sync-server binary for the private stack')
+    run.add_argument('--no-metrics', action='store_true', help="don't start metrics.py in the private stack")
+    run.add_argument('--workdir', help='directory for the private stack (kept)')
+    run.add_argument('--keep', action='store_true', help='keep the temporary work directory')
+    run.add_argument('--setup-concurrency', type=int, default=8)
+    run.add_argument('--sample-interval', type=float, default=1)
+    run.add_argument('--interval', type=float, default=10, help='timeline resolution in seconds')
+    run.add_argument('--lag-grace', type=float, default=30, help='seconds to wait for monitor and exporter')
+    run.add_argument('--seed', type=int, default=1)
+    run.add_argument('--report', help='JSON report path')
+    run.set_defaults(func=cmd_run)
+
+    compare = sub.add_parser('compare', help='compare two reports')
+    compare.add_argument('old')
+    compare.add_argument('new')
+    compare.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args(argv[1:])
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
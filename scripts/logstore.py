@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""Rotating log segments for /var/log/anki.
+
+auth.log is the live file, auth.log.1 the newest sealed segment (kept plain so
+fail2ban and tail-style readers can finish it), older segments are compressed
+as auth.log.<stamp>.zst (or .gz). A hidden manifest per log records line and
+tag counts of every sealed segment, so counting AUTH_FAILED across history
+never decompresses anything.
+"""
+
+import collections
+import gzip
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+LOG_DIR = os.environ.get('LOG_DIR', '/var/log/anki')
+MAX_BYTES = int(float(os.environ.get('LOG_MAX_SIZE_MB', 10)) * 1024 * 1024)
+MAX_AGE = int(float(os.environ.get('LOG_MAX_AGE_HOURS', 24)) * 3600)
+KEEP = int(os.environ.get('LOG_KEEP_SEGMENTS', 10))
+KEEP_DAYS = int(os.environ.get('LOG_RETENTION_DAYS', 30))
+COMPRESS = os.environ.get('LOG_COMPRESS', 'auto')
+INTERVAL = int(os.environ.get('LOG_ROTATE_INTERVAL', 60))
+
+# server.log, caddy.log and maintenance.log are held open by their writers
+# (the daemon's redirected stderr), so they are copied and truncated in place;
+# everything else is appended line by line and renamed
+COPYTRUNCATE = {'server.log', 'caddy.log', 'maintenance.log'}
+LOGS = ('auth.log', 'devices.log', 'latency.log', 'sync.log', 'server.log',
+        'backup.log', 'email.log', 'caddy.log', 'maintenance.log', 'sessions.log')
+
+_TAG = re.compile(r'^\[[^\]]*\] ([A-Z][A-Z_]+)\b')
+_SEGMENT = re.compile(r'^\d{8}-\d{6}(\.zst|\.gz)?$')
+_MAX_TAGS = 32
+
+
+def codec():
+    if COMPRESS in ('zstd', 'auto') and shutil.which('zstd'):
+        return 'zst'
+    if COMPRESS == 'none':
+        return None
+    return 'gz'
+
+
+def _manifest_path(path):
+    head, name = os.path.split(path)
+    return os.path.join(head, f'.{name}.segments.json')
+
+
+def load_manifest(path):
+    try:
+        with open(_manifest_path(path)) as f:
+            data = json.load(f)
+        data.setdefault('segments', {})
+        return data
+    except (OSError, ValueError):
+        return {'opened': None, 'segments': {}}
+
+
+def _save_manifest(path, data):
+    target = _manifest_path(path)
+    tmp = f'{target}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, target)
+
+
+def segments(path):
+    """Sealed segments, newest first"""
+    head, name = os.path.split(path)
+    newest = f'{path}.1'
+    older = []
+    try:
+        for entry in os.listdir(head or '.'):
+            if entry.startswith(name + '.') and _SEGMENT.match(entry[len(name) + 1:]):
+                older.append(os.path.join(head, entry))
+    except OSError:
+        pass
+    older.sort(reverse=True)
+    return ([newest] if os.path.exists(newest) else []) + older
+
+
+def _iter_lines(path):
+    if path.endswith('.zst'):
+        proc = subprocess.Popen(['zstd', '-dcq', path], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, text=True, errors='replace')
+        try:
+            yield from proc.stdout
+        finally:
+            proc.stdout.close()
+            proc.wait()
+        return
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', errors='replace') as f:
+        yield from f
+
+
+def _tail_plain(path, n, block=65536):
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            pos = f.tell()
+            data = b''
+            while pos > 0 and data.count(b'\n') <= n:
+                step = min(block, pos)
+                pos -= step
+                f.seek(pos)
+                data = f.read(step) + data
+    except OSError:
+        return []
+    lines = data.decode(errors='replace').splitlines()
+    return lines[-n:] if n else []
+
+
+def tail_lines(path, n=100):
+    """Last n lines across the live file and as many segments as it takes"""
+    lines = _tail_plain(path, n)
+    for seg in segments(path):
+        need = n - len(lines)
+        if need <= 0:
+            break
+        if seg.endswith(('.zst', '.gz')):
+            try:
+                older = list(collections.deque((l.rstrip('\n') for l in _iter_lines(seg)), maxlen=need))
+            except OSError:
+                older = []
+        else:
+            older = _tail_plain(seg, need)
+        lines = older + lines
+    return lines
+
+
+def _count(path):
+    lines = 0
+    tags = collections.Counter()
+    try:
+        for line in _iter_lines(path):
+            lines += 1
+            m = _TAG.match(line)
+            if m and (m.group(1) in tags or len(tags) < _MAX_TAGS):
+                tags[m.group(1)] += 1
+    except OSError:
+        pass
+    return lines, dict(tags)
+
+
+def count_tagged(path, tag):
+    """Lines tagged `[ts] TAG ...` in the live file plus every retained segment"""
+    total = sum(s.get('tags', {}).get(tag, 0) for s in load_manifest(path)['segments'].values())
+    needle = f'] {tag}'
+    try:
+        with open(path, errors='replace') as f:
+            for line in f:
+                if needle in line:
+                    m = _TAG.match(line)
+                    total += bool(m and m.group(1) == tag)
+    except OSError:
+        pass
+    return total
+
+
+def _compress(src, dest, kind):
+    tmp = f'{dest}.tmp'
+    if kind == 'zst':
+        subprocess.run(['zstd', '-q', '-f', '-19', '-T0', src, '-o', tmp], check=True)
+    else:
+        with open(src, 'rb') as fin, gzip.open(tmp, 'wb', compresslevel=6) as fout:
+            shutil.copyfileobj(fin, fout)
+    shutil.copystat(src, tmp)
+    os.replace(tmp, dest)
+    os.unlink(src)
+
+
+def rotate(path, now=None):
+    """Seal the live file if it is too big or too old; returns True if rotated"""
+    now = now or time.time()
+    manifest = load_manifest(path)
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return False
+    if manifest.get('opened') is None:
+        manifest['opened'] = now
+        _save_manifest(path, manifest)
+    if size == 0 or (size < MAX_BYTES and now - manifest['opened'] < MAX_AGE):
+        return False
+
+    sealed = f'{path}.1'
+    kind = codec()
+    if os.path.exists(sealed) and os.path.getsize(sealed) == 0:
+        os.unlink(sealed)
+        manifest['segments'].pop(os.path.basename(sealed), None)
+    elif os.path.exists(sealed):
+        meta = manifest['segments'].pop(os.path.basename(sealed), {})
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(meta.get('sealed', now)))
+        if kind:
+            dest = f'{path}.{stamp}.{kind}'
+            _compress(sealed, dest, kind)
+        else:
+            dest = f'{path}.{stamp}'
+            os.replace(sealed, dest)
+        manifest['segments'][os.path.basename(dest)] = meta
+
+    if os.path.basename(path) in COPYTRUNCATE:
+        shutil.copy2(path, sealed)
+        with open(path, 'r+b') as f:
+            f.truncate(0)
+    else:
+        os.replace(path, sealed)
+        open(path, 'a').close()
+
+    lines, tags = _count(sealed)
+    manifest['segments'][os.path.basename(sealed)] = {'sealed': now, 'lines': lines, 'tags': tags}
+    manifest['opened'] = now
+    prune(path, manifest, now)
+    _save_manifest(path, manifest)
+    return True
+
+
+def prune(path, manifest, now):
+    head = os.path.dirname(path)
+    for i, seg in enumerate(segments(path)):
+        name = os.path.basename(seg)
+        sealed = manifest['segments'].get(name, {}).get('sealed', now)
+        if i >= KEEP or now - sealed > KEEP_DAYS * 86400:
+            try:
+                os.unlink(seg)
+            except OSError:
+                pass
+            manifest['segments'].pop(name, None)
+    # forget segments that were removed by hand
+    for name in list(manifest['segments']):
+        if not os.path.exists(os.path.join(head, name)):
+            del manifest['segments'][name]
+
+
+def rotate_all():
+    for name in LOGS:
+        path = os.path.join(LOG_DIR, name)
+        try:
+            rotate(path)
+        except Exception as e:
+            print(f'[{time.strftime("%Y-%m-%d %H:%M:%S")}] [LOGROTATE] {name}: {e}', file=sys.stderr)
+
+
+def main(argv):
+    cmd = argv[1] if len(argv) > 1 else 'daemon'
+    if cmd == 'daemon':
+        while True:
+            rotate_all()
+            time.sleep(INTERVAL)
+    elif cmd == 'once':
+        rotate_all()
+    elif cmd == 'tail' and len(argv) >= 3:
+        print('\n'.join(tail_lines(argv[2], int(argv[3]) if len(argv) > 3 else 100)))
+    elif cmd == 'count' and len(argv) == 4:
+        print(count_tagged(argv[2], argv[3]))
+    else:
+        print('Usage: logstore.py [daemon|once|tail FILE [N]|count FILE TAG]', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""Idle-time maintenance of users' collections.
+
+Every MAINT_INTERVAL seconds, each user whose collection.anki2 is due (not
+maintained in MAINT_EVERY_HOURS) and idle (not mid-sync according to
+monitor.py's sync_activity.json, and the collection and its -wal untouched
+for MAINT_IDLE_MINUTES) gets, in order:
+
+  PRAGMA wal_checkpoint(TRUNCATE)   fold the WAL back into the database
+  ANALYZE                           first time, then every MAINT_ANALYZE_DAYS
+  PRAGMA optimize                   cheap; re-analyzes tables that need it
+  VACUUM                            when free pages are at least
+                                    MAINT_VACUUM_FREE_RATIO of the file and
+                                    MAINT_VACUUM_MIN_MB, and the disk has room
+
+Everything runs under a short busy timeout, so a collection the server has
+open is skipped and retried next pass. Nothing runs while a backup holds
+backup.lock or a restore holds the supervisor; each collection is worked on
+under a shared lock on backup.lock, so a backup or restore starting meanwhile
+waits for it to be left alone. A waiting backup or restore leaves
+backup.lock.pending.<pid>, and no further user is started until it is gone.
+At most
+MAINT_CONCURRENCY users are worked on at once, with only one VACUUM at a
+time. Per-user results go to maintenance.json in STATE_DIR for the exporter.
+
+Each maintained user's media folder is also checked for orphaned files (see
+mediarefs.py), and quarantined ones past their retention are deleted.
+
+  maintenance.py daemon | once [USER...] | status
+"""
+
+import fcntl
+import glob
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import mediarefs
+import shards
+import userstore
+from monitor import BACKUP_LOCK, backup_running
+
+STATE_DIR = os.environ.get('STATE_DIR', '/var/lib/anki')
+STATE_FILE = os.path.join(STATE_DIR, 'maintenance.json')
+HOLD_FILE = os.path.join(STATE_DIR, 'supervisor.hold')
+INTERVAL = int(os.environ.get('MAINT_INTERVAL', 3600))
+EVERY_HOURS = float(os.environ.get('MAINT_EVERY_HOURS', 24))
+IDLE_MINUTES = float(os.environ.get('MAINT_IDLE_MINUTES', 15))
+ANALYZE_DAYS = float(os.environ.get('MAINT_ANALYZE_DAYS', 7))
+VACUUM_FREE_RATIO = float(os.environ.get('MAINT_VACUUM_FREE_RATIO', 0.2))
+VACUUM_MIN_BYTES = int(float(os.environ.get('MAINT_VACUUM_MIN_MB', 8)) * 1024 * 1024)
+CONCURRENCY = max(1, int(os.environ.get('MAINT_CONCURRENCY', 1)))
+BUSY_TIMEOUT = 1
+
+_vacuum_lock = threading.Lock()
+_state_lock = threading.Lock()
+
+
+def log(msg):
+    print(f'[{time.strftime("%Y-%m-%d %H:%M:%S")}] [MAINT] {msg}', file=sys.stderr, flush=True)
+
+
+def collection(user):
+    return os.path.join(shards.user_dir(user), 'collection.anki2')
+
+
+def load_state():
+    try:
+        with open(STATE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'users': {}, 'passes': 0}
+
+
+def save_state(state):
+    tmp = f'{STATE_FILE}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, STATE_FILE)
+
+
+def syncing_users():
+    try:
+        with open(os.path.join(STATE_DIR, 'sync_activity.json')) as f:
+            return set(json.load(f).get('active', []))
+    except (OSError, ValueError):
+        return set()
+
+
+def backup_waiting():
+    """True while backup.sh or restore.sh waits for backup.lock; markers of
+    waiters that were killed are ignored"""
+    for marker in glob.glob(f'{BACKUP_LOCK}.pending.*'):
+        try:
+            os.kill(int(marker.rsplit('.', 1)[1]), 0)
+        except (ValueError, ProcessLookupError):
+            continue
+        except PermissionError:
+            pass  # alive, just not ours
+        return True
+    return False
+
+
+def paused():
+    """Why maintenance must wait right now, or None"""
+    if os.path.exists(HOLD_FILE):
+        return 'sync server held (restore)'
+    if backup_running():
+        return 'backup running'
+    if backup_waiting():
+        return 'backup waiting'
+    return None
+
+
+@contextmanager
+def backups_held():
+    """A shared flock on backup.lock for the duration of the block; backup.sh
+    and restore.sh take it exclusively, so they wait until the block is done.
+    Yields False when a backup or restore already holds it or is waiting
+    for it."""
+    try:
+        fd = os.open(BACKUP_LOCK, os.O_RDONLY)
+    except OSError:
+        yield True  # no backup has run yet
+        return
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        # checked under the lock: a waiter that arrived since paused() gets in
+        # as soon as the users already started are done
+        if backup_waiting():
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            yield False
+            return
+        yield True
+    finally:
+        os.close(fd)
+
+
+def idle_for(path):
+    """Seconds since the collection or its WAL last changed"""
+    newest = 0
+    for p in (path, path + '-wal'):
+        try:
+            newest = max(newest, os.stat(p).st_mtime)
+        except OSError:
+            pass
+    return time.time() - newest
+
+
+def file_bytes(path):
+    total = 0
+    for p in (path, path + '-wal'):
+        try:
+            total += os.stat(p).st_size
+        except OSError:
+            pass
+    return total
+
+
+def checkpoint(conn):
+    busy, _, _ = conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+    if busy:
+        raise sqlite3.OperationalError('database is locked (checkpoint)')
+
+
+def maintain(user, path, entry):
+    """One user's maintenance; returns their updated entry. Raises
+    sqlite3.OperationalError when the collection is in use."""
+    start = time.monotonic()
+    before = file_bytes(path)
+    done = []
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+    try:
+        wal = conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        if wal:
+            checkpoint(conn)
+            done.append('checkpoint')
+        now = time.time()
+        has_stats = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone()
+        if not has_stats or now - entry.get('last_analyze', 0) >= ANALYZE_DAYS * 86400:
+            conn.execute('ANALYZE')
+            entry['last_analyze'] = now
+            done.append('analyze')
+        conn.execute('PRAGMA optimize')
+        done.append('optimize')
+
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        pages = conn.execute('PRAGMA page_count').fetchone()[0]
+        free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        free_ratio = free / pages if pages else 0
+        if free_ratio >= VACUUM_FREE_RATIO and free * page_size >= VACUUM_MIN_BYTES:
+            # VACUUM writes a full copy of the database before replacing it
+            st = os.statvfs(os.path.dirname(path))
+            if st.f_bavail * st.f_frsize < 2 * pages * page_size:
+                log(f'{user}: not enough free disk space to VACUUM')
+            else:
+                with _vacuum_lock:
+                    # a restore may have started while waiting for another VACUUM
+                    vacuum = not os.path.exists(HOLD_FILE)
+                    if vacuum:
+                        conn.execute('VACUUM')
+                        if wal:
+                            checkpoint(conn)  # the vacuumed copy lands in the WAL first
+                if vacuum:
+                    entry['last_vacuum'] = time.time()
+                    entry['vacuums'] = entry.get('vacuums', 0) + 1
+                    done.append('vacuum')
+                    free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+                    pages = conn.execute('PRAGMA page_count').fetchone()[0]
+                    free_ratio = free / pages if pages else 0
+                else:
+                    log(f'{user}: restore pending, VACUUM left for the next run')
+    finally:
+        conn.close()
+    seconds = time.monotonic() - start
+    reclaimed = max(0, before - file_bytes(path))
+    entry.update(
+        last_run=time.time(), last_seconds=round(seconds, 3), last_reclaimed_bytes=reclaimed,
+        last_steps=done, last_error=None, bytes=file_bytes(path), free_ratio=round(free_ratio, 4),
+        runs=entry.get('runs', 0) + 1,
+        seconds_total=round(entry.get('seconds_total', 0) + seconds, 3),
+        reclaimed_bytes_total=entry.get('reclaimed_bytes_total', 0) + reclaimed)
+    return entry
+
+
+def run_pass(users=None, force=False):
+    """Maintain every due, idle user (or just `users`, due or not)"""
+    state = load_state()
+    now = time.time()
+    candidates = users or userstore.names()
+    # least recently maintained first, so a pass cut short by a backup resumes fairly
+    candidates = sorted(candidates, key=lambda u: state['users'].get(u, {}).get('last_run', 0))
+    counts = {'done': 0, 'paused': 0, 'busy': 0, 'locked': 0, 'errors': 0}
+
+    def count(key):
+        with _state_lock:
+            counts[key] += 1
+
+    def one(user):
+        path = collection(user)
+        entry = dict(state['users'].get(user, {}))
+        if not os.path.exists(path):
+            return
+        if not force and now - entry.get('last_run', 0) < EVERY_HOURS * 3600:
+            return
+        if paused():
+            count('paused')
+            return
+        if user in syncing_users() or (not force and idle_for(path) < IDLE_MINUTES * 60):
+            count('busy')
+            return
+        with backups_held() as held:
+            if not held:
+                count('paused')
+                return
+            try:
+                entry = maintain(user, path, entry)
+                count('done')
+                if entry['last_steps'] and 'vacuum' in entry['last_steps']:
+                    log(f'{user}: vacuumed, {entry["last_reclaimed_bytes"]} bytes reclaimed in {entry["last_seconds"]}s')
+                if mediarefs.ENABLED:
+                    mediarefs.check(user)
+                    if mediarefs.RECLAIM == 'quarantine':
+                        mediarefs.reclaim(user)
+            except (OSError, sqlite3.Error) as e:
+                if isinstance(e, sqlite3.OperationalError) and 'locked' in str(e):
+                    # the server has it open; try again next pass
+                    count('locked')
+                    entry['locked'] = entry.get('locked', 0) + 1
+                    with _state_lock:
+                        state['users'][user] = entry
+                    return
+                log(f'{user}: {e}')
+                count('errors')
+                entry['last_error'] = str(e)
+                entry['last_run'] = time.time()  # don't retry a broken file every pass
+        with _state_lock:
+            state['users'][user] = entry
+
+    with ThreadPoolExecutor(CONCURRENCY) as pool:
+        list(pool.map(one, candidates))
+    if mediarefs.ENABLED:
+        mediarefs.purge()
+
+    known = set(userstore.names())
+    state['users'] = {u: e for u, e in state['users'].items() if u in known}
+    state['passes'] = state.get('passes', 0) + 1
+    state['last_pass'] = int(now)
+    state['last_pass_seconds'] = round(time.time() - now, 3)
+    state['last_pass_counts'] = counts
+    save_state(state)
+    return counts
+
+
+def main(argv):
+    cmd = argv[1] if len(argv) > 1 else 'daemon'
+    if cmd == 'daemon':
+        log(f'Maintaining idle collections every {INTERVAL}s')
+        while True:
+            try:
+                counts = run_pass()
+                if counts['done'] or counts['errors']:
+                    log(f'pass: {counts}')
+            except Exception as e:
+                log(f'pass failed: {e}')
+            time.sleep(INTERVAL)
+    elif cmd == 'once':
+        print(run_pass(argv[2:] or None, force=bool(argv[2:])))
+    elif cmd == 'status':
+        state = load_state()
+        for user, e in sorted(state['users'].items()):
+            print(f'{user:24} runs={e.get("runs", 0)} reclaimed={e.get("reclaimed_bytes_total", 0)} '
+                  f'seconds={e.get("seconds_total", 0)} free_ratio={e.get("free_ratio", "-")} '
+                  f'last={time.strftime("%Y-%m-%d %H:%M", time.localtime(e.get("last_run", 0)))}')
+    else:
+        print(__doc__.strip().splitlines()[-1].strip(), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
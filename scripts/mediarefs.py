@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+"""Orphaned media: files in collection.media that no note refers to.
+
+Media references are indexed per note in a sidecar database (mediarefs.db in
+STATE_DIR) with the same usn watermarks analytics.py uses, so a refresh only
+re-reads notes the server has stored since the last one and drops deleted
+notes from their graves. A check compares the indexed references with the
+files on disk and with the server's media.db:
+
+  unused     referenced by no note, but still listed by the server; clients
+             keep downloading it until one runs Tools > Check Media, which
+             deletes it and syncs the deletion
+  untracked  referenced by no note and unknown to the server (a failed
+             upload, a leftover from a restore); no client can see it
+
+Only untracked files are reclaimed: they are moved into DATA_DIR/.media-
+quarantine/<user>/ once they are MEDIA_ORPHAN_MIN_AGE_HOURS old, and deleted
+after MEDIA_QUARANTINE_DAYS. Names starting with '_' (used by note type
+templates) and generated LaTeX images are never treated as orphans.
+
+maintenance.py runs a check for each idle user it maintains, and a reclaim
+when MEDIA_RECLAIM=quarantine.
+
+  mediarefs.py scan [USER...] | report [USER] | reclaim [USER...]
+  mediarefs.py purge | restore USER [FILE...]
+"""
+
+import html
+import os
+import re
+import sqlite3
+import sys
+import time
+import unicodedata
+from urllib.parse import unquote
+
+import shards
+from analytics import open_collection
+
+STATE_DIR = os.environ.get('STATE_DIR', '/var/lib/anki')
+DB_PATH = os.path.join(STATE_DIR, 'mediarefs.db')
+QUARANTINE_DIR = os.path.join(shards.DATA_DIR, '.media-quarantine')
+ENABLED = os.environ.get('MEDIA_ORPHANS_ENABLED', 'true') == 'true'
+RECLAIM = os.environ.get('MEDIA_RECLAIM', 'off')
+MIN_AGE = float(os.environ.get('MEDIA_ORPHAN_MIN_AGE_HOURS', 24)) * 3600
+QUARANTINE_DAYS = float(os.environ.get('MEDIA_QUARANTINE_DAYS', 14))
+VERIFY_HOURS = float(os.environ.get('ANALYTICS_VERIFY_HOURS', 24))
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS collections (
+    user TEXT PRIMARY KEY, ino INTEGER, size INTEGER, mtime REAL, scm INTEGER,
+    note_usn INTEGER, grave_usn INTEGER, verified REAL DEFAULT 0, checked REAL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS note_refs (
+    user TEXT, nid INTEGER, refs TEXT, PRIMARY KEY (user, nid)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS orphans (
+    user TEXT, name TEXT, size INTEGER, tracked INTEGER, first_seen REAL,
+    PRIMARY KEY (user, name)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS quarantine (
+    user TEXT, name TEXT, size INTEGER, moved REAL, PRIMARY KEY (user, name)
+) WITHOUT ROWID;
+'''
+
+START = -2  # below any usn a server-side row can carry
+SEP = '\x1f'
+
+# what Anki's own media check looks for in note fields
+_HTML_REF = re.compile(r'''(?si)<\b(?:img|audio|video|source|object)\b(?:[^>"']|"[^"]*"|'[^']*')*?'''
+                       r'''\b(?:src|data)\b\s*=\s*(?:"([^"]+?)"|'([^']+?)'|([^ >]+))''')
+_SOUND_REF = re.compile(r'\[sound:([^\]]+)\]')
+
+
+def connect():
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def media_dir(user):
+    return os.path.join(shards.user_dir(user), 'collection.media')
+
+
+def collection(user):
+    return os.path.join(shards.user_dir(user), 'collection.anki2')
+
+
+def protected(name):
+    return name.startswith(('_', '.', 'latex-'))
+
+
+def refs(fields):
+    """File names a note's fields refer to"""
+    found = set()
+    for m in _HTML_REF.finditer(fields):
+        found.add(next(g for g in m.groups() if g))
+    found.update(_SOUND_REF.findall(fields))
+    names = set()
+    for raw in found:
+        if '://' in raw or raw.startswith('data:'):
+            continue
+        for name in (raw, html.unescape(raw), unquote(html.unescape(raw))):
+            names.add(unicodedata.normalize('NFC', name))
+    return names
+
+
+def _validator(path):
+    # new notes sit in the -wal until a checkpoint
+    st = os.stat(path)
+    try:
+        wal = os.stat(path + '-wal')
+        return st.st_ino, st.st_size + wal.st_size, max(st.st_mtime, wal.st_mtime)
+    except OSError:
+        return st.st_ino, st.st_size, st.st_mtime
+
+
+def _apply(db, col, user, state, now, rebuilt=False):
+    scm, col_usn = col.execute('SELECT scm, usn FROM col').fetchone()
+    if state['scm'] != scm or col_usn < state['note_usn']:
+        db.execute('DELETE FROM note_refs WHERE user = ?', (user,))
+        state.update(note_usn=START, grave_usn=START, verified=0)
+
+    top = state['note_usn']
+    rows = []
+    # rows of a sync still in progress carry the current usn; next time
+    for nid, flds, usn in col.execute('SELECT id, flds, usn FROM notes WHERE usn > ? AND usn < ?',
+                                      (state['note_usn'], col_usn)):
+        top = max(top, usn)
+        rows.append((user, nid, SEP.join(sorted(refs(flds)))))
+    db.executemany('INSERT OR REPLACE INTO note_refs VALUES (?, ?, ?)', rows)
+    state['note_usn'] = top
+
+    top = state['grave_usn']
+    for oid, usn in col.execute('SELECT oid, usn FROM graves WHERE type = 1 AND usn > ? AND usn < ?',
+                                (state['grave_usn'], col_usn)):
+        top = max(top, usn)
+        db.execute('DELETE FROM note_refs WHERE user = ? AND nid = ?', (user, oid))
+    state['grave_usn'] = top
+
+    if now - state['verified'] >= VERIFY_HOURS * 3600:
+        notes = col.execute('SELECT COUNT(*) FROM notes').fetchone()[0]
+        have = db.execute('SELECT COUNT(*) FROM note_refs WHERE user = ?', (user,)).fetchone()[0]
+        if notes != have and not rebuilt:
+            print(f'[mediarefs] {user}: index drifted ({have}/{notes} notes), rebuilding', file=sys.stderr)
+            state['scm'] = None
+            return _apply(db, col, user, state, now, rebuilt=True)
+        state['verified'] = now
+    state['scm'] = scm
+
+
+def update(user, db):
+    """Fold notes changed since the last call into the reference index; a
+    stat() when the collection hasn't changed"""
+    path = collection(user)
+    try:
+        check = _validator(path)
+    except OSError:
+        return False
+    row = db.execute('SELECT ino, size, mtime, scm, note_usn, grave_usn, verified FROM collections '
+                     'WHERE user = ?', (user,)).fetchone()
+    now = time.time()
+    if row and tuple(row[:3]) == check and now - row[6] < VERIFY_HOURS * 3600:
+        return False
+    state = dict(zip(('scm', 'note_usn', 'grave_usn', 'verified'), row[3:] if row else (None, START, START, 0)))
+    if row and row[0] != check[0]:
+        state['scm'] = None  # replaced by a full upload
+    with open_collection(path) as col:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            _apply(db, col, user, state, now)
+            db.execute('INSERT INTO collections (user, ino, size, mtime, scm, note_usn, grave_usn, verified) '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (user) DO UPDATE SET ino = excluded.ino, '
+                       'size = excluded.size, mtime = excluded.mtime, scm = excluded.scm, '
+                       'note_usn = excluded.note_usn, grave_usn = excluded.grave_usn, verified = excluded.verified',
+                       (user, *check, state['scm'], state['note_usn'], state['grave_usn'], state['verified']))
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+    return True
+
+
+def tracked_names(user):
+    """Names the server's media.db lists as present; raises sqlite3.Error
+    when it can't be read"""
+    conn = sqlite3.connect(f'file:{os.path.join(shards.user_dir(user), "media.db")}?mode=ro',
+                           uri=True, timeout=1)
+    try:
+        return {unicodedata.normalize('NFC', r[0])
+                for r in conn.execute('SELECT fname FROM media WHERE csum IS NOT NULL')}
+    finally:
+        conn.close()
+
+
+def check(user, db=None):
+    """Refresh the user's index and orphan list; returns the summary, or
+    None when the collection or media.db couldn't be read"""
+    own = db is None
+    db = db or connect()
+    try:
+        update(user, db)
+        referenced = set()
+        for (joined,) in db.execute("SELECT refs FROM note_refs WHERE user = ? AND refs != ''", (user,)):
+            referenced.update(joined.split(SEP))
+        try:
+            tracked = tracked_names(user)
+        except sqlite3.Error as e:
+            # without the server's list nothing can be called untracked
+            print(f'[mediarefs] {user}: media.db: {e}', file=sys.stderr)
+            return None
+        now = time.time()
+        seen = dict(db.execute('SELECT name, first_seen FROM orphans WHERE user = ?', (user,)).fetchall())
+        found = []
+        try:
+            with os.scandir(media_dir(user)) as it:
+                for e in it:
+                    name = unicodedata.normalize('NFC', e.name)
+                    if protected(name) or name in referenced:
+                        continue
+                    try:
+                        if not e.is_file(follow_symlinks=False):
+                            continue
+                        size = e.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        continue
+                    found.append((user, e.name, size, int(name in tracked), seen.get(e.name, now)))
+        except FileNotFoundError:
+            pass
+        with db:
+            db.execute('DELETE FROM orphans WHERE user = ?', (user,))
+            db.executemany('INSERT INTO orphans VALUES (?, ?, ?, ?, ?)', found)
+            db.execute('UPDATE collections SET checked = ? WHERE user = ?', (now, user))
+        return summary([user], db).get(user)
+    except (OSError, sqlite3.Error) as e:
+        print(f'[mediarefs] {user}: {e}', file=sys.stderr)
+        return None
+    finally:
+        if own:
+            db.close()
+
+
+def reclaim(user, db=None):
+    """Quarantine the user's untracked orphans that are old enough; returns
+    (files, bytes) moved"""
+    own = db is None
+    db = db or connect()
+    moved = [0, 0]
+    try:
+        now = time.time()
+        rows = db.execute('SELECT name, size FROM orphans WHERE user = ? AND tracked = 0 AND first_seen <= ?',
+                          (user, now - MIN_AGE)).fetchall()
+        if not rows:
+            return tuple(moved)
+        tracked = tracked_names(user)  # again, right before moving anything
+        dest_dir = os.path.join(QUARANTINE_DIR, user)
+        os.makedirs(dest_dir, exist_ok=True)
+        for name, size in rows:
+            src = os.path.join(media_dir(user), name)
+            try:
+                if unicodedata.normalize('NFC', name) in tracked or now - os.stat(src).st_mtime < MIN_AGE:
+                    continue
+                os.replace(src, os.path.join(dest_dir, name))
+            except OSError:
+                continue
+            with db:
+                db.execute('DELETE FROM orphans WHERE user = ? AND name = ?', (user, name))
+                db.execute('INSERT OR REPLACE INTO quarantine VALUES (?, ?, ?, ?)', (user, name, size, now))
+            moved[0] += 1
+            moved[1] += size
+        if moved[0]:
+            print(f'[mediarefs] {user}: quarantined {moved[0]} untracked files ({moved[1]} bytes)', file=sys.stderr)
+    except (OSError, sqlite3.Error) as e:
+        print(f'[mediarefs] {user}: {e}', file=sys.stderr)
+    finally:
+        if own:
+            db.close()
+    return tuple(moved)
+
+
+def purge(db=None):
+    """Delete quarantined files older than MEDIA_QUARANTINE_DAYS"""
+    own = db is None
+    db = db or connect()
+    deleted = 0
+    try:
+        cutoff = time.time() - QUARANTINE_DAYS * 86400
+        for user, name in db.execute('SELECT user, name FROM quarantine WHERE moved < ?', (cutoff,)).fetchall():
+            try:
+                os.unlink(os.path.join(QUARANTINE_DIR, user, name))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f'[mediarefs] {user}: {e}', file=sys.stderr)
+                continue
+            with db:
+                db.execute('DELETE FROM quarantine WHERE user = ? AND name = ?', (user, name))
+            deleted += 1
+            try:
+                os.rmdir(os.path.join(QUARANTINE_DIR, user))
+            except OSError:
+                pass  # not empty yet
+    finally:
+        if own:
+            db.close()
+    return deleted
+
+
+def restore(user, names=None):
+    """Move quarantined files back into the user's media folder"""
+    db = connect()
+    try:
+        rows = db.execute('SELECT name FROM quarantine WHERE user = ?', (user,)).fetchall()
+        restored = 0
+        for (name,) in rows:
+            if names and name not in names:
+                continue
+            dest = os.path.join(media_dir(user), name)
+            if os.path.exists(dest):
+                print(f'[mediarefs] {user}: {name} exists again, left in quarantine', file=sys.stderr)
+                continue
+            try:
+                os.replace(os.path.join(QUARANTINE_DIR, user, name), dest)
+            except OSError as e:
+                print(f'[mediarefs] {user}: {name}: {e}', file=sys.stderr)
+                continue
+            with db:
+                db.execute('DELETE FROM quarantine WHERE user = ? AND name = ?', (user, name))
+            restored += 1
+        return restored
+    finally:
+        db.close()
+
+
+def summary(users, db=None):
+    """Per-user orphan totals from the last check"""
+    own = db is None
+    db = db or connect()
+    try:
+        result = {}
+        for user in users:
+            row = db.execute('SELECT checked FROM collections WHERE user = ?', (user,)).fetchone()
+            if not row or not row[0]:
+                continue
+            entry = {'checked': int(row[0])}
+            for tracked, key in ((1, 'unused'), (0, 'untracked')):
+                files, total = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM orphans '
+                                          'WHERE user = ? AND tracked = ?', (user, tracked)).fetchone()
+                entry[f'{key}_files'], entry[f'{key}_bytes'] = files, total
+            entry['quarantined_files'], entry['quarantined_bytes'] = db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM quarantine WHERE user = ?', (user,)).fetchone()
+            entry['orphaned_files'] = entry['unused_files'] + entry['untracked_files']
+            entry['orphaned_bytes'] = entry['unused_bytes'] + entry['untracked_bytes']
+            result[user] = entry
+        return result
+    finally:
+        if own:
+            db.close()
+
+
+def largest(user, limit=50):
+    """The user's biggest orphans: (name, size, tracked)"""
+    db = connect()
+    try:
+        return db.execute('SELECT name, size, tracked FROM orphans WHERE user = ? ORDER BY size DESC LIMIT ?',
+                          (user, limit)).fetchall()
+    finally:
+        db.close()
+
+
+def main(argv):
+    import userstore
+    cmd = argv[1] if len(argv) > 1 else ''
+    args = argv[2:]
+    if cmd == 'scan':
+        for user in args or userstore.names():
+            s = check(user)
+            if s:
+                print(f'{user:24} unused={s["unused_files"]}/{s["unused_bytes"]}B '
+                      f'untracked={s["untracked_files"]}/{s["untracked_bytes"]}B')
+    elif cmd == 'report':
+        if args:
+            for name, size, tracked in largest(args[0], 1000):
+                print(f'{size:>12} {"unused" if tracked else "untracked":9} {name}')
+            return 0
+        for user, s in sorted(summary(userstore.names()).items()):
+            print(f'{user:24} orphaned={s["orphaned_files"]}/{s["orphaned_bytes"]}B '
+                  f'untracked={s["untracked_files"]}/{s["untracked_bytes"]}B '
+                  f'quarantined={s["quarantined_files"]}/{s["quarantined_bytes"]}B '
+                  f'checked={time.strftime("%Y-%m-%d %H:%M", time.localtime(s["checked"]))}')
+    elif cmd == 'reclaim':
+        for user in args or userstore.names():
+            files, total = reclaim(user)
+            if files:
+                print(f'{user}: {files} files, {total} bytes quarantined')
+    elif cmd == 'purge':
+        print(f'{purge()} quarantined files deleted')
+    elif cmd == 'restore' and args:
+        print(f'{restore(args[0], set(args[1:]))} files restored')
+    else:
+        print('\n'.join(line.strip() for line in __doc__.strip().splitlines()[-2:]), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""Per-user media statistics from the sync server's media database.
+
+The server records every media file it accepts in <user>/media.db: one row
+per file name with its checksum (NULL once deleted), size, mtime and the usn
+of the sync that changed it, plus running totals in its meta table. File
+count and bytes come from those totals; rows newer than the stored usn
+watermark are folded into per-day addition and deletion counts kept in a
+sidecar database (mediastats.db in STATE_DIR), so a refresh reads a handful
+of rows instead of listing collection.media.
+
+The folder itself is only scanned to reconcile drift (every
+MEDIA_VERIFY_HOURS) and for users whose media.db can't be read, in which
+case the scan is redone only when the folder's mtime changes.
+"""
+
+import os
+import sqlite3
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+import shards
+
+STATE_DIR = os.environ.get('STATE_DIR', '/var/lib/anki')
+DB_PATH = os.path.join(STATE_DIR, 'mediastats.db')
+VERIFY_HOURS = float(os.environ.get('MEDIA_VERIFY_HOURS', 24))
+HISTORY_DAYS = 30
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS media (
+    user TEXT PRIMARY KEY, ino INTEGER, size INTEGER, mtime REAL, wal_size INTEGER, wal_mtime REAL,
+    usn INTEGER, files INTEGER DEFAULT 0, bytes INTEGER DEFAULT 0, source TEXT,
+    dir_mtime REAL, scan_files INTEGER, scan_bytes INTEGER, drift_files INTEGER, drift_bytes INTEGER,
+    verified REAL DEFAULT 0, updated REAL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS media_daily (
+    user TEXT, day TEXT, added INTEGER, added_bytes INTEGER, deleted INTEGER,
+    PRIMARY KEY (user, day)
+) WITHOUT ROWID;
+'''
+
+START = -1  # below any usn a media row can carry
+
+
+def connect():
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def media_dir(user):
+    return os.path.join(shards.user_dir(user), 'collection.media')
+
+
+def media_db(user):
+    return os.path.join(shards.user_dir(user), 'media.db')
+
+
+def scan(path):
+    """(files, bytes) of a media folder, the slow way"""
+    files = total = 0
+    with os.scandir(path) as it:
+        for e in it:
+            try:
+                if e.is_file(follow_symlinks=False):
+                    files += 1
+                    total += e.stat(follow_symlinks=False).st_size
+            except OSError:
+                pass
+    return files, total
+
+
+def _validator(path):
+    # the server writes media.db in WAL mode, so new rows show up in the -wal
+    # file long before the main file changes
+    st = os.stat(path)
+    try:
+        wal = os.stat(path + '-wal')
+        wal = (wal.st_size, wal.st_mtime)
+    except OSError:
+        wal = (0, 0.0)
+    return (st.st_ino, st.st_size, st.st_mtime) + wal
+
+
+def _read_media(path, state):
+    """Totals and rows changed since state['usn'], read-only; raises
+    sqlite3.Error when the database is locked or not the expected schema"""
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=1)
+    try:
+        meta = conn.execute('SELECT last_usn, total_bytes, total_nonempty_files FROM meta').fetchone()
+        if meta is None:
+            raise sqlite3.DatabaseError('empty meta table')
+        last_usn, total_bytes, total_files = meta
+        if last_usn < state['usn']:
+            state['usn'] = START  # replaced or reset on the server
+        changes = conn.execute('SELECT csum IS NULL, size, mtime, usn FROM media WHERE usn > ?',
+                               (state['usn'],)).fetchall()
+        return total_files, total_bytes, changes
+    finally:
+        conn.close()
+
+
+def _apply(db, user, state, changes, now):
+    if state['usn'] == START:
+        db.execute('DELETE FROM media_daily WHERE user = ?', (user,))
+    oldest = (date.fromtimestamp(now) - timedelta(days=HISTORY_DAYS)).isoformat()
+    days = {}
+    for deleted, size, mtime, usn in changes:
+        state['usn'] = max(state['usn'], usn)
+        day = datetime.fromtimestamp(mtime).strftime('%Y-%m-%d')
+        if day < oldest:
+            continue
+        agg = days.setdefault(day, [0, 0, 0])
+        if deleted:
+            agg[2] += 1
+        else:
+            agg[0] += 1
+            agg[1] += size
+    for day, (added, added_bytes, deleted) in days.items():
+        db.execute('INSERT INTO media_daily VALUES (?, ?, ?, ?, ?) ON CONFLICT (user, day) DO UPDATE SET '
+                   'added = added + excluded.added, added_bytes = added_bytes + excluded.added_bytes, '
+                   'deleted = deleted + excluded.deleted', (user, day, added, added_bytes, deleted))
+    db.execute('DELETE FROM media_daily WHERE user = ? AND day < ?', (user, oldest))
+
+
+def update(user, db=None):
+    """Refresh one user's media stats; a couple of stat() calls when nothing
+    changed"""
+    own = db is None
+    db = db or connect()
+    try:
+        row = db.execute('SELECT ino, size, mtime, wal_size, wal_mtime, usn, files, bytes, source, '
+                         'dir_mtime, scan_files, scan_bytes, drift_files, drift_bytes, verified '
+                         'FROM media WHERE user = ?',
+                         (user,)).fetchone()
+        keys = ('usn', 'files', 'bytes', 'source', 'dir_mtime', 'scan_files', 'scan_bytes',
+                'drift_files', 'drift_bytes', 'verified')
+        state = dict(zip(keys, row[5:])) if row else dict(zip(keys, (START, 0, 0) + (None,) * 6 + (0,)))
+        now = time.time()
+        try:
+            dir_mtime = os.stat(media_dir(user)).st_mtime
+        except OSError:
+            dir_mtime = None
+        try:
+            check = _validator(media_db(user))
+        except OSError:
+            check = None
+        due = now - state['verified'] >= VERIFY_HOURS * 3600
+
+        changes = []
+        if check is not None and (not row or tuple(row[:5]) != check or state['source'] != 'media.db' or due):
+            if row and row[0] != check[0]:
+                state['usn'] = START  # a new database, e.g. after a restore
+            try:
+                state['files'], state['bytes'], changes = _read_media(media_db(user), state)
+                state['source'] = 'media.db'
+            except sqlite3.Error as e:
+                if state['source'] == 'media.db':
+                    return False  # locked mid-sync: keep the last figures, retry next time
+                print(f'[mediastats] {user}: {e}, scanning the folder instead', file=sys.stderr)
+                check = None
+        elif check is not None and not due:
+            return False
+        if check is None:
+            state['source'] = 'scan'
+            if dir_mtime != state['dir_mtime'] or state['scan_files'] is None:
+                due = True
+            elif not due:
+                return False
+
+        if due and dir_mtime is not None:
+            state['scan_files'], state['scan_bytes'] = scan(media_dir(user))
+            state['dir_mtime'] = dir_mtime
+            state['verified'] = now
+            if state['source'] == 'scan':
+                state['files'], state['bytes'] = state['scan_files'], state['scan_bytes']
+            state['drift_files'] = state['scan_files'] - state['files']
+            state['drift_bytes'] = state['scan_bytes'] - state['bytes']
+            if state['drift_files'] or state['drift_bytes']:
+                print(f'[mediastats] {user}: media.db says {state["files"]} files/{state["bytes"]} bytes, '
+                      f'folder has {state["scan_files"]}/{state["scan_bytes"]}', file=sys.stderr)
+        elif due:
+            state['verified'] = now
+
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            if changes or state['usn'] == START:
+                _apply(db, user, state, changes, now)
+            db.execute('INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                       (user, *(check or (None,) * 5), *(state[k] for k in keys), now))
+            db.commit()
+        except BaseException:
+            db.rollback()
+            raise
+        return True
+    except (OSError, sqlite3.Error) as e:
+        print(f'[mediastats] {user}: {e}', file=sys.stderr)
+        return False
+    finally:
+        if own:
+            db.close()
+
+
+def update_all(users):
+    db = connect()
+    try:
+        for user in users:
+            update(user, db)
+    finally:
+        db.close()
+
+
+def summary(users, days=7, now=None):
+    """Per-user media totals, recent changes over `days` and the last
+    reconciliation against the folder"""
+    now = now or time.time()
+    since = (date.fromtimestamp(now) - timedelta(days=days - 1)).isoformat()
+    db = connect()
+    try:
+        result = {}
+        for user in users:
+            row = db.execute('SELECT files, bytes, source, drift_files, drift_bytes, verified FROM media '
+                             'WHERE user = ?', (user,)).fetchone()
+            if not row:
+                continue
+            files, total, source, drift_files, drift_bytes, verified = row
+            added, added_bytes, deleted = db.execute(
+                'SELECT COALESCE(SUM(added), 0), COALESCE(SUM(added_bytes), 0), COALESCE(SUM(deleted), 0) '
+                'FROM media_daily WHERE user = ? AND day >= ?', (user, since)).fetchone()
+            result[user] = {
+                'files': files,
+                'bytes': total,
+                'source': source,
+                'added': added,
+                'added_bytes': added_bytes,
+                'deleted': deleted,
+                # folder minus media.db at the last reconciliation
+                'drift_files': drift_files,
+                'drift_bytes': drift_bytes,
+                'verified': int(verified),
+            }
+        return result
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    import userstore
+    update_all(sys.argv[1:] or userstore.names())
@@ -1,12 +1,23 @@
 #!/usr/bin/env python3
 """Prometheus metrics endpoint for the Anki sync server."""
 
+import gzip
+import json
 import os
 import re
-import subprocess
+import threading
 import time
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+import analytics
+import mediarefs
+import mediastats
+import shards
+import statcache
+import userstore
+from logstore import count_tagged, tail_lines
 
 DATA_DIR = os.environ.get('SYNC_BASE', '/data')
 BACKUP_DIR = os.environ.get('BACKUP_DIR', '/backups')
@@ -16,8 +27,21 @@ PORT = int(os.environ.get('METRICS_PORT', 9090))
 ANKI_VERSION = os.environ.get('ANKI_VERSION', 'unknown')
 TLS_ENABLED = os.environ.get('TLS_ENABLED', 'false')
 START_TIME = time.time()
-
-_size_cache = {}
+# full: every per-user series; topn: the METRICS_TOP_N largest (or most
+# recently active) users plus user="other"; aggregate: quantiles across users
+USER_MODE = os.environ.get('METRICS_USER_MODE', 'full')
+TOP_N = int(os.environ.get('METRICS_TOP_N', 20))
+TOP_BY = os.environ.get('METRICS_TOP_BY', 'size')
+# re-ranked hourly so "other" counters don't jump with every scrape
+TOP_REFRESH = 3600
+QUANTILES = (0.5, 0.9, 0.99)
+# dropped outside full mode: neither summed nor ranked meaningfully
+UNFOLDABLE = {'anki_sync_user_shard'}
+# /metrics/users is the costliest body and is scraped rarely; repeats within
+# this many seconds are served from memory
+USERS_TTL = int(os.environ.get('METRICS_USERS_TTL', 300))
+
+CACHE = statcache.StatCache('metrics')
 
 
 def read_int(path):
@@ -28,161 +52,219 @@ def read_int(path):
 
 
 def dir_size(path, ttl=60):
-    now = time.time()
-    cached = _size_cache.get(path)
-    if cached and now - cached[0] < ttl:
-        return cached[1]
-    total = 0
-    try:
-        for entry in Path(path).rglob('*'):
-            if entry.is_file():
-                total += entry.stat().st_size
-    except OSError:
-        pass
-    _size_cache[path] = (now, total)
-    return total
-
-
-_col_cache = {}
-
-
-def collection_stats(db_path):
-    """Cards/notes/decks/reviews; the server holds synced collections locked,
-    so query a temp copy and cache by mtime"""
-    import shutil
-    import sqlite3
-    import tempfile
-
-    def query(conn):
-        # anki schemas use a custom collation vanilla sqlite doesn't have
-        conn.create_collation('unicase', lambda a, b: (a > b) - (a < b))
-        stats = {}
-        stats['cards'] = conn.execute('SELECT COUNT(*) FROM cards').fetchone()[0]
-        stats['notes'] = conn.execute('SELECT COUNT(*) FROM notes').fetchone()[0]
-        for key, table in (('decks', 'decks'), ('reviews', 'revlog')):
-            try:
-                stats[key] = conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
-            except sqlite3.Error:
-                stats[key] = 0
-        if not stats['decks']:
-            # schema-11 collections keep decks as JSON in the col table
-            try:
-                import json
-                stats['decks'] = len(json.loads(conn.execute('SELECT decks FROM col').fetchone()[0]))
-            except Exception:
-                pass
-        return stats
-
-    try:
-        mtime = os.path.getmtime(db_path)
-        cached = _col_cache.get(db_path)
-        if cached and cached[0] == mtime:
-            return cached[1]
-        try:
-            conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, timeout=1)
-            stats = query(conn)
-            conn.close()
-        except sqlite3.OperationalError:
-            if os.path.getsize(db_path) >= 512 * 1024 * 1024:
-                return None
-            fd, tmp = tempfile.mkstemp(suffix='.anki2')
-            os.close(fd)
-            try:
-                shutil.copyfile(db_path, tmp)
-                conn = sqlite3.connect(f'file:{tmp}?mode=ro', uri=True)
-                stats = query(conn)
-                conn.close()
-            finally:
-                os.unlink(tmp)
-        _col_cache[db_path] = (mtime, stats)
-        return stats
-    except Exception:
-        return None
+    return statcache.dir_size(CACHE, path, ttl)
 
 
 def tail(path, n=2000):
     try:
-        out = subprocess.run(['tail', '-n', str(n), path],
-                             capture_output=True, text=True, timeout=5).stdout
-        return out.splitlines() if out else []
+        return tail_lines(path, n)
     except Exception:
         return []
 
 
-def count_matches(path, needle):
+def count_matches(path, tag):
+    # sealed segments are counted from their manifest, never decompressed
     try:
-        out = subprocess.run(['grep', '-c', needle, path],
-                             capture_output=True, text=True, timeout=5).stdout.strip()
-        return int(out)
+        return count_tagged(path, tag)
     except Exception:
         return 0
 
 
-def get_users():
+def read_state(name):
     try:
-        return [u for u in Path(os.path.join(STATE_DIR, 'users.txt')).read_text().split() if u]
-    except OSError:
-        return []
+        return json.loads(Path(os.path.join(STATE_DIR, name)).read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def get_users():
+    return userstore.names()
 
 
 def label(value):
     return value.replace('\\', '\\\\').replace('"', '\\"')
 
 
-def build_metrics():
-    lines = []
+_top = {'at': 0, 'users': set()}
+
+
+def top_users():
+    """Names of the TOP_N users kept in topn mode"""
+    if time.time() - _top['at'] >= TOP_REFRESH:
+        users = get_users()
+        if TOP_BY == 'activity':
+            def rank(u):
+                col = os.path.join(shards.user_dir(u), 'collection.anki2')
+                return max((os.stat(p).st_mtime for p in (col, col + '-wal') if os.path.exists(p)), default=0)
+        else:
+            def rank(u):
+                return dir_size(shards.user_dir(u))
+        _top['users'] = set(sorted(users, key=rank, reverse=True)[:TOP_N])
+        _top['at'] = time.time()
+    return _top['users']
+
+
+def number(value):
+    return int(value) if value == int(value) else round(value, 6)
+
+
+def sample(name, labels, value):
+    inner = ','.join(f'{k}="{v}"' for k, v in labels)
+    return f'{name}{{{inner}}} {number(value)}' if inner else f'{name} {number(value)}'
+
+
+def user_sample(name, user, value, **labels):
+    """A per-user sample, formatted only once build_metrics has kept, folded
+    or aggregated it for METRICS_USER_MODE"""
+    return name, user, tuple((k, label(str(v))) for k, v in labels.items()), value
+
+
+def format_user_sample(row):
+    name, user, labels, value = row
+    return sample(name, (('user', label(user)),) + labels, value)
+
+
+def fold_users(name, mtype, samples, mode):
+    """A family's per-user samples reshaped for METRICS_USER_MODE; returns
+    (type, samples). Samples already formatted pass through."""
+    out = [s for s in samples if isinstance(s, str)]
+    rows = [s for s in samples if not isinstance(s, str)]
+    if not rows:
+        return mtype, samples
+    if name in UNFOLDABLE:
+        return mtype, out
+    groups = {}
+    if mode == 'topn':
+        keep = top_users()
+        # timestamps and ratios don't add up; "other" reports the newest/highest
+        combine = max if name.endswith(('_timestamp_seconds', '_ratio')) else sum
+        for row in rows:
+            sname, user, labels, value = row
+            if user in keep:
+                out.append(format_user_sample(row))
+            else:
+                groups.setdefault((sname, labels), []).append(value)
+        out += [sample(sname, (('user', 'other'),) + labels, combine(values))
+                for (sname, labels), values in groups.items()]
+        return mtype, out
+    for sname, user, labels, value in rows:
+        groups.setdefault((sname, labels), []).append(value)
+    for (sname, labels), values in groups.items():
+        values.sort()
+        out += [sample(sname, labels + (('quantile', str(q)),), values[min(len(values) - 1, int(len(values) * q))])
+                for q in QUANTILES]
+        out.append(sample(f'{sname}_sum', labels, sum(values)))
+        out.append(sample(f'{sname}_count', labels, len(values)))
+    return 'summary', out
+
+
+def collect_users(metric):
+    metric('anki_sync_users_total', 'Configured users', 'gauge',
+           [f'anki_sync_users_total {len(get_users())}'])
+    if USER_MODE == 'topn':
+        metric('anki_sync_metrics_other_users', 'Users folded into user="other" by METRICS_USER_MODE=topn', 'gauge',
+               [f'anki_sync_metrics_other_users {max(0, len(get_users()) - TOP_N)}'])
 
-    def metric(name, help_text, mtype, samples):
-        lines.append(f'# HELP {name} {help_text}')
-        lines.append(f'# TYPE {name} {mtype}')
-        lines.extend(samples)
-        lines.append('')
 
+def collect_storage(metric):
     users = get_users()
-    metric('anki_sync_users_total', 'Configured users', 'gauge',
-           [f'anki_sync_users_total {len(users)}'])
-
     metric('anki_sync_data_bytes', 'Total sync data size in bytes', 'gauge',
            [f'anki_sync_data_bytes {dir_size(DATA_DIR)}'])
 
     metric('anki_sync_user_data_bytes', 'Per-user data size in bytes', 'gauge',
-           [f'anki_sync_user_data_bytes{{user="{label(u)}"}} {dir_size(os.path.join(DATA_DIR, u))}'
+           [user_sample('anki_sync_user_data_bytes', u, dir_size(shards.user_dir(u)))
             for u in users])
 
     col_bytes = {}
-    media_bytes = {}
-    media_files = {}
-    col_stats = {}
     for u in users:
-        udir = Path(DATA_DIR) / u
+        udir = Path(shards.user_dir(u))
         col_bytes[u] = sum(f.stat().st_size for f in udir.glob('*.anki2') if f.is_file())
-        mdir = udir / 'collection.media'
-        media_bytes[u] = dir_size(str(mdir)) if mdir.is_dir() else 0
-        try:
-            media_files[u] = sum(1 for f in mdir.iterdir() if f.is_file()) if mdir.is_dir() else 0
-        except OSError:
-            media_files[u] = 0
-        col = udir / 'collection.anki2'
-        if col.is_file():
-            stats = collection_stats(str(col))
-            if stats:
-                col_stats[u] = stats
+    # from each user's media.db, see mediastats.py
+    mediastats.update_all(users)
+    media = mediastats.summary(users)
+    media_bytes = {u: m['bytes'] for u, m in media.items()}
+    media_files = {u: m['files'] for u, m in media.items()}
 
     metric('anki_sync_collections_bytes', 'Total collection database size', 'gauge',
            [f'anki_sync_collections_bytes {sum(col_bytes.values())}'])
     metric('anki_sync_media_bytes', 'Total media size', 'gauge',
            [f'anki_sync_media_bytes {sum(media_bytes.values())}'])
     metric('anki_sync_user_collection_bytes', 'Per-user collection database size', 'gauge',
-           [f'anki_sync_user_collection_bytes{{user="{label(u)}"}} {v}' for u, v in col_bytes.items()])
+           [user_sample('anki_sync_user_collection_bytes', u, v) for u, v in col_bytes.items()])
     metric('anki_sync_user_media_bytes', 'Per-user media size', 'gauge',
-           [f'anki_sync_user_media_bytes{{user="{label(u)}"}} {v}' for u, v in media_bytes.items()])
+           [user_sample('anki_sync_user_media_bytes', u, v) for u, v in media_bytes.items()])
     metric('anki_sync_media_files_total', 'Per-user media file count', 'gauge',
-           [f'anki_sync_media_files_total{{user="{label(u)}"}} {v}' for u, v in media_files.items()])
+           [user_sample('anki_sync_media_files_total', u, v) for u, v in media_files.items()])
+    metric('anki_sync_user_media_recent_files', 'Media files added or deleted over the last 7 days', 'gauge',
+           [user_sample('anki_sync_user_media_recent_files', u, m[c], change=c)
+            for u, m in media.items() for c in ('added', 'deleted')])
+    metric('anki_sync_user_media_recent_added_bytes', 'Bytes of media added over the last 7 days', 'gauge',
+           [user_sample('anki_sync_user_media_recent_added_bytes', u, m['added_bytes'])
+            for u, m in media.items()])
+    metric('anki_sync_user_media_drift_files', 'Files in collection.media minus files in media.db at the last check',
+           'gauge', [user_sample('anki_sync_user_media_drift_files', u, m['drift_files'])
+                     for u, m in media.items() if m['drift_files'] is not None])
+    # from maintenance.py's orphan checks, see mediarefs.py
+    orphans = mediarefs.summary(users)
+    metric('anki_sync_user_media_orphaned_bytes', 'Media no note refers to; state="untracked" files are unknown '
+           'to the server too', 'gauge',
+           [user_sample('anki_sync_user_media_orphaned_bytes', u, o[f'{k}_bytes'], state=k)
+            for u, o in orphans.items() for k in ('unused', 'untracked')])
+    metric('anki_sync_user_media_orphaned_files', 'Media files no note refers to', 'gauge',
+           [user_sample('anki_sync_user_media_orphaned_files', u, o[f'{k}_files'], state=k)
+            for u, o in orphans.items() for k in ('unused', 'untracked')])
+    metric('anki_sync_user_media_quarantined_bytes', 'Untracked orphans moved to quarantine, awaiting deletion',
+           'gauge', [user_sample('anki_sync_user_media_quarantined_bytes', u, o['quarantined_bytes'])
+                     for u, o in orphans.items()])
+
+
+def collect_collections(metric):
+    # only rows synced since the last scrape are read, see analytics.py
+    users = get_users()
+    analytics.update_all(users)
+    col_stats = analytics.summary(users)
     for key, help_text in (('cards', 'Cards in collection'), ('notes', 'Notes in collection'),
-                           ('decks', 'Decks in collection'), ('reviews', 'Reviews logged')):
+                           ('decks', 'Decks in collection'), ('reviews', 'Review log entries, including manual reschedules')):
         metric(f'anki_sync_{key}_total', help_text, 'gauge',
-               [f'anki_sync_{key}_total{{user="{label(u)}"}} {s[key]}' for u, s in col_stats.items()])
-
+               [user_sample(f'anki_sync_{key}_total', u, s[key]) for u, s in col_stats.items()])
+    metric('anki_sync_user_review_seconds_total', 'Time spent answering cards', 'counter',
+           [user_sample('anki_sync_user_review_seconds_total', u, round(s['review_seconds'], 1))
+            for u, s in col_stats.items()])
+    metric('anki_sync_user_answers_total', 'Answers by button', 'counter',
+           [user_sample('anki_sync_user_answers_total', u, n, ease=e)
+            for u, s in col_stats.items() for e, n in s['answers'].items()])
+    metric('anki_sync_user_reviews_today', 'Reviews answered today', 'gauge',
+           [user_sample('anki_sync_user_reviews_today', u, s['reviews_today']) for u, s in col_stats.items()])
+    metric('anki_sync_user_review_seconds_today', 'Time spent answering cards today', 'gauge',
+           [user_sample('anki_sync_user_review_seconds_today', u, round(s['review_seconds_today'], 1))
+            for u, s in col_stats.items()])
+    metric('anki_sync_user_due_cards', 'Cards due now (review, learning and overdue)', 'gauge',
+           [user_sample('anki_sync_user_due_cards', u, s['due']) for u, s in col_stats.items()])
+    metric('anki_sync_user_last_review_timestamp_seconds', 'Time of the newest synced review', 'gauge',
+           [user_sample('anki_sync_user_last_review_timestamp_seconds', u, s['last_review'])
+            for u, s in col_stats.items()])
+
+
+def collect_shards(metric):
+    # SYNC_SHARDS > 1: one server per shard, users placed by shards.shard_of
+    if shards.SHARDS < 2:
+        return
+    users = get_users()
+    per_shard = {i: [] for i in range(shards.SHARDS)}
+    for u in users:
+        per_shard[shards.shard_of(u)].append(u)
+    metric('anki_sync_shard_up', 'Whether the shard\'s sync server accepts connections', 'gauge',
+           [f'anki_sync_shard_up{{shard="{i}"}} {int(shards.shard_up(i))}' for i in per_shard])
+    metric('anki_sync_shard_users', 'Users assigned to each shard', 'gauge',
+           [f'anki_sync_shard_users{{shard="{i}"}} {len(us)}' for i, us in per_shard.items()])
+    metric('anki_sync_shard_data_bytes', 'Data size per shard', 'gauge',
+           [f'anki_sync_shard_data_bytes{{shard="{i}"}} {sum(dir_size(shards.user_dir(u)) for u in us)}'
+            for i, us in per_shard.items()])
+    metric('anki_sync_user_shard', 'Shard serving each user', 'gauge',
+           [user_sample('anki_sync_user_shard', u, shards.shard_of(u)) for u in users])
+
+
+def collect_backups(metric):
     backups = []
     if os.path.isdir(BACKUP_DIR):
         backups = sorted(Path(BACKUP_DIR).glob('anki_backup_*.tar.gz'),
@@ -194,15 +276,105 @@ def build_metrics():
     metric('anki_sync_backup_last_timestamp_seconds', 'mtime of newest backup', 'gauge',
            [f'anki_sync_backup_last_timestamp_seconds {int(backups[-1].stat().st_mtime) if backups else 0}'])
 
-    metric('anki_sync_operations_total', 'Completed collection syncs', 'counter',
-           [f'anki_sync_operations_total {read_int(os.path.join(STATE_DIR, "sync_count.txt"))}'])
-
+    # backup.sh yielding to syncs, and sync latency with and without a backup
+    # running (bucketed by monitor.py)
+    throttle = read_state('backup_throttle.json')
+    metric('anki_sync_backup_throttled_seconds_total', 'Time backups spent paused for active or slow syncs', 'counter',
+           [f'anki_sync_backup_throttled_seconds_total {throttle.get("throttled_seconds_total", 0)}'])
+    metric('anki_sync_backup_last_throttled_seconds', 'Time the last backup spent paused for syncs', 'gauge',
+           [f'anki_sync_backup_last_throttled_seconds {throttle.get("last_throttled_seconds", 0)}'])
+    metric('anki_sync_backup_skipped_users_total', 'Users left out of a backup because they were still syncing', 'counter',
+           [f'anki_sync_backup_skipped_users_total {throttle.get("skipped_users_total", 0)}'])
+    activity = read_state('sync_activity.json')
+    metric('anki_sync_backup_running', 'Whether a backup holds the backup lock', 'gauge',
+           [f'anki_sync_backup_running {int(activity.get("backup_running", False))}'])
+    bounds = activity.get('bucket_bounds', [])
+    samples, p95s = [], []
+    for state, hist in sorted(activity.get('impact', {}).items()):
+        cumulative = 0
+        p95 = None
+        for le, n in zip([str(b) for b in bounds] + ['+Inf'], hist['buckets']):
+            cumulative += n
+            samples.append(f'anki_sync_sync_duration_ms_bucket{{backup="{state}",le="{le}"}} {cumulative}')
+            if p95 is None and cumulative >= hist['count'] * 0.95:
+                p95 = le
+        samples.append(f'anki_sync_sync_duration_ms_sum{{backup="{state}"}} {hist["sum"]}')
+        samples.append(f'anki_sync_sync_duration_ms_count{{backup="{state}"}} {hist["count"]}')
+        if hist['count']:
+            p95s.append(f'anki_sync_sync_p95_ms{{backup="{state}"}} {p95}')
+    metric('anki_sync_sync_duration_ms', 'Sync request latency, split by whether a backup was running', 'histogram', samples)
+    metric('anki_sync_sync_p95_ms', 'Upper bound of the bucket holding the 95th percentile sync latency, by backup state',
+           'gauge', p95s)
+
+
+def collect_sessions(metric):
+    # whole sync sessions grouped by monitor.py, from login to media sync
+    sessions = read_state('sessions.json')
+    if not sessions:
+        return
+    bounds = sessions.get('bucket_bounds', [])
+    samples = []
+    for kind, hist in sorted(sessions.get('types', {}).items()):
+        cumulative = 0
+        for le, n in zip([str(b) for b in bounds] + ['+Inf'], hist['buckets']):
+            cumulative += n
+            samples.append(f'anki_sync_session_duration_seconds_bucket{{type="{kind}",le="{le}"}} {cumulative}')
+        samples.append(f'anki_sync_session_duration_seconds_sum{{type="{kind}"}} {hist["sum"]}')
+        samples.append(f'anki_sync_session_duration_seconds_count{{type="{kind}"}} {hist["count"]}')
+    metric('anki_sync_session_duration_seconds', 'Wall time of whole sync sessions by type', 'histogram', samples)
+    metric('anki_sync_sessions_total', 'Sync sessions by type and outcome', 'counter',
+           [f'anki_sync_sessions_total{{type="{k}",outcome="{o}"}} {n}'
+            for k, outcomes in sorted(sessions.get('outcomes', {}).items()) for o, n in sorted(outcomes.items())])
+    metric('anki_sync_session_phase_seconds_total', 'Server time spent in each phase of sync sessions, by type',
+           'counter', [f'anki_sync_session_phase_seconds_total{{type="{k}",phase="{p}"}} {ms / 1000}'
+                       for k, phases in sorted(sessions.get('phase_ms', {}).items())
+                       for p, ms in sorted(phases.items())])
+
+
+def collect_auth(metric):
     auth_log = os.path.join(LOG_DIR, 'auth.log')
     metric('anki_sync_auth_success_total', 'Successful logins', 'counter',
            [f'anki_sync_auth_success_total {count_matches(auth_log, "AUTH_SUCCESS")}'])
     metric('anki_sync_auth_failed_total', 'Failed logins', 'counter',
            [f'anki_sync_auth_failed_total {count_matches(auth_log, "AUTH_FAILED")}'])
 
+    # top offenders per sliding window, kept in memory by monitor.py
+    top = read_state('auth_top.json')
+    metric('anki_sync_auth_failed_by_ip', 'Failed logins per source IP (top offenders, sliding window)', 'gauge',
+           [f'anki_sync_auth_failed_by_ip{{ip="{label(e["ip"])}",window="{w}"}} {e["failed"]}'
+            for w, entries in top.get('windows', {}).items() for e in entries])
+
+
+def collect_requests(metric):
+    metric('anki_sync_operations_total', 'Completed collection syncs', 'counter',
+           [f'anki_sync_operations_total {read_int(os.path.join(STATE_DIR, "sync_count.txt"))}'])
+
+    # every request line, counted incrementally by monitor.py
+    req = read_state('requests.json')
+    entries = req.get('requests', [])
+    metric('anki_sync_requests_total', 'Requests by endpoint and HTTP status', 'counter',
+           [f'anki_sync_requests_total{{uri="{label(e["uri"])}",status="{label(e["status"])}"}} {e["count"]}'
+            for e in entries])
+    per_uri = {}
+    for e in entries:
+        agg = per_uri.setdefault(e['uri'], [0, 0])
+        agg[0] += e['count']
+        agg[1] += e['ms_sum']
+    bounds = req.get('bucket_bounds', [])
+    samples = []
+    for uri, buckets in sorted(req.get('buckets', {}).items()):
+        cumulative = 0
+        for le, n in zip([str(b) for b in bounds] + ['+Inf'], buckets):
+            cumulative += n
+            samples.append(f'anki_sync_request_duration_ms_bucket{{uri="{label(uri)}",le="{le}"}} {cumulative}')
+        count, ms_sum = per_uri.get(uri, (cumulative, 0))
+        samples.append(f'anki_sync_request_duration_ms_sum{{uri="{label(uri)}"}} {ms_sum}')
+        samples.append(f'anki_sync_request_duration_ms_count{{uri="{label(uri)}"}} {count}')
+    metric('anki_sync_request_duration_ms', 'Request latency by endpoint, all statuses', 'histogram', samples)
+    metric('anki_sync_request_error_ratio', f'Share of 4xx/5xx responses over the last {req.get("error_ratio_window", 300)}s',
+           'gauge', [f'anki_sync_request_error_ratio{{uri="{label(u)}"}} {r}'
+                     for u, r in sorted(req.get('error_ratio', {}).items())])
+
     vals = []
     for line in tail(os.path.join(LOG_DIR, 'latency.log')):
         m = re.search(r'ms=(\d+)', line)
@@ -220,32 +392,255 @@ def build_metrics():
             f'anki_sync_request_latency_ms{{stat="p95"}} {p95}',
             f'anki_sync_request_latency_ms{{stat="max"}} {mx}'])
 
+
+def collect_transfer(metric):
+    # Caddy access log joined to server lines by monitor.py (TLS only)
+    transfer = read_state('transfer.json')
+    moved = transfer.get('bytes', [])
+    metric('anki_sync_request_bytes_total', 'Request body bytes received at the proxy', 'counter',
+           [user_sample('anki_sync_request_bytes_total', e['user'], e['in'], uri=e['uri'])
+            for e in moved])
+    metric('anki_sync_response_bytes_total', 'Response body bytes sent by the proxy', 'counter',
+           [user_sample('anki_sync_response_bytes_total', e['user'], e['out'], uri=e['uri'])
+            for e in moved])
+    overhead = transfer.get('overhead', {})
+    samples = []
+    if overhead:
+        cumulative = 0
+        for le, n in zip([str(b) for b in overhead['bounds']] + ['+Inf'], overhead['buckets']):
+            cumulative += n
+            samples.append(f'anki_sync_proxy_overhead_ms_bucket{{le="{le}"}} {cumulative}')
+        samples.append(f'anki_sync_proxy_overhead_ms_sum {overhead["sum"]}')
+        samples.append(f'anki_sync_proxy_overhead_ms_count {overhead["count"]}')
+    metric('anki_sync_proxy_overhead_ms', 'Time spent in the TLS proxy on top of the server (proxy duration minus elap_ms)',
+           'histogram', samples)
+
+
+def collect_devices(metric):
     devices = {}
     for line in tail(os.path.join(LOG_DIR, 'devices.log')):
         m = re.search(r'uid="([^"]*)" client="([^"]*)"', line)
         if m:
             devices.setdefault(m.group(1), set()).add(m.group(2))
     metric('anki_sync_devices_total', 'Distinct devices per user', 'gauge',
-           [f'anki_sync_devices_total{{user="{label(u)}"}} {len(c)}'
+           [user_sample('anki_sync_devices_total', u, len(c))
             for u, c in devices.items()])
 
+
+def collect_cache(metric):
+    caches = {'metrics': CACHE.stats(), 'dashboard': statcache.saved_stats('dashboard')}
+    caches = {n: c for n, c in caches.items() if c}
+    for key, mtype, help_text in (('hits', 'counter', 'Stat cache lookups answered from cache'),
+                                  ('misses', 'counter', 'Stat cache lookups that had to recompute'),
+                                  ('evictions', 'counter', 'Stat cache entries dropped to stay within limits'),
+                                  ('entries', 'gauge', 'Stat cache entries held'),
+                                  ('bytes', 'gauge', 'Estimated stat cache memory')):
+        name = f'anki_sync_statcache_{key}_total' if mtype == 'counter' else f'anki_sync_statcache_{key}'
+        metric(name, help_text, mtype, [f'{name}{{cache="{n}"}} {c.get(key, 0)}' for n, c in caches.items()])
+    lookups = {n: c.get('hits', 0) + c.get('misses', 0) for n, c in caches.items()}
+    metric('anki_sync_statcache_hit_ratio', 'Share of stat cache lookups served from cache since start', 'gauge',
+           [f'anki_sync_statcache_hit_ratio{{cache="{n}"}} {round(c.get("hits", 0) / lookups[n], 4) if lookups[n] else 0}'
+            for n, c in caches.items()])
+
+
+def collect_maintenance(metric):
+    # written by maintenance.py after every pass
+    maint = read_state('maintenance.json')
+    if not maint:
+        return
+    users = maint.get('users', {})
+    metric('anki_sync_maintenance_reclaimed_bytes_total', 'Bytes freed by checkpoints and VACUUM per user', 'counter',
+           [user_sample('anki_sync_maintenance_reclaimed_bytes_total', u, e.get('reclaimed_bytes_total', 0))
+            for u, e in users.items()])
+    metric('anki_sync_maintenance_seconds_total', 'Time spent maintaining each user\'s collection', 'counter',
+           [user_sample('anki_sync_maintenance_seconds_total', u, e.get('seconds_total', 0))
+            for u, e in users.items()])
+    metric('anki_sync_maintenance_runs_total', 'Maintenance runs per user', 'counter',
+           [user_sample('anki_sync_maintenance_runs_total', u, e.get('runs', 0)) for u, e in users.items()])
+    metric('anki_sync_maintenance_vacuums_total', 'VACUUMs per user', 'counter',
+           [user_sample('anki_sync_maintenance_vacuums_total', u, e.get('vacuums', 0))
+            for u, e in users.items()])
+    metric('anki_sync_maintenance_locked_total', 'Runs skipped because the collection was in use', 'counter',
+           [user_sample('anki_sync_maintenance_locked_total', u, e.get('locked', 0))
+            for u, e in users.items()])
+    metric('anki_sync_collection_free_ratio', 'Share of free pages in each collection at its last maintenance',
+           'gauge', [user_sample('anki_sync_collection_free_ratio', u, e['free_ratio'])
+                     for u, e in users.items() if 'free_ratio' in e])
+    metric('anki_sync_maintenance_last_run_timestamp_seconds', 'When each user was last maintained', 'gauge',
+           [user_sample('anki_sync_maintenance_last_run_timestamp_seconds', u, int(e.get('last_run', 0)))
+            for u, e in users.items()])
+    metric('anki_sync_maintenance_last_pass_timestamp_seconds', 'End of the last maintenance pass', 'gauge',
+           [f'anki_sync_maintenance_last_pass_timestamp_seconds {maint.get("last_pass", 0)}'])
+    metric('anki_sync_maintenance_last_pass_users', 'Users in the last pass by outcome', 'gauge',
+           [f'anki_sync_maintenance_last_pass_users{{outcome="{k}"}} {v}'
+            for k, v in maint.get('last_pass_counts', {}).items()])
+
+
+def collect_startup(metric):
+    # written by entrypoint.sh; the ownership repair finishes in the background
+    startup = read_state('startup.json')
+    if not startup:
+        return
+    phases = startup.get('phases', {})
+    if phases:
+        metric('anki_sync_startup_phase_seconds', 'Time spent in each container startup phase', 'gauge',
+               [f'anki_sync_startup_phase_seconds{{phase="{label(p)}"}} {v}' for p, v in phases.items()])
+    if 'ready_seconds' in startup:
+        metric('anki_sync_startup_ready_seconds', 'Seconds from container start until the sync server accepted '
+               'connections', 'gauge', [f'anki_sync_startup_ready_seconds {startup["ready_seconds"]}'])
+        metric('anki_sync_startup_seconds', 'Seconds from container start until every service was up', 'gauge',
+               [f'anki_sync_startup_seconds {startup["total_seconds"]}'])
+    repair = startup.get('ownership_repair', {})
+    metric('anki_sync_ownership_repair_running', 'Whether the background ownership repair is still running', 'gauge',
+           [f'anki_sync_ownership_repair_running {int(repair.get("state") == "running")}'])
+    if 'fixed' in repair:
+        metric('anki_sync_ownership_repair_fixed', 'Files and folders whose owner the last repair fixed', 'gauge',
+               [f'anki_sync_ownership_repair_fixed {repair["fixed"]}'])
+        metric('anki_sync_ownership_repair_seconds', 'Duration of the last background ownership repair', 'gauge',
+               [f'anki_sync_ownership_repair_seconds {repair["seconds"]}'])
+
+
+def collect_info(metric):
     metric('anki_sync_uptime_seconds', 'Metrics exporter uptime', 'counter',
            [f'anki_sync_uptime_seconds {int(time.time() - START_TIME)}'])
 
     metric('anki_sync_info', 'Server information', 'gauge',
            [f'anki_sync_info{{version="{label(ANKI_VERSION)}",tls="{label(TLS_ENABLED)}"}} 1'])
 
-    return '\n'.join(lines).encode()
+
+# names for ?collect[]=, in output order
+COLLECTORS = {
+    'users': collect_users,
+    'storage': collect_storage,
+    'collections': collect_collections,
+    'shards': collect_shards,
+    'backups': collect_backups,
+    'sessions': collect_sessions,
+    'auth': collect_auth,
+    'requests': collect_requests,
+    'transfer': collect_transfer,
+    'devices': collect_devices,
+    'cache': collect_cache,
+    'maintenance': collect_maintenance,
+    'startup': collect_startup,
+    'info': collect_info,
+}
+
+
+def build_metrics(collect=None, openmetrics=False, user_mode=None, users_only=False):
+    """The exposition text; users_only keeps just the per-user families, in
+    full, for /metrics/users"""
+    user_mode = user_mode or USER_MODE
+    lines = []
+
+    def metric(name, help_text, mtype, samples):
+        if users_only:
+            samples = [s for s in samples if not isinstance(s, str)]
+            if not samples:
+                return
+        elif user_mode != 'full':
+            mtype, samples = fold_users(name, mtype, samples, user_mode)
+        samples = [s if isinstance(s, str) else format_user_sample(s) for s in samples]
+        if openmetrics and mtype == 'counter':
+            # OpenMetrics names the counter family without _total and
+            # requires it on every sample
+            family = name[:-len('_total')] if name.endswith('_total') else name
+            samples = [f'{family}_total{s[len(family):]}' if s[len(family):][:1] in (' ', '{') else s
+                       for s in samples]
+            name = family
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {mtype}')
+        lines.extend(samples)
+        if not openmetrics:
+            lines.append('')
+
+    for name, collector in COLLECTORS.items():
+        if collect is None or name in collect:
+            collector(metric)
+
+    if openmetrics:
+        lines.append('# EOF')
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def qualities(header):
+    """q-value of each coding or media type in an Accept or Accept-Encoding
+    header, lowercased; the highest one when a type is listed twice"""
+    quality = {}
+    for part in header.split(','):
+        value, *params = part.split(';')
+        q = 1.0
+        for param in params:
+            key, _, v = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        value = value.strip().lower()
+        if value:
+            quality[value] = max(q, quality.get(value, 0.0))
+    return quality
+
+
+def accepts_gzip(header):
+    """Whether an Accept-Encoding header allows gzip; q=0 refuses it"""
+    quality = qualities(header)
+    return quality.get('gzip', quality.get('x-gzip', quality.get('*', 0))) > 0
+
+
+def wants_openmetrics(header):
+    """Whether an Accept header prefers OpenMetrics to the text format"""
+    quality = qualities(header)
+    om = quality.get('application/openmetrics-text', 0)
+    text = quality.get('text/plain', quality.get('text/*', quality.get('*/*', 0)))
+    return om > 0 and om >= text
+
+
+_users_bodies = {}
+_users_lock = threading.Lock()
+
+
+def users_metrics(collect, openmetrics):
+    """build_metrics for /metrics/users, reused for USERS_TTL seconds"""
+    key = (tuple(sorted(collect)) if collect else None, openmetrics)
+    with _users_lock:
+        at, body = _users_bodies.get(key, (0, None))
+        if body is None or time.time() - at >= USERS_TTL:
+            body = build_metrics(collect, openmetrics, 'full', True)
+            _users_bodies[key] = (time.time(), body)
+        return body
 
 
 class MetricsHandler(BaseHTTPRequestHandler):
     def do_GET(self):
-        if self.path not in ('/', '/metrics'):
+        url = urlsplit(self.path)
+        if url.path not in ('/', '/metrics', '/metrics/users'):
             self.send_error(404)
             return
-        body = build_metrics()
+        # node_exporter style: ?collect[]=storage&collect[]=backups
+        collect = parse_qs(url.query).get('collect[]')
+        unknown = sorted(set(collect or ()) - set(COLLECTORS))
+        if unknown:
+            self.send_error(400, f'unknown collector: {", ".join(unknown)}')
+            return
+        openmetrics = wants_openmetrics(self.headers.get('Accept', ''))
+        # every per-user series regardless of METRICS_USER_MODE, for a slow scrape job
+        if url.path == '/metrics/users':
+            body = users_metrics(collect, openmetrics)
+        else:
+            body = build_metrics(collect, openmetrics)
+        gzipped = accepts_gzip(self.headers.get('Accept-Encoding', ''))
+        if gzipped:
+            body = gzip.compress(body, compresslevel=6)
         self.send_response(200)
-        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        if openmetrics:
+            self.send_header('Content-Type', 'application/openmetrics-text; version=1.0.0; charset=utf-8')
+        else:
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Vary', 'Accept, Accept-Encoding')
         self.send_header('Content-Length', str(len(body)))
         self.end_headers()
         self.wfile.write(body)
@@ -0,0 +1,547 @@
+#!/usr/bin/env python3
+"""Follow server.log and turn request lines into the event logs and state the
+dashboard and exporter read.
+
+Server request lines look like
+  request{uri="/sync/meta" ip=1.2.3.4}: finished httpstatus=200 elap_ms=12 uid="alice" ...
+"""
+
+import fcntl
+import json
+import os
+import re
+import sys
+import time
+from collections import deque
+from datetime import datetime
+
+from authtrack import SlidingTopK
+from caddylog import ProxyJoin, parse_access
+
+LOG_DIR = os.environ.get('LOG_DIR', '/var/log/anki')
+STATE_DIR = os.environ.get('STATE_DIR', '/var/lib/anki')
+SERVER_LOG = os.environ.get('SERVER_LOG', os.path.join(LOG_DIR, 'server.log'))
+# Caddy's JSON access log, only written when TLS_ENABLED=true
+CADDY_LOG = os.environ.get('CADDY_LOG', os.path.join(LOG_DIR, 'caddy.log'))
+AUTH_TOP_K = int(os.environ.get('AUTH_TOP_K', 10))
+BACKUP_LOCK = os.environ.get('BACKUP_LOCK_FILE', os.path.join(STATE_DIR, 'backup.lock'))
+FLUSH_INTERVAL = 5
+# lines read from one log before turning to the other, so a backlog in
+# server.log doesn't run far ahead of caddy.log and break the join
+READ_BATCH = 500
+
+# anything else is counted as uri="other" to keep label cardinality bounded
+KNOWN_URIS = {
+    '/health',
+    '/sync/hostKey', '/sync/meta', '/sync/start', '/sync/applyGraves',
+    '/sync/applyChanges', '/sync/chunk', '/sync/applyChunk', '/sync/sanityCheck2',
+    '/sync/finish', '/sync/abort', '/sync/upload', '/sync/download',
+    '/msync/begin', '/msync/mediaChanges', '/msync/uploadChanges',
+    '/msync/downloadFiles', '/msync/mediaSanity',
+}
+LATENCY_BUCKETS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+ERROR_WINDOW = 300
+# a user counts as mid-sync until a closing request or this long without one
+SYNC_IDLE_AFTER = 30
+SYNC_CLOSING = {'/sync/finish', '/sync/abort', '/msync/mediaSanity'}
+RECENT_LATENCY_WINDOW = 60
+# an unfinished session is given up on after this long without a request; a
+# full upload or download is only logged once it ends, so this must outlast one
+SESSION_TIMEOUT = int(os.environ.get('SYNC_SESSION_TIMEOUT', 600))
+# a hostKey this recent from the same address is counted as the session's login
+SESSION_LOGIN_WINDOW = 60
+SESSION_BUCKETS = (1, 2, 5, 10, 30, 60, 120, 300, 600, 1800)
+SESSION_PHASES = {
+    '/sync/hostKey': 'login', '/sync/meta': 'meta',
+    '/sync/start': 'changes', '/sync/applyGraves': 'changes', '/sync/applyChanges': 'changes',
+    '/sync/chunk': 'chunks', '/sync/applyChunk': 'chunks', '/sync/sanityCheck2': 'sanity',
+    '/sync/finish': 'finish', '/sync/abort': 'abort',
+    '/sync/upload': 'upload', '/sync/download': 'download',
+}
+
+_ANSI = re.compile(r'\x1b\[[0-9;]*m')
+_FIELD = re.compile(r'(\w+)=("([^"]*)"|[^\s}]+)')
+_STAMP = re.compile(r'^\s*(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(?:\.\d+)?(?:Z|[+-]\d\d:?\d\d)?)')
+
+
+def stamp(now=None):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now))
+
+
+def append(name, text, now=None):
+    # open per line like the shell did, so rename rotation needs no signal
+    with open(os.path.join(LOG_DIR, name), 'a') as f:
+        f.write(f'[{stamp(now)}] {text}\n')
+
+
+def write_json(name, data):
+    path = os.path.join(STATE_DIR, name)
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def read_json(name, default=None):
+    try:
+        with open(os.path.join(STATE_DIR, name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def parse(line):
+    line = _ANSI.sub('', line)
+    if 'finished' not in line or 'httpstatus=' not in line:
+        return None
+    fields = {}
+    for m in _FIELD.finditer(line):
+        fields.setdefault(m.group(1), m.group(3) if m.group(3) is not None else m.group(2))
+    m = _STAMP.match(line)
+    if m:
+        try:
+            fields['_ts'] = datetime.fromisoformat(m.group(1)).timestamp()
+        except ValueError:
+            pass
+    return fields
+
+
+def normalize_uri(uri):
+    uri = uri.split('?', 1)[0]
+    return uri if uri in KNOWN_URIS else 'other'
+
+
+def normalize_status(status):
+    return status if len(status) == 3 and status.isdigit() else 'other'
+
+
+class RequestStats:
+    """Per-endpoint counters; cumulative totals survive restarts via requests.json"""
+
+    def __init__(self, saved=None):
+        saved = saved or {}
+        self.counts = {}  # (uri, status) -> [count, ms_sum]
+        for e in saved.get('requests', []):
+            self.counts[(e['uri'], e['status'])] = [e['count'], e['ms_sum']]
+        self.buckets = {u: list(b) for u, b in saved.get('buckets', {}).items()}
+        self.recent = {}  # uri -> {minute: [total, errors]}
+
+    def add(self, uri, status, ms, now):
+        entry = self.counts.setdefault((uri, status), [0, 0])
+        entry[0] += 1
+        entry[1] += ms
+        buckets = self.buckets.setdefault(uri, [0] * (len(LATENCY_BUCKETS) + 1))
+        for i, le in enumerate(LATENCY_BUCKETS):
+            if ms <= le:
+                buckets[i] += 1
+                break
+        else:
+            buckets[-1] += 1
+        minute = int(now // 60)
+        recent = self.recent.setdefault(uri, {})
+        slot = recent.setdefault(minute, [0, 0])
+        slot[0] += 1
+        slot[1] += status == 'other' or status[0] in '45'
+
+    def error_ratios(self, now):
+        oldest = int(now // 60) - ERROR_WINDOW // 60
+        ratios = {}
+        for uri, recent in list(self.recent.items()):
+            for m in [m for m in recent if m <= oldest]:
+                del recent[m]
+            if not recent:
+                del self.recent[uri]
+                continue
+            total = sum(t for t, _ in recent.values())
+            ratios[uri] = round(sum(e for _, e in recent.values()) / total, 4)
+        return ratios
+
+    def snapshot(self, now):
+        return {
+            'updated': int(now),
+            'requests': [{'uri': u, 'status': s, 'count': c, 'ms_sum': ms}
+                         for (u, s), (c, ms) in sorted(self.counts.items())],
+            'buckets': self.buckets,
+            'bucket_bounds': list(LATENCY_BUCKETS),
+            'error_ratio_window': ERROR_WINDOW,
+            'error_ratio': self.error_ratios(now),
+        }
+
+
+def backup_running():
+    """True while backup.sh holds backup.lock (probing never blocks it: the
+    script waits a few seconds for the lock before giving up)"""
+    try:
+        fd = os.open(BACKUP_LOCK, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        return False
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
+
+
+def shared_address(ip):
+    """Whether many clients can arrive from ip: the local TLS proxy, or unknown"""
+    return ip == 'unknown' or ip == '::1' or ip.startswith('127.')
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0
+
+
+class SyncActivity:
+    """Who is mid-sync and how fast syncs are, for backup.sh to yield to;
+    sync latency is also bucketed by whether a backup was running, so the
+    cost of backups shows up in the exporter"""
+
+    def __init__(self, saved=None):
+        saved = saved or {}
+        self.last = {}  # uid -> (time, uri) of their latest request
+        self.recent = deque()  # (time, ms) of sync requests
+        self.impact = {state: {'buckets': list(v['buckets']), 'sum': v['sum'], 'count': v['count']}
+                       for state, v in saved.get('impact', {}).items()}
+        self.backup = backup_running()
+
+    def add(self, uid, uri, ms, now):
+        if uid is not None:
+            self.last[uid] = (now, uri)
+        if not uri.startswith(('/sync/', '/msync/')) or uri == '/sync/hostKey':
+            return
+        self.recent.append((now, ms))
+        hist = self.impact.setdefault('running' if self.backup else 'idle',
+                                      {'buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'sum': 0, 'count': 0})
+        hist['buckets'][next((i for i, le in enumerate(LATENCY_BUCKETS) if ms <= le), -1)] += 1
+        hist['sum'] += ms
+        hist['count'] += 1
+
+    def active(self, now):
+        for uid, (ts, _) in list(self.last.items()):
+            if now - ts > SYNC_IDLE_AFTER:
+                del self.last[uid]
+        return sorted(uid for uid, (_, uri) in self.last.items() if uri not in SYNC_CLOSING)
+
+    def snapshot(self, now):
+        self.backup = backup_running()
+        while self.recent and now - self.recent[0][0] > RECENT_LATENCY_WINDOW:
+            self.recent.popleft()
+        return {
+            'updated': int(now),
+            'active': self.active(now),
+            'recent_p95_ms': percentile([ms for _, ms in self.recent], 0.95),
+            'recent_window': RECENT_LATENCY_WINDOW,
+            'backup_running': self.backup,
+            'bucket_bounds': list(LATENCY_BUCKETS),
+            'impact': self.impact,
+        }
+
+
+class SyncSessions:
+    """Groups each client's requests, from login through media sync, into one
+    record per sync session, appended to sessions.log as compact JSON:
+
+      {"user":..,"device":..,"type":..,"outcome":..,"start":..,"wall_ms":..,
+       "server_ms":..,"requests":..,"phases":{"meta":12,"chunks":840,..}}
+
+    type is full_upload or full_download when the session transferred the
+    whole collection, normal for an incremental sync, media when only media
+    was synced and check when meta found nothing to do. phases sums the
+    server's time per step; wall_ms also covers the network and the client.
+    Duration histograms by type survive restarts via sessions.json.
+
+    Quiet sessions are expired against the newest log time seen, so catching
+    up on a backlog doesn't close them all as incomplete. A login is only
+    credited to a session of the same user (when the server logs the uid on
+    hostKey) or, failing that, from the same address when that address
+    isn't shared: behind the TLS proxy every client is 127.0.0.1.
+    """
+
+    def __init__(self, saved=None):
+        saved = saved or {}
+        self.open = {}  # (uid, ip) -> session
+        self.logins = {}  # (ip, uid or None) -> (start, ms) of the latest successful hostKey
+        self.latest = 0.0  # newest log time seen
+        self.types = {t: {'buckets': list(v['buckets']), 'sum': v['sum'], 'count': v['count']}
+                      for t, v in saved.get('types', {}).items()}
+        self.outcomes = {t: dict(v) for t, v in saved.get('outcomes', {}).items()}
+        self.phases = {t: dict(v) for t, v in saved.get('phase_ms', {}).items()}
+        self.dirty = False
+
+    def add(self, uid, ip, uri, status, ms, ts, client=None):
+        start = ts - ms / 1000
+        self.latest = max(self.latest, ts)
+        if uri == '/sync/hostKey':
+            if status == '200':
+                self.logins[(ip, uid)] = (start, ms)
+            return
+        if uid is None or not uri.startswith(('/sync/', '/msync/')):
+            return
+        key = (uid, ip)
+        session = self.open.get(key)
+        # meta is the first call of every sync, so it starts a new session
+        if session is not None and uri == '/sync/meta':
+            self.close(key, ts)
+            session = None
+        if session is None:
+            session = self.open[key] = {'user': uid, 'device': '', 'start': start, 'end': ts,
+                                        'server_ms': 0, 'requests': 0, 'phases': {},
+                                        'done': False, 'aborted': False, 'error': None}
+            login = self.logins.pop((ip, uid), None)
+            if login is None and not shared_address(ip):
+                login = self.logins.pop((ip, None), None)
+            if login and 0 <= start - login[0] <= SESSION_LOGIN_WINDOW:
+                session['start'] = login[0]
+                session['phases']['login'] = login[1]
+                session['server_ms'] += login[1]
+                session['requests'] += 1
+        phase = SESSION_PHASES.get(uri, 'media' if uri.startswith('/msync/') else 'other')
+        session['phases'][phase] = session['phases'].get(phase, 0) + ms
+        session['server_ms'] += ms
+        session['requests'] += 1
+        session['end'] = max(session['end'], ts)
+        if client:
+            session['device'] = client
+        if status[:1] not in ('1', '2', '3') and session['error'] is None:
+            session['error'] = uri
+        elif uri in ('/sync/finish', '/sync/upload', '/sync/download'):
+            session['done'] = True
+        if uri == '/sync/abort':
+            session['aborted'] = True
+        # media sync comes last, so its sanity check (or an abort) ends the session
+        if uri in ('/sync/abort', '/msync/mediaSanity'):
+            self.close(key, ts)
+
+    def close(self, key, now):
+        s = self.open.pop(key)
+        phases = s['phases']
+        if 'upload' in phases:
+            kind = 'full_upload'
+        elif 'download' in phases:
+            kind = 'full_download'
+        elif phases.keys() & {'changes', 'chunks', 'sanity', 'finish', 'abort'}:
+            kind = 'normal'
+        elif 'media' in phases:
+            kind = 'media'
+        else:
+            kind = 'check'
+        if s['error']:
+            outcome = 'error'
+        elif s['aborted']:
+            outcome = 'aborted'
+        elif s['done'] or kind in ('media', 'check'):
+            outcome = 'ok'
+        else:
+            outcome = 'incomplete'
+        wall = max(0, int((s['end'] - s['start']) * 1000))
+        record = {'user': s['user'], 'device': s['device'], 'type': kind, 'outcome': outcome,
+                  'start': round(s['start'], 3), 'wall_ms': wall, 'server_ms': s['server_ms'],
+                  'requests': s['requests'], 'phases': phases}
+        if s['error']:
+            record['error_at'] = s['error']
+        append('sessions.log', 'SESSION ' + json.dumps(record, separators=(',', ':')), now)
+
+        hist = self.types.setdefault(kind, {'buckets': [0] * (len(SESSION_BUCKETS) + 1), 'sum': 0, 'count': 0})
+        hist['buckets'][next((i for i, le in enumerate(SESSION_BUCKETS) if wall <= le * 1000), -1)] += 1
+        hist['sum'] = round(hist['sum'] + wall / 1000, 3)
+        hist['count'] += 1
+        outcomes = self.outcomes.setdefault(kind, {})
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        totals = self.phases.setdefault(kind, {})
+        for phase, ms in phases.items():
+            totals[phase] = totals.get(phase, 0) + ms
+        self.dirty = True
+
+    def expire(self, now, caught_up=True):
+        """Close sessions that went quiet; one that already finished its
+        collection sync only waits briefly for a media sync to follow. Until
+        the log is caught up, quiet is measured in log time."""
+        clock = max(now, self.latest) if caught_up else self.latest
+        for key, s in list(self.open.items()):
+            if clock - s['end'] > (SYNC_IDLE_AFTER if s['done'] else SESSION_TIMEOUT):
+                self.close(key, now)
+        for key, (start, _) in list(self.logins.items()):
+            if clock - start > SESSION_LOGIN_WINDOW:
+                del self.logins[key]
+
+    def snapshot(self, now):
+        return {
+            'updated': int(now),
+            'bucket_bounds': list(SESSION_BUCKETS),
+            'types': self.types,
+            'outcomes': self.outcomes,
+            'phase_ms': self.phases,
+        }
+
+
+def follow(path, position=None):
+    """tail -F with a resumable (inode, offset) position; yields (line, position),
+    or (None, position) whenever there is nothing new to read"""
+    f = None
+    inode = None
+    while True:
+        if f is None:
+            try:
+                f = open(path, 'rb')
+            except OSError:
+                position = position or ()  # read a file that appears later from the start
+                yield None, position
+                continue
+            inode = os.fstat(f.fileno()).st_ino
+            if position and position[0] == inode and position[1] <= os.fstat(f.fileno()).st_size:
+                f.seek(position[1])
+            elif position is None:
+                f.seek(0, os.SEEK_END)
+            position = (inode, f.tell())
+        line = f.readline()
+        if line.endswith(b'\n'):
+            position = (inode, f.tell())
+            yield line.decode(errors='replace'), position
+            continue
+        f.seek(position[1])
+        yield None, position
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if st.st_ino != inode:
+            # renamed away: finish the old file, then start the new one at 0
+            rest = f.read()
+            for chunk in rest.split(b'\n')[:-1] if rest else []:
+                yield chunk.decode(errors='replace') + '\n', position
+            f.close()
+            f = None
+            position = ()
+        elif st.st_size < position[1]:
+            f.seek(0)  # copy-truncated
+            position = (inode, 0)
+
+
+class Monitor:
+    def __init__(self):
+        self.auth = SlidingTopK(k=AUTH_TOP_K)
+        self.requests = RequestStats(read_json('requests.json'))
+        self.proxy = ProxyJoin(read_json('transfer.json'))
+        self.activity = SyncActivity(read_json('sync_activity.json'))
+        self.sessions = SyncSessions(read_json('sessions.json'))
+        self.dirty = False
+        self.proxy_dirty = False
+        self.caught_up = set()  # sources with nothing more to read right now
+
+    def handle_server_line(self, line, now):
+        fields = parse(line)
+        if fields:
+            self.handle(fields, now)
+
+    def handle_caddy_line(self, line, now):
+        entry = parse_access(line)
+        if entry:
+            entry['uri'] = normalize_uri(entry['uri'])
+            entry['status'] = normalize_status(entry['status'])
+            self.proxy.add_edge(entry)
+            self.proxy_dirty = True
+
+    def handle(self, fields, now):
+        status = fields.get('httpstatus', '')
+        uri = fields.get('uri', '')
+        ip = fields.get('ip') or 'unknown'
+        uid = fields.get('uid')
+        elap = fields.get('elap_ms', '')
+
+        self.requests.add(normalize_uri(uri), normalize_status(status),
+                          int(elap) if elap.isdigit() else 0, now)
+        self.proxy.add_upstream(fields.get('_ts', now), normalize_uri(uri), normalize_status(status),
+                                uid, int(elap) if elap.isdigit() else 0)
+        self.activity.add(uid, normalize_uri(uri), int(elap) if elap.isdigit() else 0, now)
+        self.sessions.add(uid, ip, normalize_uri(uri), normalize_status(status),
+                          int(elap) if elap.isdigit() else 0, fields.get('_ts', now), fields.get('client'))
+        self.dirty = True
+
+        # authenticated requests carry uid=; record their latency
+        if uid is not None and status == '200' and elap.isdigit():
+            append('latency.log', f'LATENCY uri="{uri}" ms={elap}', now)
+
+        if uri == '/sync/hostKey':
+            if status == '200':
+                append('auth.log', f'AUTH_SUCCESS ip="{ip}"', now)
+            else:
+                append('auth.log', f'AUTH_FAILED ip="{ip}"', now)
+                self.auth.add(ip, now)
+        elif uri == '/sync/meta' and status == '200' and uid is not None:
+            append('devices.log', f'DEVICE uid="{uid}" client="{fields.get("client", "")}"', now)
+        elif uri == '/sync/finish' and status == '200':
+            append('sync.log', f'SYNC_COMPLETE uid="{uid or "unknown"}"', now)
+            path = os.path.join(STATE_DIR, 'sync_count.txt')
+            try:
+                count = int(open(path).read().strip() or 0)
+            except (OSError, ValueError):
+                count = 0
+            with open(path, 'w') as f:
+                f.write(f'{count + 1}\n')
+
+    def flush(self, now):
+        write_json('auth_top.json', {
+            'updated': int(now),
+            'failed_seen': self.auth.total,
+            'sketch_bytes': self.auth.memory_bytes(),
+            'windows': self.auth.snapshot(now),
+        })
+        # error ratios slide too, so refresh while there was recent traffic
+        if self.dirty or self.requests.recent:
+            write_json('requests.json', self.requests.snapshot(now))
+        self.dirty = False
+        # written every flush: backup.sh treats a stale file as "monitor down"
+        write_json('sync_activity.json', self.activity.snapshot(now))
+        self.sessions.expire(now, 'server' in self.caught_up)
+        if self.sessions.dirty:
+            write_json('sessions.json', self.sessions.snapshot(now))
+            self.sessions.dirty = False
+        if self.proxy_dirty:
+            write_json('transfer.json', self.proxy.snapshot(now))
+            with open(os.path.join(STATE_DIR, 'bytes_synced.txt'), 'w') as f:
+                f.write(f'{self.proxy.total_bytes()}\n')
+            self.proxy_dirty = False
+
+
+def main():
+    monitor = Monitor()
+    saved = read_json('monitor.json', {}).get('positions', {})
+    sources = [('server', SERVER_LOG, monitor.handle_server_line),
+               ('caddy', CADDY_LOG, monitor.handle_caddy_line)]
+    followers = [(name, follow(path, tuple(saved[name]) if saved.get(name) else None), handler)
+                 for name, path, handler in sources]
+    positions = {}
+    last_flush = 0.0
+    while True:
+        idle = True
+        for name, lines, handler in followers:
+            for n, (line, position) in enumerate(lines, 1):
+                positions[name] = position
+                if line is None:
+                    monitor.caught_up.add(name)
+                    break
+                monitor.caught_up.discard(name)
+                idle = False
+                try:
+                    handler(line, time.time())
+                except OSError as e:
+                    print(f'[{stamp()}] [MONITOR] {e}', file=sys.stderr)
+                if n >= READ_BATCH:
+                    break
+        if monitor.proxy.expire(time.time(), 'server' in monitor.caught_up, 'caddy' in monitor.caught_up):
+            monitor.proxy_dirty = True
+        now = time.time()
+        if now - last_flush >= FLUSH_INTERVAL:
+            # windows slide even without new failures
+            monitor.flush(now)
+            write_json('monitor.json', {'positions': {k: list(v) for k, v in positions.items() if v}})
+            last_flush = now
+        if idle:
+            time.sleep(0.25)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,9 +4,19 @@
 # =============================================================================
 
 set -e
+set -o pipefail
 
 BACKUP_DIR="${BACKUP_DIR:-/backups}"
 DATA_DIR="${SYNC_BASE:-/data}"
+STATE_DIR="${STATE_DIR:-/var/lib/anki}"
+LOCK_FILE="${BACKUP_LOCK_FILE:-$STATE_DIR/backup.lock}"
+# previous data is kept as $DATA_DIR/.pre_restore_<timestamp>; this many are kept
+RESTORE_KEEP_SAFETY="${RESTORE_KEEP_SAFETY:-1}"
+
+# entrypoint.sh's supervisor stops the sync servers while the hold file exists
+SUPERVISOR_PID_FILE=/var/run/anki-supervisor.pid
+HOLD_FILE="$STATE_DIR/supervisor.hold"
+SERVERS_PID_FILE="$STATE_DIR/sync_servers.pid"
 
 log() {
     echo "[$(date '+%Y-%m-%d %H:%M:%S')] [RESTORE] $*"
@@ -21,8 +31,10 @@ Restore Anki sync server data from a backup.
 Options:
   -l, --list       List available local backups
   -L, --list-s3    List available S3 backups
-  -s, --s3         Download and restore from S3
-  -d, --download   Download from S3 only (don't restore)
+  -s, --s3         Restore from S3, streaming the backup into the extraction
+  -d, --download   Download from S3 only (don't restore); resumes a partial
+                   download
+  -r, --rollback   Put back the data the last restore replaced
   -f, --force      Skip confirmation prompt
   -h, --help       Show this help message
 
@@ -32,9 +44,154 @@ Examples:
   restore.sh anki_backup_20240101_030000.tar.gz
   restore.sh --s3 anki_backup_20240101_030000.tar.gz
   restore.sh --download anki_backup_20240101_030000.tar.gz
+  restore.sh --rollback
+
+The backup is extracted next to the live data and checked first; the sync
+server is only stopped for the few renames that swap it in. The replaced
+data stays in $DATA_DIR/.pre_restore_<timestamp> (the newest
+RESTORE_KEEP_SAFETY are kept) until --rollback or a later restore.
 EOF
 }
 
+# Files restored as root would not be writable by the server
+as_anki() {
+    if [ "$(id -u)" = "0" ] && id anki > /dev/null 2>&1; then
+        setpriv --reuid anki --regid anki --init-groups "$@"
+    else
+        "$@"
+    fi
+}
+
+ms_now() {
+    echo $(( ${EPOCHREALTIME/./} / 1000 ))
+}
+
+supervisor_pid() {
+    local pid
+    pid=$(cat "$SUPERVISOR_PID_FILE" 2>/dev/null) && kill -0 "$pid" 2>/dev/null && echo "$pid"
+}
+
+# wait_servers running|stopped: until sync_servers.pid says so, up to 60s
+wait_servers() {
+    local i
+    for i in $(seq 600); do
+        if grep -q '[0-9]' "$SERVERS_PID_FILE" 2>/dev/null; then
+            [ "$1" = "running" ] && return 0
+        else
+            [ "$1" = "stopped" ] && return 0
+        fi
+        sleep 0.1
+    done
+    return 1
+}
+
+hold_servers() {
+    local pid
+    if ! pid=$(supervisor_pid); then
+        log "Sync server supervisor not running, not stopping the server"
+        return 0
+    fi
+    echo $$ > "$HOLD_FILE"
+    kill -HUP "$pid"
+    wait_servers stopped || { log "Error: sync server did not stop"; return 1; }
+}
+
+release_servers() {
+    [ -e "$HOLD_FILE" ] || return 0
+    rm -f "$HOLD_FILE"
+    local pid
+    if pid=$(supervisor_pid); then
+        kill -HUP "$pid"
+        wait_servers running || log "WARN: sync server did not come back, check /var/log/anki/server.log"
+    fi
+}
+
+# quick_check every collection and media database, a few at a time
+verify_restore() {
+    local dir="$1"
+    if [ -z "$(find "$dir" -mindepth 1 -maxdepth 1 -print -quit)" ]; then
+        log "Error: backup is empty"
+        return 1
+    fi
+    local bad
+    bad=$(find "$dir" -type f \( -name '*.anki2' -o -name '*.db' \) -print0 \
+          | xargs -0 -r -n 1 -P "$(nproc)" sh -c \
+              '[ "$(sqlite3 -readonly "$1" "PRAGMA quick_check" 2>&1)" = "ok" ] || echo "$1"' _)
+    if [ -n "$bad" ]; then
+        log "Error: damaged databases in the backup:"
+        echo "$bad" | sed "s|^$dir/|  |"
+        return 1
+    fi
+}
+
+# Replace the live entries of DATA_DIR (not the dot-directories) with those of
+# $1, moving the live ones to $2. Renames within one filesystem, so this takes
+# milliseconds however big the data is; a failed rename is undone.
+swap_data() {
+    local src="$1" safety="$2" e
+    local -a moved_out=() moved_in=()
+    as_anki mkdir "$safety"
+    while IFS= read -r -d '' e; do
+        mv "$e" "$safety/" || { swap_undo; return 1; }
+        moved_out+=("${e##*/}")
+    done < <(find "$DATA_DIR" -mindepth 1 -maxdepth 1 ! -name '.*' -print0)
+    while IFS= read -r -d '' e; do
+        mv "$e" "$DATA_DIR/" || { swap_undo; return 1; }
+        moved_in+=("${e##*/}")
+    done < <(find "$src" -mindepth 1 -maxdepth 1 -print0)
+    return 0
+}
+
+swap_undo() {
+    log "Swap failed, putting the previous data back"
+    local name
+    for name in "${moved_in[@]}"; do mv "$DATA_DIR/$name" "$src/" || true; done
+    for name in "${moved_out[@]}"; do mv "$safety/$name" "$DATA_DIR/" || true; done
+    rmdir "$safety" 2>/dev/null || true
+}
+
+# Swap $1 in with the servers stopped and no backup reading DATA_DIR
+swap_with_hold() {
+    local src="$1" safety="$DATA_DIR/.pre_restore_$(date +%Y%m%d_%H%M%S)"
+    [ ! -e "$safety" ] || safety+="_$$"
+    exec 9>>"$LOCK_FILE"
+    if ! flock -n 9; then
+        log "Waiting for the running backup to finish..."
+        # keeps maintenance.py from starting more users meanwhile
+        echo $$ > "$LOCK_FILE.pending.$$"
+        local got=0
+        flock -w 3600 9 && got=1
+        rm -f "$LOCK_FILE.pending.$$"
+        [ "$got" -eq 1 ] || { log "Error: backup still running"; return 1; }
+    fi
+    local t0
+    t0=$(ms_now)
+    hold_servers || return 1
+    local rc=0
+    swap_data "$src" "$safety" || rc=1
+    release_servers
+    flock -u 9
+    [ "$rc" -eq 0 ] || return 1
+    rmdir "$src" 2>/dev/null || true
+    SAFETY_DIR="$safety"
+    log "Swapped in, sync server was down for $(( $(ms_now) - t0 )) ms"
+}
+
+prune_safety() {
+    local old
+    ls -1d "$DATA_DIR"/.pre_restore_* 2>/dev/null | sort -r | tail -n +$((RESTORE_KEEP_SAFETY + 1)) | while IFS= read -r old; do
+        log "Removing old safety copy $(basename "$old")"
+        rm -rf "$old"
+    done
+}
+
+cleanup() {
+    release_servers
+    if [ -n "$RESTORE_DIR" ] && [ -d "$RESTORE_DIR" ]; then
+        rm -rf "$RESTORE_DIR"
+    fi
+}
+
 list_local_backups() {
     echo ""
     echo "Local backups in $BACKUP_DIR:"
@@ -107,98 +264,61 @@ EOF
     echo ""
 }
 
+# --download: into BACKUP_DIR via a .part file that a rerun resumes
 download_from_s3() {
     local backup_file="$1"
-    local dest="${BACKUP_DIR}/${backup_file}"
-    
     log "Downloading $backup_file from S3..."
-    
-    python3 << EOF
-import boto3
-import os
-import sys
-from botocore.config import Config
-
-endpoint = os.environ.get('S3_ENDPOINT', '')
-bucket = os.environ.get('S3_BUCKET', '')
-access_key = os.environ.get('S3_ACCESS_KEY', '')
-secret_key = os.environ.get('S3_SECRET_KEY', '')
-region = os.environ.get('S3_REGION', 'us-east-1')
-
-config = Config(signature_version='s3v4')
-
-try:
-    if endpoint:
-        s3 = boto3.client('s3',
-            endpoint_url=endpoint,
-            aws_access_key_id=access_key,
-            aws_secret_access_key=secret_key,
-            region_name=region,
-            config=config
-        )
-    else:
-        s3 = boto3.client('s3',
-            aws_access_key_id=access_key,
-            aws_secret_access_key=secret_key,
-            region_name=region,
-            config=config
-        )
-
-    s3_key = "anki-backups/${backup_file}"
-    local_file = "${dest}"
+    python3 /usr/local/bin/s3fetch.py "$backup_file" "${BACKUP_DIR}/${backup_file}"
+}
 
-    print(f"Downloading s3://{bucket}/{s3_key}")
-    s3.download_file(bucket, s3_key, local_file)
-    print(f"Downloaded to {local_file}")
-except Exception as e:
-    print(f"Error: {e}")
-    sys.exit(1)
-EOF
-    return $?
+# Decompress and unpack $1 into $2. A backup on S3 is streamed: parts are
+# fetched concurrently and fed to pigz in order, with no local copy.
+extract_backup() {
+    local source="$1" dest="$2" gunzip="gzip -dc"
+    command -v pigz > /dev/null 2>&1 && gunzip="pigz -dc"
+    if [ "$FROM_S3" = "true" ]; then
+        python3 /usr/local/bin/s3fetch.py "$source" - | $gunzip | as_anki tar -x -C "$dest"
+    else
+        $gunzip < "$source" | as_anki tar -x -C "$dest"
+    fi
 }
 
 do_restore() {
     local backup_path="$1"
     
     log "Restoring from $(basename "$backup_path")..."
+    trap cleanup EXIT
     
-    # Create safety backup (SQLite-safe staging, same approach as backup.sh)
-    SAFETY_BACKUP="pre_restore_$(date +%Y%m%d_%H%M%S).tar.gz"
-    if [ -d "$DATA_DIR" ] && [ "$(ls -A "$DATA_DIR" 2>/dev/null)" ]; then
-        log "Creating safety backup: $SAFETY_BACKUP"
-        STAGING=$(mktemp -d "${BACKUP_DIR}/.staging.XXXXXX")
-        (
-            cd "$DATA_DIR"
-            find . -type d -exec mkdir -p "$STAGING/{}" \;
-            find . -type f ! -name '*.anki2*' ! -name '*.db' ! -name '*-wal' ! -name '*-shm' \
-                -exec cp -a {} "$STAGING/{}" \;
-            find . -type f \( -name '*.anki2' -o -name '*.db' \) -print0 | while IFS= read -r -d '' db; do
-                if ! sqlite3 -cmd '.timeout 10000' "$db" ".backup '$STAGING/$db'" 2>/dev/null; then
-                    cp -a "$db" "$STAGING/$db"
-                    for sib in "$db-wal" "$db-shm"; do
-                        [ -f "$sib" ] && cp -a "$sib" "$STAGING/$sib" || true
-                    done
-                fi
-            done
-            tar -C "$STAGING" -czf "${BACKUP_DIR}/${SAFETY_BACKUP}" .
-        ) || log "WARN: safety backup failed"
-        rm -rf "$STAGING"
-    fi
-    
-    # Clear and restore
-    log "Clearing current data..."
-    rm -rf "${DATA_DIR:?}"/* 2>/dev/null || true
+    # Extract next to the live data (same filesystem, so the swap is renames)
+    # while the server keeps running. pigz decompresses with reading, writing
+    # and checksumming on separate threads.
+    local t0
+    t0=$(ms_now)
+    RESTORE_DIR=$(as_anki mktemp -d "$DATA_DIR/.restore.XXXXXX")
+    log "Extracting backup into $(basename "$RESTORE_DIR")..."
+    extract_backup "$backup_path" "$RESTORE_DIR"
+    log "Extracted in $(( ($(ms_now) - t0) / 1000 ))s, verifying..."
+    verify_restore "$RESTORE_DIR"
     
-    log "Extracting backup..."
-    tar -xzf "$backup_path" -C "$DATA_DIR"
-    
-    # Fix permissions
-    chown -R anki:anki "$DATA_DIR" 2>/dev/null || true
+    swap_with_hold "$RESTORE_DIR"
+    RESTORE_DIR=""
     
     log "Restore complete!"
-    [ -f "${BACKUP_DIR}/${SAFETY_BACKUP}" ] && log "Safety backup: $SAFETY_BACKUP"
-    echo ""
-    echo "IMPORTANT: Restart the container to apply changes."
+    log "Previous data: $SAFETY_DIR (restore.sh --rollback puts it back)"
+    prune_safety
+}
+
+do_rollback() {
+    local latest
+    latest=$(ls -1d "$DATA_DIR"/.pre_restore_* 2>/dev/null | sort -r | head -n 1)
+    if [ -z "$latest" ]; then
+        log "Error: no safety copy in $DATA_DIR to roll back to"
+        exit 1
+    fi
+    log "Rolling back to $(basename "$latest")..."
+    trap cleanup EXIT
+    swap_with_hold "$latest"
+    log "Rollback complete! The replaced data is in $SAFETY_DIR"
 }
 
 # =============================================================================
@@ -209,6 +329,7 @@ LIST_LOCAL=false
 LIST_S3=false
 FROM_S3=false
 DOWNLOAD_ONLY=false
+ROLLBACK=false
 FORCE=false
 BACKUP_FILE=""
 
@@ -231,6 +352,10 @@ while [[ $# -gt 0 ]]; do
             FROM_S3=true
             shift
             ;;
+        -r|--rollback)
+            ROLLBACK=true
+            shift
+            ;;
         -f|--force)
             FORCE=true
             shift
@@ -253,6 +378,15 @@ if [ "$LIST_LOCAL" = "true" ] || [ "$LIST_S3" = "true" ]; then
     exit 0
 fi
 
+if [ "$ROLLBACK" = "true" ]; then
+    if [ "$FORCE" != "true" ]; then
+        read -p "Replace the data in $DATA_DIR with the last safety copy? (yes/no): " confirm
+        [ "$confirm" != "yes" ] && { echo "Cancelled."; exit 0; }
+    fi
+    do_rollback
+    exit 0
+fi
+
 # No file specified - show both lists
 if [ -z "$BACKUP_FILE" ]; then
     list_local_backups
@@ -261,25 +395,29 @@ if [ -z "$BACKUP_FILE" ]; then
     exit 0
 fi
 
-# Download from S3 if requested
-if [ "$FROM_S3" = "true" ]; then
+if [ "$DOWNLOAD_ONLY" = "true" ]; then
     download_from_s3 "$BACKUP_FILE" || exit 1
-    [ "$DOWNLOAD_ONLY" = "true" ] && { log "Download complete."; exit 0; }
+    log "Download complete."
+    exit 0
 fi
 
-# Check backup exists
-BACKUP_PATH="${BACKUP_DIR}/${BACKUP_FILE}"
-if [ ! -f "$BACKUP_PATH" ]; then
-    log "Error: Backup not found: $BACKUP_PATH"
-    list_local_backups
-    exit 1
+if [ "$FROM_S3" = "true" ]; then
+    # streamed straight into the extraction by do_restore
+    BACKUP_PATH="$BACKUP_FILE"
+else
+    BACKUP_PATH="${BACKUP_DIR}/${BACKUP_FILE}"
+    if [ ! -f "$BACKUP_PATH" ]; then
+        log "Error: Backup not found: $BACKUP_PATH"
+        list_local_backups
+        exit 1
+    fi
 fi
 
 # Confirmation
 if [ "$FORCE" != "true" ]; then
     echo ""
     echo "WARNING: This will overwrite all data in $DATA_DIR"
-    echo "Backup: $BACKUP_PATH"
+    echo "Backup: $([ "$FROM_S3" = "true" ] && echo "s3://$S3_BUCKET/anki-backups/$BACKUP_FILE" || echo "$BACKUP_PATH")"
     echo ""
     read -p "Proceed? (yes/no): " confirm
     [ "$confirm" != "yes" ] && { echo "Cancelled."; exit 0; }
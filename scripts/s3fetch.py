@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""Fetch a backup from S3 with concurrent ranged GETs.
+
+The object is split into S3_RESTORE_PART_MB parts, and S3_RESTORE_CONCURRENCY
+of them are downloaded at once, all pinned to the ETag seen at the start so
+a backup replaced mid-download fails instead of mixing two archives.
+
+  s3fetch.py KEY -              stream the object to stdout in order, for
+                                restore.sh to pipe into pigz | tar; at most
+                                two parts per connection are held in memory
+  s3fetch.py KEY FILE           download into FILE.part and rename it when
+                                complete; finished parts are recorded in
+                                FILE.part.json, so a rerun after an
+                                interruption only fetches what is missing
+
+A part whose connection breaks is retried up to S3_RESTORE_RETRIES times
+with backoff, asking only for the bytes it doesn't have yet. Progress goes
+to stderr every few seconds. S3_ENDPOINT points it at MinIO, Garage or any
+other S3-compatible store (a local moto server works for testing).
+"""
+
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+BUCKET = os.environ.get('S3_BUCKET', '')
+PREFIX = 'anki-backups/'
+PART_SIZE = max(1, int(float(os.environ.get('S3_RESTORE_PART_MB', 8)) * 1024 * 1024))
+CONCURRENCY = max(1, int(os.environ.get('S3_RESTORE_CONCURRENCY', 8)))
+RETRIES = int(os.environ.get('S3_RESTORE_RETRIES', 5))
+PROGRESS_INTERVAL = 5
+READ_CHUNK = 1024 * 1024
+# errors a retry can't fix
+FATAL = {'PreconditionFailed', 'NoSuchKey', 'NoSuchBucket', 'AccessDenied', 'InvalidAccessKeyId',
+         'SignatureDoesNotMatch', '403', '404', '412'}
+
+
+def log(msg):
+    print(f'[{time.strftime("%Y-%m-%d %H:%M:%S")}] [S3] {msg}', file=sys.stderr, flush=True)
+
+
+def client():
+    kwargs = {
+        'aws_access_key_id': os.environ.get('S3_ACCESS_KEY', ''),
+        'aws_secret_access_key': os.environ.get('S3_SECRET_KEY', ''),
+        'region_name': os.environ.get('S3_REGION', 'us-east-1'),
+        # one pooled connection per worker; retries are done per part below
+        'config': Config(signature_version='s3v4', max_pool_connections=CONCURRENCY + 1,
+                         retries={'max_attempts': 1}),
+    }
+    if os.environ.get('S3_ENDPOINT'):
+        kwargs['endpoint_url'] = os.environ['S3_ENDPOINT']
+    return boto3.client('s3', **kwargs)
+
+
+class Progress:
+    def __init__(self, total, done=0):
+        self.total = total
+        self.done = done
+        self.start = self.last = time.monotonic()
+        self.start_bytes = done
+        self.lock = threading.Lock()
+
+    def add(self, n):
+        with self.lock:
+            self.done += n
+            now = time.monotonic()
+            if now - self.last >= PROGRESS_INTERVAL:
+                self.last = now
+                self.report(now)
+
+    def report(self, now=None):
+        elapsed = (now or time.monotonic()) - self.start
+        rate = (self.done - self.start_bytes) / elapsed if elapsed > 0 else 0
+        eta = f', ETA {int((self.total - self.done) / rate)}s' if rate and self.done < self.total else ''
+        pct = self.done * 100 // self.total if self.total else 100
+        log(f'{self.done / 1048576:.1f}/{self.total / 1048576:.1f} MB ({pct}%), {rate / 1048576:.1f} MB/s{eta}')
+
+
+class Fetcher:
+    def __init__(self, key):
+        self.s3 = client()
+        self.key = key if key.startswith(PREFIX) else PREFIX + key
+        head = self.s3.head_object(Bucket=BUCKET, Key=self.key)
+        self.size = head['ContentLength']
+        self.etag = head['ETag']
+        self.parts = -(-self.size // PART_SIZE)
+        self.progress = None
+        self.failed = threading.Event()
+
+    def span(self, i):
+        start = i * PART_SIZE
+        return start, min(self.size, start + PART_SIZE) - 1
+
+    def fetch(self, i):
+        """Part i as bytes, resuming a broken transfer where it stopped"""
+        start, end = self.span(i)
+        buf = bytearray()
+        for attempt in range(RETRIES + 1):
+            if self.failed.is_set():
+                raise RuntimeError('aborted')
+            try:
+                resp = self.s3.get_object(Bucket=BUCKET, Key=self.key, IfMatch=self.etag,
+                                          Range=f'bytes={start + len(buf)}-{end}')
+                for chunk in resp['Body'].iter_chunks(READ_CHUNK):
+                    buf += chunk
+                    self.progress.add(len(chunk))
+                if len(buf) == end - start + 1:
+                    return bytes(buf)
+                raise OSError(f'part {i}: got {len(buf)} of {end - start + 1} bytes')
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code', '')
+                if code in FATAL or attempt == RETRIES:
+                    if code in ('PreconditionFailed', '412'):
+                        raise RuntimeError(f'{self.key} changed during the download') from e
+                    raise
+                error = e
+            except (BotoCoreError, OSError) as e:
+                if attempt == RETRIES:
+                    raise
+                error = e
+            delay = min(30, 2 ** attempt) * random.uniform(0.5, 1)
+            log(f'part {i}: {error}; retrying in {delay:.1f}s ({len(buf)} bytes kept)')
+            time.sleep(delay)
+
+    def stream(self, out):
+        """Write the object to `out` in order while later parts download"""
+        self.progress = Progress(self.size)
+        window = 2 * CONCURRENCY
+        with ThreadPoolExecutor(CONCURRENCY) as pool:
+            pending = {}
+            try:
+                for i in range(min(window, self.parts)):
+                    pending[i] = pool.submit(self.fetch, i)
+                for i in range(self.parts):
+                    data = pending.pop(i).result()
+                    if i + window < self.parts:
+                        pending[i + window] = pool.submit(self.fetch, i + window)
+                    out.write(data)
+                out.flush()
+            except BaseException:
+                self.failed.set()
+                for f in pending.values():
+                    f.cancel()
+                raise
+        self.progress.report()
+
+    def download(self, dest):
+        """Fetch into dest.part, resumable across runs, then rename to dest"""
+        part_path, state_path = f'{dest}.part', f'{dest}.part.json'
+        state = {}
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            pass
+        if (state.get('etag'), state.get('size'), state.get('part_size')) != (self.etag, self.size, PART_SIZE) \
+                or not os.path.exists(part_path):
+            state = {'etag': self.etag, 'size': self.size, 'part_size': PART_SIZE, 'done': []}
+            with open(part_path, 'wb') as f:
+                f.truncate(self.size)
+        done = set(state['done'])
+        todo = [i for i in range(self.parts) if i not in done]
+        if done:
+            log(f'resuming: {len(done)} of {self.parts} parts already downloaded')
+        self.progress = Progress(self.size, sum(self.span(i)[1] - self.span(i)[0] + 1 for i in done))
+        lock = threading.Lock()
+        fd = os.open(part_path, os.O_WRONLY)
+        try:
+            def one(i):
+                data = self.fetch(i)
+                os.pwrite(fd, data, self.span(i)[0])
+                os.fdatasync(fd)  # on disk before it is recorded as done
+                with lock:
+                    done.add(i)
+                    state['done'] = sorted(done)
+                    with open(f'{state_path}.tmp', 'w') as f:
+                        json.dump(state, f)
+                    os.replace(f'{state_path}.tmp', state_path)
+
+            with ThreadPoolExecutor(CONCURRENCY) as pool:
+                futures = [pool.submit(one, i) for i in todo]
+                try:
+                    for f in futures:
+                        f.result()
+                except BaseException:
+                    self.failed.set()
+                    for f in futures:
+                        f.cancel()
+                    raise
+        finally:
+            os.close(fd)
+        os.replace(part_path, dest)
+        try:
+            os.unlink(state_path)
+        except FileNotFoundError:
+            pass  # nothing to fetch (an empty object)
+        self.progress.report()
+
+
+def main(argv):
+    if len(argv) != 3:
+        print('Usage: s3fetch.py KEY - | s3fetch.py KEY FILE', file=sys.stderr)
+        return 2
+    key, dest = argv[1], argv[2]
+    try:
+        fetcher = Fetcher(key)
+        log(f's3://{BUCKET}/{fetcher.key}: {fetcher.size / 1048576:.1f} MB in {fetcher.parts} parts, '
+            f'{CONCURRENCY} at a time')
+        if dest == '-':
+            fetcher.stream(sys.stdout.buffer)
+        else:
+            fetcher.download(dest)
+    except BrokenPipeError:
+        log('Error: the extraction stopped reading')
+        return 1
+    except (ClientError, BotoCoreError, OSError, RuntimeError) as e:
+        log(f'Error: {e}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""Where a user's data lives when SYNC_SHARDS > 1.
+
+entrypoint.sh then runs one anki-sync-server per shard, each with
+SYNC_BASE=<SYNC_BASE>/shard-<i> and listening on SYNC_SHARD_BASE_PORT + i,
+and users are assigned by a stable hash of their name. This module applies
+the same hash so the exporter, dashboard and analytics find every user's
+folder without asking the servers.
+"""
+
+import hashlib
+import os
+import socket
+
+DATA_DIR = os.environ.get('SYNC_BASE', '/data')
+SHARDS = max(1, int(os.environ.get('SYNC_SHARDS', 1)))
+SHARD_BASE_PORT = int(os.environ.get('SYNC_SHARD_BASE_PORT', 8090))
+
+
+def shard_of(user):
+    # same as entrypoint.sh: first 32 bits of sha1(name), mod the shard count
+    return int(hashlib.sha1(user.encode()).hexdigest()[:8], 16) % SHARDS
+
+
+def shard_dir(shard):
+    return os.path.join(DATA_DIR, f'shard-{shard}') if SHARDS > 1 else DATA_DIR
+
+
+def user_dir(user):
+    return os.path.join(shard_dir(shard_of(user)), user)
+
+
+def shard_up(shard, timeout=0.5):
+    """Whether the shard's server accepts connections"""
+    try:
+        with socket.create_connection(('127.0.0.1', SHARD_BASE_PORT + shard), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+def host_key(value):
+    # what the server hands out at login: sha1 of the SYNC_USERn value
+    return hashlib.sha1(value.encode()).hexdigest()
+
+
+if __name__ == '__main__':
+    import sys
+    if sys.argv[1:] == ['--route']:
+        # SYNC_USERn values on stdin -> shard, host key and value, tab-separated
+        for line in sys.stdin:
+            value = line.rstrip('\n')
+            if value:
+                print(shard_of(value.split(':', 1)[0]), host_key(value), value, sep='\t')
+    else:
+        for name in sys.argv[1:]:
+            print(shard_of(name), name)
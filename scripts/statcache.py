@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""Bounded stat-validated cache for the exporter and the dashboard.
+
+Entries are keyed by path and only reused while the path's (mtime, size,
+inode) still match, so a hit costs one stat(). The cache is an LRU bounded by
+entry count and an estimate of its memory use, every entry also expires after
+a maximum age, and the whole thing is written to STATE_DIR now and then so a
+restarted process revalidates from disk instead of rescanning /data and
+copying every locked collection again.
+
+The exporter and the dashboard call it from several request threads at
+once: the entries and counters are guarded by a lock, and compute() runs
+outside it.
+"""
+
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+STATE_DIR = os.environ.get('STATE_DIR', '/var/lib/anki')
+MAX_ENTRIES = int(os.environ.get('STATCACHE_MAX_ENTRIES', 20000))
+MAX_BYTES = int(float(os.environ.get('STATCACHE_MAX_MB', 16)) * 1024 * 1024)
+MAX_AGE = int(os.environ.get('STATCACHE_MAX_AGE', 86400))
+SAVE_INTERVAL = 30
+ENTRY_OVERHEAD = 200  # dict slots, tuples and ints around each entry
+
+
+def validator(path):
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size, st.st_ino]
+
+
+class StatCache:
+    def __init__(self, name, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES, max_age=MAX_AGE):
+        self.name = name
+        self.path = os.path.join(STATE_DIR, f'statcache-{name}.json')
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.entries = OrderedDict()  # path -> (validator, stored, value, bytes)
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self.dirty = False
+        self.saved = time.time()
+        self.lock = threading.Lock()
+        self._save_lock = threading.Lock()  # one writer of the .tmp file at a time
+        self._load()
+        atexit.register(self.save)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        with self.lock:
+            for key, (check, stored, value) in data.get('entries', []):
+                if now - stored < self.max_age:
+                    self._put(key, check, stored, value)
+
+    # _put and _drop expect self.lock to be held
+    def _put(self, key, check, stored, value):
+        self._drop(key)
+        size = len(key) + len(json.dumps(value)) + ENTRY_OVERHEAD
+        self.entries[key] = (check, stored, value, size)
+        self.bytes += size
+        while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+            self._drop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _drop(self, key):
+        old = self.entries.pop(key, None)
+        if old:
+            self.bytes -= old[3]
+
+    def get(self, path, compute, max_age=None):
+        """compute(path) unless a cached value for the path's current
+        (mtime, size, inode) is younger than max_age (default: the cache's)"""
+        try:
+            check = validator(path)
+        except OSError:
+            with self.lock:
+                self._drop(path)
+            return compute(path)
+        now = time.time()
+        age = self.max_age if max_age is None else min(max_age, self.max_age)
+        with self.lock:
+            entry = self.entries.get(path)
+            hit = entry is not None and entry[0] == check and now - entry[1] < age
+            if hit:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                if now - self.saved >= SAVE_INTERVAL:
+                    self.dirty = True  # keep the persisted hit counters current
+            else:
+                self.misses += 1
+        if hit:
+            self._maybe_save(now)
+            return entry[2]
+        value = compute(path)
+        if value is not None:
+            with self.lock:
+                self._put(path, check, now, value)
+                self.dirty = True
+        self._maybe_save(now)
+        return value
+
+    def _maybe_save(self, now):
+        if self.dirty and now - self.saved >= SAVE_INTERVAL:
+            self.save()
+
+    def peek(self, path):
+        """(value, age) if the path is cached and still valid, else None"""
+        with self.lock:
+            entry = self.entries.get(path)
+        try:
+            if entry and entry[0] == validator(path):
+                return entry[2], time.time() - entry[1]
+        except OSError:
+            pass
+        return None
+
+    def stats(self):
+        with self.lock:
+            return self._stats()
+
+    def _stats(self):
+        return {'entries': len(self.entries), 'bytes': self.bytes, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+    def save(self):
+        # another thread already writing covers this save too
+        if not self._save_lock.acquire(blocking=False):
+            return
+        try:
+            with self.lock:
+                if not self.dirty:
+                    return
+                data = {'stats': self._stats(),
+                        'entries': [[k, [c, s, v]] for k, (c, s, v, _) in self.entries.items()]}
+                self.dirty = False
+                self.saved = time.time()
+            tmp = f'{self.path}.tmp'
+            try:
+                with open(tmp, 'w') as f:
+                    json.dump(data, f)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                with self.lock:
+                    self.dirty = True
+                print(f'[statcache] {self.name}: {e}', file=sys.stderr)
+        finally:
+            self._save_lock.release()
+
+
+def saved_stats(name):
+    """Counters another process last persisted"""
+    try:
+        with open(os.path.join(STATE_DIR, f'statcache-{name}.json')) as f:
+            return json.load(f).get('stats', {})
+    except (OSError, ValueError):
+        return {}
+
+
+# media folders hold thousands of files that are replaced, never rewritten,
+# so their mtime is enough; small directories (collection files that grow in
+# place) are rescanned once they are older than the caller's ttl
+LARGE_DIR = 256
+
+
+def dir_size(cache, path, ttl=60):
+    def scan(d):
+        files = total = 0
+        dirs = []
+        with os.scandir(d) as it:
+            for e in it:
+                try:
+                    if e.is_dir(follow_symlinks=False):
+                        dirs.append(e.name)
+                    elif e.is_file(follow_symlinks=False):
+                        files += 1
+                        total += e.stat(follow_symlinks=False).st_size
+                except OSError:
+                    pass
+        return {'files': files, 'bytes': total, 'dirs': dirs}
+
+    total = 0
+    stack = [path]
+    while stack:
+        d = stack.pop()
+        known = cache.peek(d)
+        max_age = None if known and known[0]['files'] >= LARGE_DIR else ttl
+        try:
+            node = cache.get(d, scan, max_age)
+        except OSError:
+            continue
+        total += node['bytes']
+        stack.extend(os.path.join(d, n) for n in node['dirs'])
+    return total
@@ -3,12 +3,13 @@
 # Anki Sync Server - User Management CLI
 # =============================================================================
 # 
-# Note: Adding/removing users requires container restart to take effect.
-# This tool manages a user config file that can be used with --env-file.
+# Users live in the user store (userstore.py, /config/users.db). Changes are
+# applied without a container restart: the entrypoint reloads the store on
+# SIGHUP and restarts only the sync servers whose users changed.
 # =============================================================================
 
-CONFIG_FILE="${CONFIG_FILE:-/config/users.env}"
 DATA_DIR="${SYNC_BASE:-/data}"
+SUPERVISOR_PID_FILE=/var/run/anki-supervisor.pid
 
 usage() {
     cat << 'EOF'
@@ -19,8 +20,13 @@ Commands:
   add <username> [pass]    Add a new user (generates password if not provided)
   remove <username>        Remove a user
   reset <username> [pass]  Reset user password
+  import [file] [--replace]
+                           Add or update users from name:password or
+                           SYNC_USERn=name:password lines (stdin if no file);
+                           --replace also removes users missing from the file
+  export [--env]           Print users as name:password (or SYNC_USERn=) lines
+  reload                   Make the sync server pick up the user store again
   hash <password>          Generate hashed password
-  export                   Export users as environment variables
   stats                    Show user statistics
   help                     Show this help
 
@@ -30,14 +36,33 @@ Examples:
   user-manager.sh add john mypassword
   user-manager.sh remove john
   user-manager.sh reset john newpassword
+  user-manager.sh import users.txt
+  user-manager.sh export > users.txt
   user-manager.sh hash mypassword
   user-manager.sh stats
 
-Note: Changes require container restart to take effect.
-      Use 'export' to generate env vars for docker-compose.
+Note: With PASSWORDS_HASHED, plain passwords given to add, reset and import
+      are stored hashed.
 EOF
 }
 
+# Write as anki so the store stays readable by the exporter and dashboard
+store() {
+    if [ "$(id -u)" = "0" ] && id anki > /dev/null 2>&1; then
+        setpriv --reuid anki --regid anki --init-groups python3 /usr/local/bin/userstore.py "$@"
+    else
+        python3 /usr/local/bin/userstore.py "$@"
+    fi
+}
+
+reload_server() {
+    if [ -f "$SUPERVISOR_PID_FILE" ] && kill -HUP "$(cat "$SUPERVISOR_PID_FILE")" 2>/dev/null; then
+        echo "Applied: the sync server is reloading its users."
+    else
+        echo "Could not signal the sync server; restart the container to apply."
+    fi
+}
+
 generate_password() {
     openssl rand -base64 16 | tr -d '/+=' | head -c 16
 }
@@ -64,31 +89,17 @@ list_users() {
     echo "================="
     
     local count=0
-    for var in $(env | grep -E '^SYNC_USER[0-9]+=' | sort -t= -k1 -V); do
-        value="${var#*=}"
-        username="${value%%:*}"
+    while IFS=$'\t' read -r username source updated; do
         count=$((count + 1))
-        echo "  $count. $username"
-    done
+        printf "  %d. %-24s %-4s %s\n" "$count" "$username" "$source" "$updated"
+    done < <(store list)
     
     if [ $count -eq 0 ]; then
         echo "  No users configured."
     fi
     
     echo ""
-    echo "Total: $count users"
-    
-    # Check config file
-    if [ -f "$CONFIG_FILE" ]; then
-        echo ""
-        echo "Config file: $CONFIG_FILE"
-        echo "Users in config file:"
-        grep -E '^SYNC_USER[0-9]+=' "$CONFIG_FILE" 2>/dev/null | while read -r line; do
-            username="${line#*=}"
-            username="${username%%:*}"
-            echo "  - $username"
-        done
-    fi
+    echo "Total: $count users (source env = seeded from SYNC_USERn)"
 }
 
 add_user() {
@@ -105,19 +116,12 @@ add_user() {
         generated=true
     fi
     
-    # Find next available user number
-    local max_num=0
-    for var in $(env | grep -E '^SYNC_USER[0-9]+=' | sed 's/=.*//' | sed 's/SYNC_USER//'); do
-        [ "$var" -gt "$max_num" ] && max_num=$var
-    done
-    local next_num=$((max_num + 1))
-    
-    # Create config directory if needed
-    mkdir -p "$(dirname "$CONFIG_FILE")"
+    if store has "$username"; then
+        echo "Error: User '$username' already exists (use reset to change the password)"
+        exit 1
+    fi
     
-    # Add to config file
-    echo "SYNC_USER${next_num}=${username}:${password}" >> "$CONFIG_FILE"
-    chmod 600 "$CONFIG_FILE"
+    printf '%s\n' "$password" | store set "$username" > /dev/null || exit 1
     
     echo ""
     echo "User added successfully!"
@@ -127,11 +131,8 @@ add_user() {
     else
         echo "  Password: (as specified)"
     fi
-    echo "  Variable: SYNC_USER${next_num}"
     echo ""
-    echo "To apply: Restart the container with --env-file $CONFIG_FILE"
-    echo "Or add to your docker-compose.yml:"
-    echo "  SYNC_USER${next_num}=${username}:${password}"
+    reload_server
 }
 
 remove_user() {
@@ -142,18 +143,15 @@ remove_user() {
         exit 1
     fi
     
-    if [ ! -f "$CONFIG_FILE" ]; then
-        echo "Error: Config file not found: $CONFIG_FILE"
-        exit 1
-    fi
-    
-    # Remove from config file
-    if grep -q "=${username}:" "$CONFIG_FILE"; then
-        sed -i "/=${username}:/d" "$CONFIG_FILE"
-        echo "User '$username' removed from $CONFIG_FILE"
-        echo "Restart the container to apply changes."
+    local source
+    if source=$(store remove "$username"); then
+        echo "User '$username' removed"
+        if [ "$source" = "env" ]; then
+            echo "Note: '$username' is still set in a SYNC_USERn variable and returns on the next container start."
+        fi
+        reload_server
     else
-        echo "User '$username' not found in config file."
+        exit 1
     fi
 }
 
@@ -166,22 +164,15 @@ reset_password() {
         exit 1
     fi
     
-    if [ ! -f "$CONFIG_FILE" ]; then
-        echo "Error: Config file not found: $CONFIG_FILE"
+    if ! store has "$username"; then
+        echo "User '$username' not found."
         exit 1
     fi
     
-    if grep -q "=${username}:" "$CONFIG_FILE"; then
-        # Get the variable name
-        local varname=$(grep "=${username}:" "$CONFIG_FILE" | cut -d= -f1)
-        # Replace the line
-        sed -i "s|^${varname}=.*|${varname}=${username}:${password}|" "$CONFIG_FILE"
-        echo "Password reset for '$username'"
-        [ -z "$2" ] && echo "New password: $password"
-        echo "Restart the container to apply changes."
-    else
-        echo "User '$username' not found in config file."
-    fi
+    printf '%s\n' "$password" | store set "$username" > /dev/null || exit 1
+    echo "Password reset for '$username'"
+    [ -z "$2" ] && echo "New password: $password"
+    reload_server
 }
 
 show_stats() {
@@ -189,7 +180,7 @@ show_stats() {
     echo "User Statistics:"
     echo "================"
     
-    local user_count=$(env | grep -cE '^SYNC_USER[0-9]+=' || echo 0)
+    local user_count=$(store count 2>/dev/null || echo 0)
     echo "  Active users: $user_count"
     
     if [ -d "$DATA_DIR" ]; then
@@ -202,10 +193,10 @@ show_stats() {
         echo "  User data dirs: $user_dirs"
     fi
     
-    # Auth stats from log
+    # Auth stats from log, including rotated segments
     if [ -f /var/log/anki/auth.log ]; then
-        local auth_success=$(grep -c "AUTH_SUCCESS" /var/log/anki/auth.log 2>/dev/null || echo 0)
-        local auth_failed=$(grep -c "AUTH_FAILED" /var/log/anki/auth.log 2>/dev/null || echo 0)
+        local auth_success=$(python3 /usr/local/bin/logstore.py count /var/log/anki/auth.log AUTH_SUCCESS 2>/dev/null || echo 0)
+        local auth_failed=$(python3 /usr/local/bin/logstore.py count /var/log/anki/auth.log AUTH_FAILED 2>/dev/null || echo 0)
         echo "  Auth success: $auth_success"
         echo "  Auth failed: $auth_failed"
     fi
@@ -213,14 +204,31 @@ show_stats() {
     echo ""
 }
 
+import_users() {
+    local file="${1:--}"
+    local replace=""
+    if [ "$1" = "--replace" ]; then
+        file="${2:--}"
+        replace="--replace"
+    elif [ "$2" = "--replace" ]; then
+        replace="--replace"
+    fi
+    
+    if [ "$file" != "-" ] && [ ! -f "$file" ]; then
+        echo "Error: File not found: $file"
+        exit 1
+    fi
+    
+    # the store runs as anki and may not be able to open the file itself
+    cat "$file" | store import $replace || exit 1
+    reload_server
+}
+
 export_users() {
     echo "# Anki Sync Server Users"
     echo "# Generated: $(date -Iseconds)"
-    echo ""
     
-    for var in $(env | grep -E '^SYNC_USER[0-9]+=' | sort -t= -k1 -V); do
-        echo "$var"
-    done
+    store export "$@"
 }
 
 # =============================================================================
@@ -247,8 +255,14 @@ case "${1:-help}" in
         fi
         hash_password "$2"
         ;;
+    import)
+        import_users "$2" "$3"
+        ;;
     export)
-        export_users
+        export_users "$2"
+        ;;
+    reload)
+        reload_server
         ;;
     stats|status)
         show_stats
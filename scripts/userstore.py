@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""Indexed user store (USER_DB, /config/users.db by default).
+
+Accounts live in one SQLite table keyed by name instead of SYNC_USERn
+variables or a flat file, so thousands of them can be listed, looked up and
+changed cheaply. entrypoint.sh seeds the store from SYNC_USERn at startup and
+hands its rows to anki-sync-server; user-manager.sh edits it and sends the
+entrypoint a SIGHUP, which restarts only the sync servers whose users changed.
+
+Rows seeded from the environment have source 'env' and follow it: they are
+updated when the variable changes and dropped when it goes away. Rows added
+or changed with user-manager.sh have source 'cli' and are left alone.
+
+Readers (exporter, dashboard, analytics) call names(), which re-queries only
+when the database's file change counter moves.
+
+  userstore.py seed | env | names | has NAME | count | list
+  userstore.py set NAME < secret | remove NAME
+  userstore.py import [FILE] [--replace] | export [--env]
+"""
+
+import base64
+import hashlib
+import os
+import re
+import sqlite3
+import sys
+import time
+
+DB_PATH = os.environ.get('USER_DB', '/config/users.db')
+HASHED = os.environ.get('PASSWORDS_HASHED', '') in ('1', 'true')
+HASH_ROUNDS = 600_000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    name TEXT PRIMARY KEY, secret TEXT NOT NULL, source TEXT NOT NULL DEFAULT 'cli',
+    created REAL, updated REAL
+) WITHOUT ROWID;
+'''
+
+ENV_VAR = re.compile(r'^SYNC_USER(\d+)$')
+# becomes a folder name under SYNC_BASE and is split off the secret at ':'
+VALID_NAME = re.compile(r'^[^\s:/\\]+$')
+
+_cache = {'check': None, 'names': []}
+
+
+def connect():
+    # rollback journal (not WAL) so every commit bumps the header's change
+    # counter, which is what readers validate against
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def check_name(name):
+    if not VALID_NAME.match(name) or name in ('.', '..'):
+        raise ValueError(f'invalid user name: {name!r}')
+    return name
+
+
+def hash_secret(password):
+    """PHC string the server's pbkdf2 crate accepts (same as user-manager.sh hash)"""
+    salt = os.urandom(16)
+    dk = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, HASH_ROUNDS, dklen=32)
+    b64 = lambda b: base64.b64encode(b).decode().rstrip('=')
+    return f'$pbkdf2-sha256$i={HASH_ROUNDS},l=32${b64(salt)}${b64(dk)}'
+
+
+def verify_secret(password, phc):
+    try:
+        _, algo, params, salt, dk = phc.split('$')
+        rounds = int(dict(kv.split('=') for kv in params.split(','))['i'])
+        unb64 = lambda s: base64.b64decode(s + '=' * (-len(s) % 4))
+        return algo == 'pbkdf2-sha256' and hashlib.pbkdf2_hmac(
+            'sha256', password.encode(), unb64(salt), rounds, dklen=len(unb64(dk))) == unb64(dk)
+    except (ValueError, KeyError):
+        return False
+
+
+def prepare(secret):
+    if not secret or '\n' in secret:
+        raise ValueError('empty or multi-line password')
+    if HASHED and not secret.startswith('$pbkdf2-'):
+        return hash_secret(secret)
+    return secret
+
+
+def _validator():
+    # inode plus the file change counter at offset 24 of the header
+    with open(DB_PATH, 'rb') as f:
+        return os.fstat(f.fileno()).st_ino, f.read(28)[24:28]
+
+
+def names():
+    """Sorted user names; one small read when the store hasn't changed"""
+    try:
+        check = _validator()
+    except OSError:
+        return []
+    if check != _cache['check']:
+        try:
+            conn = sqlite3.connect(f'file:{DB_PATH}?mode=ro', uri=True, timeout=5)
+            try:
+                rows = conn.execute('SELECT name FROM users ORDER BY name').fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print(f'[userstore] {e}', file=sys.stderr)
+            return _cache['names']
+        _cache['check'], _cache['names'] = check, [r[0] for r in rows]
+    return _cache['names']
+
+
+def rows(conn):
+    return conn.execute('SELECT name, secret, source, created, updated FROM users ORDER BY name').fetchall()
+
+
+def _upsert(conn, name, secret, source, now):
+    old = conn.execute('SELECT secret, source FROM users WHERE name = ?', (name,)).fetchone()
+    if old is None:
+        conn.execute('INSERT INTO users VALUES (?, ?, ?, ?, ?)', (name, secret, source, now, now))
+        return 'added'
+    if old == (secret, source):
+        return 'unchanged'
+    conn.execute('UPDATE users SET secret = ?, source = ?, updated = ? WHERE name = ?',
+                 (secret, source, now, name))
+    return 'updated'
+
+
+def set_user(conn, name, secret):
+    with conn:
+        return _upsert(conn, check_name(name), prepare(secret), 'cli', time.time())
+
+
+def remove_user(conn, name):
+    """The removed row's source, or None if there was no such user"""
+    with conn:
+        row = conn.execute('SELECT source FROM users WHERE name = ?', (name,)).fetchone()
+        conn.execute('DELETE FROM users WHERE name = ?', (name,))
+    return row[0] if row else None
+
+
+def parse_line(line):
+    """(name, secret) from 'name:secret' or 'SYNC_USERn=name:secret'; None
+    for blank lines and comments"""
+    line = line.rstrip('\r\n')
+    if not line.strip() or line.lstrip().startswith('#'):
+        return None
+    var, sep, value = line.partition('=')
+    if sep and ENV_VAR.match(var.strip()):
+        line = value
+    name, sep, secret = line.partition(':')
+    if not sep:
+        raise ValueError(f'expected name:password, got {line!r}')
+    return check_name(name.strip()), secret
+
+
+def import_users(conn, pairs, replace=False, source='cli'):
+    """Add or update every (name, secret); with replace, also drop rows of
+    the same source that are missing. Returns counts by outcome."""
+    now = time.time()
+    counts = {'added': 0, 'updated': 0, 'unchanged': 0, 'removed': 0}
+    seen = set()
+    with conn:
+        for name, secret in pairs:
+            seen.add(name)
+            old = conn.execute('SELECT secret FROM users WHERE name = ?', (name,)).fetchone()
+            # re-hashing picks a new salt, which would change the value and with
+            # it the user's host key, so keep a hash that still matches
+            if HASHED and old and (old[0] == secret or verify_secret(secret, old[0])):
+                counts['unchanged'] += 1
+                continue
+            counts[_upsert(conn, name, prepare(secret), source, now)] += 1
+        if replace:
+            for (name,) in conn.execute('SELECT name FROM users WHERE source = ?', (source,)).fetchall():
+                if name not in seen:
+                    conn.execute('DELETE FROM users WHERE name = ?', (name,))
+                    counts['removed'] += 1
+    return counts
+
+
+def seed(conn, environ=os.environ):
+    """Sync the source='env' rows with SYNC_USERn; users since changed with
+    user-manager.sh keep their store values"""
+    pairs = []
+    for var in sorted((v for v in environ if ENV_VAR.match(v)), key=lambda v: int(ENV_VAR.match(v).group(1))):
+        name, secret = parse_line(environ[var])
+        row = conn.execute('SELECT source FROM users WHERE name = ?', (name,)).fetchone()
+        if row is None or row[0] == 'env':
+            pairs.append((name, secret))
+    return import_users(conn, pairs, replace=True, source='env')
+
+
+def main(argv):
+    cmd = argv[0] if argv else 'names'
+    args = argv[1:]
+    if cmd == 'names':
+        print('\n'.join(names()))
+        return 0
+    if cmd == 'has' and len(args) == 1:
+        return 0 if args[0] in names() else 1
+    conn = connect()
+    try:
+        if cmd == 'seed':
+            c = seed(conn)
+            print(f'[userstore] from SYNC_USERn: {c["added"]} added, {c["updated"]} updated, '
+                  f'{c["removed"]} removed', file=sys.stderr)
+        elif cmd == 'env':
+            for name, secret, *_ in rows(conn):
+                print(f'{name}:{secret}')
+        elif cmd == 'count':
+            print(conn.execute('SELECT COUNT(*) FROM users').fetchone()[0])
+        elif cmd == 'list':
+            for name, _, source, _, updated in rows(conn):
+                print(f'{name}\t{source}\t{time.strftime("%Y-%m-%d %H:%M", time.localtime(updated))}')
+        elif cmd == 'set' and len(args) == 1:
+            print(set_user(conn, args[0], sys.stdin.readline().rstrip('\r\n')))
+        elif cmd == 'remove' and len(args) == 1:
+            source = remove_user(conn, args[0])
+            if source is None:
+                print(f'User {args[0]!r} not found', file=sys.stderr)
+                return 1
+            print(source)
+        elif cmd == 'import':
+            replace = '--replace' in args
+            files = [a for a in args if a != '--replace']
+            f = open(files[0]) if files and files[0] != '-' else sys.stdin
+            with f:
+                pairs = [p for p in map(parse_line, f) if p]
+            c = import_users(conn, pairs, replace)
+            print(f'{c["added"]} added, {c["updated"]} updated, {c["unchanged"]} unchanged, '
+                  f'{c["removed"]} removed')
+        elif cmd == 'export':
+            for n, (name, secret, *_) in enumerate(rows(conn), 1):
+                print(f'SYNC_USER{n}={name}:{secret}' if '--env' in args else f'{name}:{secret}')
+        else:
+            print('\n'.join(__doc__.strip().splitlines()[-3:]), file=sys.stderr)
+            return 2
+        return 0
+    except ValueError as e:
+        print(f'Error: {e}', file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))